@@ -0,0 +1,1130 @@
+import os
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+
+# Локальные файлы бота (история, журнал, каталог) создаются во временном каталоге бенчмарка
+# (процессы пула разбора импортируют этот модуль заново и должны использовать тот же каталог)
+if "STOCK_BOT_BENCH_DIR" not in os.environ:
+    os.environ["STOCK_BOT_BENCH_DIR"] = tempfile.mkdtemp(prefix="stock-bot-bench-")
+BENCH_DIR = os.environ["STOCK_BOT_BENCH_DIR"]
+os.environ.setdefault("HISTORY_DB_FILE", os.path.join(BENCH_DIR, "history.db"))
+os.environ.setdefault("SHEETS_JOURNAL_FILE", os.path.join(BENCH_DIR, "sheets_journal.jsonl"))
+os.environ.setdefault("JOURNAL_FLUSH_INTERVAL", "0.05")
+os.environ.setdefault("ADMIN_ID", "1")
+# Квоты Google Sheets не ограничивают замеры, кроме наборов, где они проверяются явно
+os.environ.setdefault("SHEETS_WRITES_PER_MINUTE", "600000")
+os.environ.setdefault("SHEETS_READS_PER_MINUTE", "600000")
+# Лимиты Telegram тоже не мешают замерам; набор outbox проверяет их отдельно
+os.environ.setdefault("TELEGRAM_GLOBAL_PER_SECOND", "100000")
+os.environ.setdefault("TELEGRAM_CHAT_PER_SECOND", "100000")
+os.environ.setdefault("TELEGRAM_GROUP_PER_MINUTE", "6000000")
+
+from openpyxl import Workbook
+from google_sheets import add_to_sheet, add_rows_to_sheet, build_row
+from stock_parser import CODE_COLUMN, NAME_COLUMN, QUANTITY_COLUMN, read_stock_frame, aggregate_stock
+
+# Фейковый лист Google Sheets: хранит строки в памяти, считает запросы к API
+# и имитирует сетевую задержку каждого вызова
+class FakeWorksheet:
+    title = "Sheet1"
+
+    def __init__(self, latency=0.0, rows=None):
+        self.rows = [list(row) for row in rows or []]
+        self.latency = latency
+        self.calls = {}
+        self.cells_read = 0  # Объём чтений: сколько ячеек вернули get/get_all_values
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _append(self, rows):
+        first_row = len(self.rows) + 1
+        self.rows.extend(list(row) for row in rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first_row}:F{len(self.rows)}"}}
+
+    def append_row(self, row, **kwargs):
+        self._call("append_row")
+        return self._append([row])
+
+    def append_rows(self, rows, **kwargs):
+        self._call("append_rows")
+        return self._append(rows)
+
+    def findall(self, query, **kwargs):
+        self._call("findall")
+        return [
+            SimpleNamespace(row=r, col=c, value=value)
+            for r, row in enumerate(self.rows, start=1)
+            for c, value in enumerate(row, start=1)
+            if str(value) == str(query)
+        ]
+
+    def row_values(self, row, **kwargs):
+        self._call("row_values")
+        return [str(value) for value in self.rows[row - 1]]
+
+    def get(self, range_name=None, **kwargs):
+        self._call("get")
+        self.cells_read += 2 * len(self.rows)
+        return [[str(value) for value in row[:2]] for row in self.rows]
+
+    def get_all_values(self, **kwargs):
+        self._call("get_all_values")
+        self.cells_read += sum(len(row) for row in self.rows)
+        return [[str(value) for value in row] for row in self.rows]
+
+    def _write(self, range_name, values):
+        row_number = int(range_name.split(":")[0].lstrip("ABCDEF"))
+        self.rows[row_number - 1] = list(values[0])
+
+    def update(self, range_name=None, values=None, **kwargs):
+        self._call("update")
+        self._write(range_name, values)
+
+    def batch_get(self, ranges, **kwargs):
+        self._call("batch_get")
+        result = []
+        for range_name in ranges:
+            row_number = int(range_name.split(":")[0].lstrip("ABCDEF"))
+            row = self.rows[row_number - 1][:2] if row_number <= len(self.rows) else []
+            self.cells_read += len(row)
+            result.append([[str(value) for value in row]] if row else [])
+        return result
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+        for item in data:
+            self._write(item["range"], item["values"])
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+# Фейковый лист, отвечающий 429 (превышение квоты) на долю запросов, как Google Sheets API.
+# Ошибка — настоящий gspread APIError с заголовком Retry-After.
+class FlakyWorksheet(FakeWorksheet):
+    def __init__(self, latency=0.0, rows=None, fault_rate=0.2, retry_after=None, seed=0):
+        super().__init__(latency, rows)
+        self.fault_rate = fault_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.faults = 0
+
+    def _call(self, name):
+        super()._call(name)
+        if self.rng.random() < self.fault_rate:
+            from gspread.exceptions import APIError
+
+            self.faults += 1
+            error = {"code": 429, "message": "Quota exceeded for quota metric 'Write requests'", "status": "RESOURCE_EXHAUSTED"}
+            headers = {} if self.retry_after is None else {"Retry-After": str(self.retry_after)}
+            raise APIError(SimpleNamespace(status_code=429, headers=headers, text=error["message"], json=lambda: {"error": error}))
+
+# Фейковая таблица: sheet1 и листы, создаваемые add_worksheet
+class FakeSpreadsheet:
+    def __init__(self, latency=0.0, rows=None):
+        self.latency = latency
+        self.sheets = [FakeWorksheet(latency, rows)]
+
+    def get_worksheet(self, index):
+        return self.sheets[index]
+
+    def worksheets(self):
+        return list(self.sheets)
+
+    def add_worksheet(self, title, rows, cols):
+        worksheet = FakeWorksheet(self.latency)
+        worksheet.title = title
+        self.sheets.append(worksheet)
+        return worksheet
+
+    @property
+    def cells_read(self):
+        return sum(sheet.cells_read for sheet in self.sheets)
+
+    def reset_counters(self):
+        for sheet in self.sheets:
+            sheet.calls.clear()
+            sheet.cells_read = 0
+
+# Синтетические строки сверки
+def make_rows(count, date="2025-01-01"):
+    return [build_row(date, str(1000 + i), f"Товар {i}", i % 50, (i * 7) % 50) for i in range(count)]
+
+# Сравнение построчной записи и пакетной записи строк сверки
+def bench_sheet_writes(sizes, latency):
+    print(f"Запись строк сверки (задержка API: {latency * 1000:.0f} мс)")
+    for size in sizes:
+        rows = make_rows(size)
+
+        single = FakeWorksheet(latency)
+        started = time.perf_counter()
+        for row in rows:
+            add_to_sheet(single, *row[:5])
+        single_time = time.perf_counter() - started
+
+        bulk = FakeWorksheet(latency)
+        started = time.perf_counter()
+        failed_chunks = add_rows_to_sheet(bulk, rows)
+        bulk_time = time.perf_counter() - started
+
+        assert not failed_chunks and bulk.rows == single.rows
+        print(
+            f"  {size:>6} строк: append_row — {single.round_trips} запросов, {single_time:.3f} с; "
+            f"append_rows — {bulk.round_trips} запросов, {bulk_time:.3f} с"
+        )
+
+    # Строки, сдвинутые вручную (удалена строка выше), не перезаписываются по устаревшему индексу
+    import google_sheets
+
+    google_sheets._locators.clear()  # Индексы строк строятся заново для нового листа
+    sheet = FakeWorksheet()
+    rows = make_rows(10)
+    google_sheets.upsert_rows(sheet, rows)
+    del sheet.rows[0]
+    changed = build_row(*rows[5][:3], 99, rows[5][4])
+    google_sheets.upsert_rows(sheet, [changed])
+    check(sheet.rows == rows[1:5] + [changed] + rows[6:], "обновление по устаревшему индексу перезаписало чужую строку")
+    google_sheets._locators.clear()
+
+# Синтетическая выгрузка ЕГАИС: три служебные строки, заголовок в четвёртой, лишние столбцы
+def make_stock_workbook(path, rows, distinct_codes=500, seed=0):
+    rng = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Остатки")
+    ws.append(["Отчёт об остатках"])
+    ws.append([f"Сформирован: {time.strftime('%Y-%m-%d %H:%M')}"])
+    ws.append([])
+    ws.append(["№", CODE_COLUMN, NAME_COLUMN, "Справка Б", QUANTITY_COLUMN, "Количество (2 регистр)"])
+    for i in range(rows):
+        code = rng.randrange(distinct_codes)
+        ws.append([i + 1, 100 + code, f"Товар {code}", f"FB-{rng.randrange(10 ** 9):09d}", rng.randrange(1, 20), 0])
+    wb.save(path)
+    return path
+
+# Та же выгрузка в CSV, как её сохраняют программы под Windows: cp1251, разделитель ";"
+def make_stock_csv(path, rows, distinct_codes=500, seed=0):
+    import csv
+
+    rng = random.Random(seed)
+    with open(path, "w", encoding="cp1251", newline="") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(["Отчёт об остатках"])
+        writer.writerow([f"Сформирован: {time.strftime('%Y-%m-%d %H:%M')}"])
+        writer.writerow([])
+        writer.writerow(["№", CODE_COLUMN, NAME_COLUMN, "Справка Б", QUANTITY_COLUMN, "Количество (2 регистр)"])
+        for i in range(rows):
+            code = rng.randrange(distinct_codes)
+            writer.writerow([i + 1, 100 + code, f"Товар {code}", f"FB-{rng.randrange(10 ** 9):09d}", rng.randrange(1, 20), 0])
+    return path
+
+# Прежний построчный алгоритм process_stock_file (для сравнения)
+def aggregate_stock_iterrows(df):
+    stock_data = {}
+    for _, row in df.iterrows():
+        code = str(row[CODE_COLUMN])
+        name = row[NAME_COLUMN]
+        quantity = row[QUANTITY_COLUMN]
+        if code in stock_data:
+            stock_data[code]["quantity"] += quantity
+        else:
+            stock_data[code] = {"name": name, "quantity": quantity}
+    return stock_data
+
+# Сравнение построчной и векторной агрегации выгрузки
+def bench_stock_aggregation(sizes):
+    print("Разбор выгрузки ЕГАИС")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = make_stock_workbook(os.path.join(tmp, f"stock_{size}.xlsx"), size)
+
+            started = time.perf_counter()
+            df = read_stock_frame(path)
+            read_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            legacy = aggregate_stock_iterrows(df)
+            legacy_time = time.perf_counter() - started
+
+            started = time.perf_counter()
+            result = aggregate_stock(df)
+            vector_time = time.perf_counter() - started
+
+            assert result == legacy and list(result) == list(legacy)
+            print(
+                f"  {size:>8} строк: чтение {read_time:.2f} с; агрегация iterrows {legacy_time:.3f} с, "
+                f"groupby {vector_time:.4f} с (x{legacy_time / max(vector_time, 1e-9):.0f})"
+            )
+
+# Сравнение движков чтения выгрузки: прежний pd.read_excel(header=3), движки ingest для xlsx и CSV
+def bench_ingest_engines(sizes):
+    import pandas as pd
+    from ingest import ENGINES, engine_available
+
+    print("Движки чтения выгрузки")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            xlsx_path = make_stock_workbook(os.path.join(tmp, f"stock_{size}.xlsx"), size)
+            csv_path = make_stock_csv(os.path.join(tmp, f"stock_{size}.csv"), size)
+            runs = [("pd.read_excel header=3", lambda: pd.read_excel(
+                xlsx_path, header=3, usecols=lambda column: column in (CODE_COLUMN, NAME_COLUMN, QUANTITY_COLUMN),
+                dtype={CODE_COLUMN: str, NAME_COLUMN: str},
+            ))]
+            runs += [
+                (f"{name} (xlsx)", lambda name=name: read_stock_frame(xlsx_path, engines=[name]))
+                for name in ENGINES if ".xlsx" in ENGINES[name][1]
+            ]
+            runs.append(("csv", lambda: read_stock_frame(csv_path, engines=["csv"])))
+            results = []
+            expected = None
+            for label, read in runs:
+                engine = label.split(" ")[0]
+                if engine in ENGINES and not engine_available(engine):
+                    results.append(f"{label} — не установлен")
+                    continue
+                started = time.perf_counter()
+                stocks = aggregate_stock(read())
+                elapsed = time.perf_counter() - started
+                expected = expected or stocks
+                results.append(f"{label} {elapsed:.2f} с" + ("" if stocks == expected else " (РЕЗУЛЬТАТ ОТЛИЧАЕТСЯ)"))
+            print(f"  {size:>8} строк: " + "; ".join(results))
+
+# Разбор выгрузки в отдельном процессе (вызывается в чистом процессе пула): число кодов, время,
+# пиковый RSS до разбора (после импорта библиотек) и после, байт
+def measure_parse_memory(mode, path):
+    import resource
+    import pandas as pd
+    from stock_parser import stream_stock
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    started = time.perf_counter()
+    if mode == "read_excel":
+        df = pd.read_excel(
+            path, header=3, usecols=lambda column: column in (CODE_COLUMN, NAME_COLUMN, QUANTITY_COLUMN),
+            dtype={CODE_COLUMN: str, NAME_COLUMN: str},
+        )
+        stocks = aggregate_stock(df)
+    elif mode == "frame":
+        stocks = aggregate_stock(read_stock_frame(path))
+    else:
+        stocks = stream_stock(path)
+    elapsed = time.perf_counter() - started
+    return len(stocks), elapsed, before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Пиковая память разбора: прежний pd.read_excel, DataFrame через ingest и потоковый разбор.
+# Каждый замер — в новом процессе, чтобы пик не наследовался от предыдущего.
+def bench_parse_memory(sizes, distinct_codes):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    print(f"Пиковая память разбора выгрузки (различных кодов: {distinct_codes})")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = make_stock_workbook(os.path.join(tmp, f"stock_{size}.xlsx"), size, distinct_codes=distinct_codes)
+            results = []
+            for mode in ("read_excel", "frame", "stream"):
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    codes, elapsed, before, peak = pool.submit(measure_parse_memory, mode, path).result()
+                results.append(f"{mode} +{(peak - before) / 2 ** 20:.1f} МБ за {elapsed:.2f} с")
+            print(f"  {size:>8} строк ({os.path.getsize(path) / 2 ** 20:.1f} МБ, кодов {codes}): " + "; ".join(results))
+
+# Остановка пулов как при завершении бота; следующий набор работает как новый запуск
+# (прерывание пауз Google Sheets снимается, иначе синхронные вызовы следующих наборов сразу прервутся)
+def stop_executors():
+    from executors import shutdown_executors, sheets_stopping
+
+    shutdown_executors()
+    sheets_stopping.clear()
+
+# Проверка результата набора: при нарушении запуск завершается ошибкой
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+# Фейковый бот Telegram: записывает все отправленные сообщения
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent), chat_id=chat_id, text=text)
+
+    # Как Bot API: в ответе file_id загруженного фото, по которому его можно отправить повторно
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent.append((chat_id, "<photo>"))
+        self.uploaded = getattr(self, "uploaded", 0) + isinstance(photo, bytes)
+        file_id = photo if isinstance(photo, str) else f"photo-{len(self.sent)}"
+        return SimpleNamespace(message_id=len(self.sent), chat_id=chat_id, photo=[SimpleNamespace(file_id=file_id)])
+
+# Фейковый бот с флуд-контролем Telegram: превышение лимита чата, группы или общего лимита
+# отвечает RetryAfter, как настоящий Bot API. Лимиты задаются в сообщениях в секунду.
+class FloodBot(FakeBot):
+    def __init__(self, chat_rate, group_rate, global_rate, burst=3):
+        from rate_limit import TokenBucket
+
+        super().__init__()
+        self.make_bucket = TokenBucket
+        self.chat_rate, self.group_rate, self.burst = chat_rate, group_rate, burst
+        self.global_bucket = TokenBucket(global_rate, capacity=max(1, int(global_rate)))
+        self.buckets = {}
+        self.flood_errors = 0
+        self.max_length = 0
+
+    def _admit(self, bucket):
+        with bucket.lock:
+            bucket._refill(time.monotonic())
+            if bucket.tokens < 1:
+                return (1 - bucket.tokens) / bucket.rate
+            bucket.tokens -= 1
+            return 0.0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        from telegram.error import RetryAfter
+
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if str(chat_id).startswith("-") else self.chat_rate
+            bucket = self.buckets[chat_id] = self.make_bucket(rate, capacity=self.burst)
+        delay = self._admit(bucket) or self._admit(self.global_bucket)
+        if delay:
+            self.flood_errors += 1
+            raise RetryAfter(delay)
+        if len(text.encode("utf-16-le")) // 2 > 4096:
+            raise ValueError("Message is too long")
+        self.max_length = max(self.max_length, len(text))
+        return await super().send_message(chat_id, text, **kwargs)
+
+# Фейковый файл Telegram, скачиваемый с локального диска
+class FakeFile:
+    def __init__(self, path):
+        self.path = path
+        self.file_size = os.path.getsize(path)
+
+    async def download_to_drive(self, custom_path=None):
+        shutil.copyfile(self.path, custom_path)
+        return custom_path
+
+    async def download_to_memory(self, out):
+        with open(self.path, "rb") as f:
+            out.write(f.read())
+
+    async def download_as_bytearray(self, buf=None):
+        with open(self.path, "rb") as f:
+            return bytearray(f.read())
+
+# Фейковое приложение: фоновые задачи create_task и общие bot_data
+class FakeApplication:
+    def __init__(self, bot):
+        self.bot = bot
+        self.bot_data = {}
+        self.tasks = []
+
+    def create_task(self, coroutine, update=None, name=None):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def drain(self):
+        await asyncio.gather(*self.tasks)
+        self.tasks.clear()
+
+# Диалог одного пользователя с ботом: собирает объекты Update/Context для реальных обработчиков
+class FakeChat:
+    def __init__(self, application, chat_id=1, user_id=1):
+        self.application = application
+        self.bot = application.bot
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.context = SimpleNamespace(bot=self.bot, application=application, user_data={}, bot_data=application.bot_data)
+
+    def _update(self, text=None, document=None, callback_data=None):
+        chat = SimpleNamespace(id=self.chat_id, type="private")
+
+        async def reply_text(reply, **kwargs):
+            return await self.bot.send_message(self.chat_id, reply, **kwargs)
+
+        async def answer(*args, **kwargs):
+            return True
+
+        message = SimpleNamespace(chat=chat, chat_id=self.chat_id, text=text, document=document, reply_text=reply_text)
+        query = SimpleNamespace(data=callback_data, message=message, answer=answer) if callback_data else None
+        return SimpleNamespace(
+            message=None if query else message,
+            callback_query=query,
+            effective_chat=chat,
+            effective_user=SimpleNamespace(id=self.user_id),
+        )
+
+    async def send_text(self, handler, text):
+        await handler(self._update(text=text), self.context)
+
+    async def send_file(self, handler, path):
+        document = SimpleNamespace(file_name=os.path.basename(path), file_size=os.path.getsize(path))
+
+        async def get_file():
+            return FakeFile(path)
+
+        document.get_file = get_file
+        await handler(self._update(document=document), self.context)
+
+    async def press(self, handler, data):
+        await handler(self._update(callback_data=data), self.context)
+        await self.application.drain()
+
+# Синтетическая история сверок для заполнения листа
+def make_history_rows(codes, count, seed=0):
+    rng = random.Random(seed)
+    today = time.time()
+    rows = [["Дата", "Код товара", "Наименование", "Факт", "ЕГАИС", "Расхождение"]]
+    for i in range(count):
+        date = time.strftime("%Y-%m-%d", time.localtime(today - 86400 * (1 + i // max(len(codes), 1))))
+        code = codes[i % len(codes)]
+        actual, egais = rng.randrange(30), rng.randrange(30)
+        rows.append([date, code, f"Товар {code}", actual, egais, actual - egais])
+    return rows
+
+# Полная сессия через реальные обработчики bot.py:
+# загрузка файла -> подсчёт -> сверка -> исправление -> отправка в группу -> история
+async def run_session(catalog_size, sheet_rows, latency, stock_rows):
+    import bot
+    import google_sheets
+    from catalog import ProductCatalog
+    from history_store import history_store
+    from metrics import metrics
+    from outbox import outbox
+    from sheets_journal import sheets_journal, run_flusher
+
+    codes = [str(100 + i) for i in range(catalog_size)]
+    catalog = ProductCatalog(os.path.join(BENCH_DIR, f"products_{catalog_size}.json"), save_delay=60)
+    for code in codes:
+        catalog.add(code, f"Товар {code}", 10)
+    bot.PRODUCTS = catalog
+
+    fake_sheet = FakeWorksheet(latency, make_history_rows(codes, sheet_rows))
+    google_sheets._sheet = fake_sheet
+    google_sheets._locators.clear()
+    history_store.resync(fake_sheet.get_all_values())
+    fake_sheet.calls.clear()
+
+    stock_path = make_stock_workbook(
+        os.path.join(BENCH_DIR, f"stock_{catalog_size}_{sheet_rows}.xlsx"), stock_rows, distinct_codes=catalog_size * 2
+    )
+    fake_bot = FakeBot()
+    application = FakeApplication(fake_bot)
+    wakeup = asyncio.Event()
+    application.bot_data['journal_wakeup'] = wakeup
+    flusher = asyncio.create_task(run_flusher(sheets_journal, wakeup))
+    chat = FakeChat(application)
+    timings = {}
+
+    async def phase(name, coroutine):
+        started = time.perf_counter()
+        await coroutine
+        timings[name] = time.perf_counter() - started
+
+    async def count_all():
+        rng = random.Random(1)
+        await chat.press(bot.button_handler, "ready_yes")
+        for _ in codes:
+            await chat.send_text(bot.handle_input, str(rng.randrange(30)))
+
+    async def check_and_flush():
+        # Двойное нажатие «Да»: второе приходит, пока сверка идёт, и должно быть проигнорировано
+        for _ in range(2):
+            await bot.button_handler(chat._update(callback_data="check_yes"), chat.context)
+        await application.drain()
+        while (await asyncio.to_thread(sheets_journal.pending, 1))[0]:
+            await asyncio.sleep(0.01)
+
+    async def edit_one():
+        discrepancy = next(iter(chat.context.user_data['session'].discrepancies), None)
+        if discrepancy is None:
+            return
+        await chat.press(bot.button_handler, "review_yes")
+        await chat.send_text(bot.handle_input, discrepancy.code)
+        await chat.send_text(bot.handle_input, str(discrepancy.egais))
+        await chat.press(bot.button_handler, "edit_no")
+
+    async def history():
+        await chat.send_text(bot.history_command, "/history")
+        await chat.send_text(bot.handle_input, codes[0])
+        for data in ("period_30", "period_30", "period_5"):
+            await chat.press(bot.button_handler, data)
+        await chat.press(bot.button_handler, "history_done")
+
+    async def reupload():
+        await chat.send_file(bot.handle_file, stock_path)
+        await asyncio.wait([chat.context.user_data['session'].stock_task])
+
+    if bot.HISTORY_CHARTS:
+        bot.preload_charts()  # Как в on_startup: matplotlib загружается в фоне после запуска
+    queued_before = sum(v for (family, _), v in metrics.counters.items() if family == "telegram_queued_total")
+    tracemalloc.start()
+    started = time.perf_counter()
+    await phase("загрузка", chat.send_file(bot.handle_file, stock_path))
+    await phase("подсчёт", count_all())
+    # Выгрузка разбирается в фоне с момента загрузки; здесь — остаток ожидания, если подсчёт был быстрее разбора
+    await phase("разбор", asyncio.wait([chat.context.user_data['session'].stock_task]))
+    await phase("сверка", check_and_flush())
+    await phase("исправление", edit_one())
+    await phase("отправка", chat.press(bot.button_handler, "send_yes"))
+    await phase("история", history())
+    # Повторная загрузка того же файла: выгрузка берётся из кэша по SHA-256 без разбора
+    await phase("повторная загрузка", reupload())
+    await outbox.drain()
+    total = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    checks = sum(text.count("Сверка завершена") for _, text in fake_bot.sent)
+    check(checks == 1, f"двойное нажатие «Да» провело сверку {checks} раз")
+
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+    return {
+        "timings": timings,
+        "total": total,
+        "api_calls": dict(fake_sheet.calls),
+        "messages": len(fake_bot.sent),
+        "texts": sum(v for (family, _), v in metrics.counters.items() if family == "telegram_queued_total") - queued_before,
+        "peak_memory": peak,
+    }
+
+# Сквозной бенчмарк для растущих каталога и листа
+def bench_sessions(catalog_sizes, sheet_sizes, latency, stock_rows):
+    from executors import run_parse
+    from stock_parser import parse_stock_file
+
+    print(f"Сквозная сессия (задержка API: {latency * 1000:.0f} мс, выгрузка: {stock_rows} строк)")
+
+    async def run_all():
+        # Прогрев пула процессов разбора, чтобы запуск воркеров не попадал в замеры
+        await run_parse(parse_stock_file, make_stock_workbook(os.path.join(BENCH_DIR, "warmup.xlsx"), 10))
+        for catalog_size in catalog_sizes:
+            for sheet_size in sheet_sizes:
+                result = await run_session(catalog_size, sheet_size, latency, stock_rows)
+                phases = ", ".join(f"{name} {seconds:.2f}" for name, seconds in result["timings"].items())
+                calls = ", ".join(f"{name}={count}" for name, count in sorted(result["api_calls"].items())) or "нет"
+                print(
+                    f"  каталог {catalog_size:>5}, лист {sheet_size:>7} строк: всего {result['total']:.2f} с ({phases}); "
+                    f"API: {calls}; сообщений: {result['messages']} (текстов: {result['texts']}); пик памяти: {result['peak_memory'] / 2 ** 20:.1f} МБ"
+                )
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        stop_executors()
+
+# Нагрузочный тест: много пользователей одновременно проходят сверку через PerChatUpdateProcessor.
+# Проверяется порядок обработки внутри каждого чата, итоговое состояние сессий
+# и то, что все строки журнала дошли до общего листа с учётом ограничения частоты записей.
+async def run_stress(chats, catalog_size, latency, stock_rows, concurrency, writes_per_minute):
+    import bot
+    import google_sheets
+    from catalog import ProductCatalog
+    from concurrency import PerChatUpdateProcessor
+    from history_store import history_store
+    from metrics import metrics
+    from outbox import outbox
+    from rate_limit import TokenBucket
+    from session import FINISHED
+    from sheets_journal import sheets_journal, run_flusher
+
+    codes = [str(100 + i) for i in range(catalog_size)]
+    catalog = ProductCatalog(os.path.join(BENCH_DIR, f"products_stress_{catalog_size}.json"), save_delay=60)
+    for code in codes:
+        catalog.add(code, f"Товар {code}", 10)
+    bot.PRODUCTS = catalog
+    bot.CONCURRENT_UPDATES = concurrency
+
+    fake_sheet = FakeWorksheet(latency)
+    google_sheets._sheet = fake_sheet
+    google_sheets._locators.clear()
+    google_sheets.sheets_write_limiter = TokenBucket(writes_per_minute / 60, capacity=max(1, writes_per_minute // 6))
+    history_store.resync([])
+    throttled_before = sum(v for (family, _), v in metrics.counters.items() if family == "sheets_throttled_total")
+
+    stock_path = make_stock_workbook(os.path.join(BENCH_DIR, "stock_stress.xlsx"), stock_rows, distinct_codes=catalog_size * 2)
+    fake_bot = FakeBot()
+    application = FakeApplication(fake_bot)
+    wakeup = asyncio.Event()
+    application.bot_data['journal_wakeup'] = wakeup
+    flusher = asyncio.create_task(run_flusher(sheets_journal, wakeup))
+    processor = PerChatUpdateProcessor(concurrency)
+    users = [FakeChat(application, chat_id=1000 + i, user_id=1000 + i) for i in range(chats)]
+    processed = {chat.chat_id: [] for chat in users}
+
+    # Обновления отправляются сразу все, как если бы они пришли из одной пачки getUpdates
+    def submit(chat, step, action):
+        async def handle():
+            processed[chat.chat_id].append(step)
+            await action()
+        update = chat._update()
+        return asyncio.create_task(processor.process_update(update, handle()))
+
+    def script(chat):
+        rng = random.Random(chat.chat_id)
+        steps = [lambda: chat.press(bot.button_handler, "ready_yes")]
+        steps += [lambda qty=rng.randrange(30): chat.send_text(bot.handle_input, str(qty)) for _ in codes]
+        steps += [lambda data=data: chat.press(bot.button_handler, data) for data in ("check_yes", "review_no", "send_yes")]
+        return steps
+
+    started = time.perf_counter()
+    await asyncio.gather(*(submit(chat, 0, lambda chat=chat: chat.send_file(bot.handle_file, stock_path)) for chat in users))
+    # Правка каталога посреди сессий не должна сбивать уже начатые подсчёты
+    catalog.add("99999", "Новый товар", 10)
+    tasks = []
+    for chat in users:
+        tasks += [submit(chat, step, action) for step, action in enumerate(script(chat), start=1)]
+    await asyncio.gather(*tasks)
+    handled = time.perf_counter() - started
+    await outbox.drain()
+    while (await asyncio.to_thread(sheets_journal.pending, 1))[0]:
+        await asyncio.sleep(0.01)
+    total = time.perf_counter() - started
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+
+    ordered = all(steps == sorted(steps) for steps in processed.values())
+    counted = {}
+    for chat_id, text in fake_bot.sent:
+        # Подряд идущие тексты одного чата склеиваются в одно сообщение
+        counted[chat_id] = counted.get(chat_id, 0) + text.count("Добавлено:")
+    finished = sum(
+        1 for chat in users
+        if chat.context.user_data['session'].stage == FINISHED and counted.get(chat.chat_id) == catalog_size
+    )
+    throttled = sum(v for (family, _), v in metrics.counters.items() if family == "sheets_throttled_total") - throttled_before
+    return {
+        "handled": handled,
+        "total": total,
+        "ordered": ordered,
+        "finished": finished,
+        "sheet_rows": len(fake_sheet.rows),
+        "api_calls": dict(fake_sheet.calls),
+        "throttled": throttled,
+        "updates": sum(len(steps) for steps in processed.values()),
+    }
+
+# Задержка других чатов, пока один чат занят: долгое обновление (как сверка, которую check_yes ждёт
+# в обработчике) и пачка нажатий в том же чате не должны занимать общий лимит обновлений
+async def run_head_of_line(concurrency, other_chats=20, busy_seconds=1.0):
+    from concurrency import PerChatUpdateProcessor
+
+    processor = PerChatUpdateProcessor(concurrency)
+
+    def update(chat_id):
+        return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=SimpleNamespace(id=chat_id))
+
+    async def work(seconds):
+        await asyncio.sleep(seconds)
+
+    async def timed_update(chat_id):
+        started = time.perf_counter()
+        await processor.process_update(update(chat_id), work(0))
+        return time.perf_counter() - started
+
+    busy = [asyncio.create_task(processor.process_update(update(1), work(busy_seconds)))]
+    busy += [asyncio.create_task(processor.process_update(update(1), work(0))) for _ in range(concurrency * 2)]
+    await asyncio.sleep(0.01)
+    latencies = await asyncio.gather(*(timed_update(2 + i) for i in range(other_chats)))
+    await asyncio.gather(*busy)
+    return max(latencies)
+
+def bench_stress(chat_counts, catalog_size, latency, stock_rows, concurrency, writes_per_minute):
+
+    print(
+        f"Нагрузка (одновременных обновлений: {concurrency}, каталог: {catalog_size}, "
+        f"квота записей: {writes_per_minute}/мин, задержка API: {latency * 1000:.0f} мс)"
+    )
+
+    async def run_all():
+        for chats in chat_counts:
+            result = await run_stress(chats, catalog_size, latency, stock_rows, concurrency, writes_per_minute)
+            calls = ", ".join(f"{name}={count}" for name, count in sorted(result["api_calls"].items())) or "нет"
+            print(
+                f"  {chats:>4} чатов, {result['updates']} обновлений: обработка {result['handled']:.2f} с, "
+                f"с записью в лист {result['total']:.2f} с; порядок {'соблюдён' if result['ordered'] else 'НАРУШЕН'}; "
+                f"завершено сессий {result['finished']}/{chats}; строк в листе {result['sheet_rows']}; "
+                f"API: {calls}; ожиданий квоты: {result['throttled']}"
+            )
+            check(result["ordered"], f"{chats} чатов: нарушен порядок обновлений внутри чата")
+            check(result["finished"] == chats, f"{chats} чатов: завершено сессий {result['finished']}")
+        busy_seconds = 1.0
+        worst = await run_head_of_line(concurrency, busy_seconds=busy_seconds)
+        print(f"  другие чаты, пока один чат занят {busy_seconds:.0f} с и шлёт {concurrency * 2} нажатий: задержка до {worst * 1000:.0f} мс")
+        check(worst < busy_seconds / 2, f"занятый чат задерживает другие чаты на {worst:.2f} с")
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        stop_executors()
+
+# Рост листа: запись дневной сверки и синхронизация истории за 30 дней
+# при всей истории в sheet1 и при разбиении по месяцам (после migrate_sheets)
+def bench_partitions(month_counts, catalog_size, latency):
+    import google_sheets
+    from migrate_sheets import migrate
+
+    print(f"Разбиение по месяцам (каталог: {catalog_size}, задержка API: {latency * 1000:.0f} мс)")
+    codes = [str(100 + i) for i in range(catalog_size)]
+    today = time.strftime("%Y-%m-%d")
+    start = time.strftime("%Y-%m-%d", time.localtime(time.time() - 30 * 86400))
+    daily = [build_row(today, code, f"Товар {code}", 5, 7) for code in codes]
+    for months in month_counts:
+        history = make_history_rows(codes, catalog_size * months * 30)
+        for mode in ("none", "month"):
+            spreadsheet = FakeSpreadsheet(latency, history)
+            google_sheets._spreadsheet, google_sheets._sheet = spreadsheet, None
+            google_sheets.SHEETS_PARTITION = mode
+            google_sheets.month_tabs.invalidate()
+            google_sheets._locators.clear()
+            if mode == "month":
+                migrate()
+            google_sheets._locators.clear()
+            google_sheets.sheets_write_limiter.tokens = google_sheets.sheets_write_limiter.capacity  # Перенос не тратит квоту замера
+            spreadsheet.reset_counters()
+
+            started = time.perf_counter()
+            google_sheets.upsert_by_date(daily)
+            write_time = time.perf_counter() - started
+            write_cells = spreadsheet.cells_read
+            spreadsheet.reset_counters()
+
+            started = time.perf_counter()
+            google_sheets.resync_history(start, today)
+            sync_time = time.perf_counter() - started
+            print(
+                f"  {months:>3} мес. ({len(history) - 1:>7} строк), {'sheet1' if mode == 'none' else 'по месяцам':>10}: "
+                f"запись дня {write_time:.3f} с / прочитано {write_cells} ячеек; "
+                f"история 30 дней {sync_time:.3f} с / прочитано {spreadsheet.cells_read} ячеек"
+            )
+    google_sheets.SHEETS_PARTITION = "none"
+
+# Устойчивость к 429: запись дневных сверок и синхронизация истории через лист,
+# отклоняющий часть запросов; итоговый лист должен совпасть с листом без сбоев
+def bench_faults(fault_rates, catalog_size, days, latency):
+    import google_sheets
+    from metrics import metrics
+
+    def counter(family):
+        return sum(v for (f, _), v in metrics.counters.items() if f == family)
+
+    def backoffs():
+        return {
+            key: list(histogram.samples) for key, histogram in metrics.histograms.items()
+            if key[0] == "sheets_backoff_seconds"
+        }
+
+    saved = google_sheets.SHEETS_BACKOFF_BASE, google_sheets.SHEETS_BACKOFF_MAX, google_sheets.SHEETS_MAX_RETRIES
+    google_sheets.SHEETS_BACKOFF_BASE, google_sheets.SHEETS_BACKOFF_MAX, google_sheets.SHEETS_MAX_RETRIES = 0.005, 0.05, 8
+    print(f"Ответы 429 (каталог: {catalog_size}, дней: {days}, задержка API: {latency * 1000:.0f} мс)")
+    codes = [str(100 + i) for i in range(catalog_size)]
+    start = datetime.date(2025, 1, 1)
+    days_rows = [
+        [build_row(str(start + datetime.timedelta(days=day)), code, f"Товар {code}", (day + i) % 30, 10) for i, code in enumerate(codes)]
+        for day in range(days)
+    ]
+    try:
+        for fault_rate, retry_after in [(0.0, None)] + [(rate, None) for rate in fault_rates] + [(fault_rates[-1], 0.02)]:
+            sheet = FlakyWorksheet(latency, fault_rate=fault_rate, retry_after=retry_after)
+            google_sheets._sheet = sheet
+            google_sheets.SHEETS_PARTITION = "none"
+            google_sheets._locators.clear()
+            retries_before, errors_before, backoffs_before = counter("sheets_retries_total"), counter("sheets_errors_total"), backoffs()
+            started = time.perf_counter()
+            for rows in days_rows:
+                google_sheets.upsert_by_date(rows)
+                # Повторная отправка того же дня (как после сбоя журнала) не должна дублировать строки
+                google_sheets.upsert_by_date(rows[: catalog_size // 2])
+            synced = google_sheets.resync_history()
+            elapsed = time.perf_counter() - started
+            expected = [row for rows in days_rows for row in rows]
+            waits = [
+                wait for key, samples in backoffs().items()
+                for wait in samples[len(backoffs_before.get(key, [])):]
+            ]
+            honoured = retry_after is None or all(wait >= retry_after for wait in waits)
+            print(
+                f"  отказов {fault_rate:>4.0%}{'' if retry_after is None else f', Retry-After {retry_after * 1000:.0f} мс'}: "
+                f"{elapsed:.2f} с, ответов 429: {sheet.faults}, повторов: {counter('sheets_retries_total') - retries_before}, "
+                f"ошибок наружу: {counter('sheets_errors_total') - errors_before - sheet.faults}, "
+                f"пауз {sum(waits):.2f} с; лист {len(sheet.rows)} строк, история: {synced}"
+            )
+            keys = [tuple(row[:2]) for row in sheet.rows]
+            expected_keys = [tuple(row[:2]) for row in expected]
+            check(len(set(keys)) == len(keys), f"отказов {fault_rate:.0%}: строки дублируются ({len(keys) - len(set(keys))})")
+            check(set(keys) >= set(expected_keys), f"отказов {fault_rate:.0%}: потеряно строк {len(set(expected_keys) - set(keys))}")
+            check(sheet.rows == expected, f"отказов {fault_rate:.0%}: лист не совпадает с листом без сбоев (порядок или значения строк)")
+            check(synced == len(expected), f"отказов {fault_rate:.0%}: в истории {synced} строк вместо {len(expected)}")
+            check(honoured, f"отказов {fault_rate:.0%}: пауза меньше Retry-After {retry_after} с")
+    finally:
+        google_sheets.SHEETS_BACKOFF_BASE, google_sheets.SHEETS_BACKOFF_MAX, google_sheets.SHEETS_MAX_RETRIES = saved
+
+# Исходящие сообщения под флуд-контролем: пользователи получают серии коротких ответов,
+# а сводки в группу идут одновременно от всех сессий. Прямая отправка сравнивается с очередью
+# outbox. Время масштабировано: лимиты Telegram умножены на scale.
+def bench_outbox(chat_counts, catalog_size, scale):
+    import outbox as outbox_module
+    from outbox import Outbox, MESSAGE_LIMIT
+
+    chat_rate, group_rate, global_rate = 1 * scale, 20 / 60 * scale, 30 * scale
+    saved = outbox_module.TELEGRAM_CHAT_PER_SECOND, outbox_module.TELEGRAM_GROUP_PER_MINUTE, outbox_module.TELEGRAM_GLOBAL_PER_SECOND
+    outbox_module.TELEGRAM_CHAT_PER_SECOND = chat_rate
+    outbox_module.TELEGRAM_GROUP_PER_MINUTE = group_rate * 60
+    outbox_module.TELEGRAM_GLOBAL_PER_SECOND = global_rate * 0.8
+    print(f"Исходящие сообщения (каталог: {catalog_size}, лимиты Telegram x{scale:g})")
+    group_id = "-100"
+    summary = "📋 Сводка остатков:\n" + "\n".join(f"Товар {100 + i}: {i % 30}{' ⚠️' if i % 30 < 10 else ''}" for i in range(catalog_size))
+    try:
+        for chats in chat_counts:
+            for mode in ("напрямую", "outbox"):
+                bot = FloodBot(chat_rate, group_rate, global_rate)
+                box = Outbox()
+                failed = 0
+
+                async def send(chat_id, text):
+                    nonlocal failed
+                    if mode == "outbox":
+                        box.send(bot, chat_id, text)
+                        return
+                    try:
+                        await bot.send_message(chat_id, text)
+                    except Exception:
+                        failed += 1
+
+                # Ответы на ввод остатков: «Добавлено» и следующий запрос на каждый товар
+                async def user_flow(chat_id):
+                    for i in range(catalog_size // 10):
+                        await send(chat_id, f"Добавлено: Товар {100 + i} = {i}")
+                        await send(chat_id, f"Введите остаток для Товар {101 + i}:")
+                        await asyncio.sleep(0.2 / scale)
+                    await send(group_id, summary)
+
+                async def run():
+                    started = time.perf_counter()
+                    await asyncio.gather(*(user_flow(1000 + i) for i in range(chats)))
+                    handled = time.perf_counter() - started
+                    await box.drain()
+                    return handled, time.perf_counter() - started
+
+                handled, total = asyncio.run(run())
+                group_text = "\n".join(text for chat_id, text in bot.sent if chat_id == group_id)
+                delivered = group_text.count("📋 Сводка остатков:")
+                print(
+                    f"  {chats:>4} чатов, {mode:>8}: обработчики {handled:.2f} с, доставка {total:.2f} с; "
+                    f"сообщений {len(bot.sent)}, RetryAfter: {bot.flood_errors}, потеряно: {failed}; "
+                    f"сводок в группе {delivered}/{chats}; самое длинное {bot.max_length}/{MESSAGE_LIMIT}"
+                )
+    finally:
+        outbox_module.TELEGRAM_CHAT_PER_SECOND, outbox_module.TELEGRAM_GROUP_PER_MINUTE, outbox_module.TELEGRAM_GLOBAL_PER_SECOND = saved
+
+# Синтетическая история сверок для прогноза: сверка каждые interval дней за days дней,
+# остаток убывает со своим расходом у каждого товара и пополняется поставкой ниже 10
+def make_forecast_history(codes, days, interval=2, seed=0):
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    records = []
+    for code in codes:
+        rate, stock = rng.uniform(0.2, 6), rng.randrange(20, 200)
+        for day in range(days, 0, -interval):
+            date = (today - datetime.timedelta(days=day)).isoformat()
+            records.append([date, code, f"Товар {code}", stock, stock, 0])
+            stock = max(0, round(stock - rate * interval * rng.uniform(0.5, 1.5)))
+            if stock < 10:
+                stock += rng.randrange(50, 200)
+    return records
+
+# Эталонный прогноз для проверки результата: запрос истории каждого товара и расчёт циклом Python
+def forecast_per_product(products, store, today, history_days, window_days, interval):
+    start_date = (datetime.date.fromisoformat(today) - datetime.timedelta(days=history_days)).isoformat()
+    window_start = (datetime.date.fromisoformat(today) - datetime.timedelta(days=window_days)).isoformat()
+    at_risk = set()
+    for product in products:
+        rows = store.query(product.code, start_date, today)
+        consumed = elapsed = 0
+        for (prev_date, prev_actual, _), (date, actual, _) in zip(rows, rows[1:]):
+            gap = (datetime.date.fromisoformat(date) - datetime.date.fromisoformat(prev_date)).days
+            if date > window_start and gap > 0 and prev_actual >= actual:
+                consumed += prev_actual - actual
+                elapsed += gap
+        if not rows or not elapsed or not consumed:
+            continue
+        rate = consumed / elapsed
+        stock = max(rows[-1][1] - rate * (datetime.date.fromisoformat(today) - datetime.date.fromisoformat(rows[-1][0])).days, 0)
+        if stock >= product.threshold and (stock - product.threshold) / rate < interval:
+            at_risk.add(product.code)
+    return at_risk
+
+# Прогноз расхода по истории: время build_forecast и проверка товаров под угрозой по эталонному расчёту.
+# Время не должно расти с глубиной истории (выборка по покрывающему индексу дат).
+def bench_forecast(product_counts, years_list):
+    from catalog import Product
+    from history_store import HistoryStore
+    from forecast import build_forecast, compute_forecast, FORECAST_HISTORY_DAYS, FORECAST_WINDOW_DAYS
+
+    print("Прогноз расхода (сверка раз в 2 дня)")
+    compute_forecast([], (), (), ())  # Импорт numpy не входит в замер
+    today = datetime.date.today().isoformat()
+    for count in product_counts:
+        for years in years_list:
+            with tempfile.TemporaryDirectory() as tmp:
+                store = HistoryStore(os.path.join(tmp, "history.db"))
+                products = [Product(str(1000 + i), f"Товар {i}", 30) for i in range(count)]
+                store.record_rows(make_forecast_history([p.code for p in products], int(365 * years)))
+                elapsed = float("inf")
+                for _ in range(3):
+                    started = time.perf_counter()
+                    forecast = build_forecast(products, today=today, store=store)
+                    elapsed = min(elapsed, time.perf_counter() - started)
+                expected = forecast_per_product(
+                    products, store, today, FORECAST_HISTORY_DAYS, FORECAST_WINDOW_DAYS, forecast.count_interval
+                )
+                found = {item.code for item in forecast.at_risk()}
+                rows = store.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+                store.conn.close()
+            print(f"  {count:>5} товаров, {years:g} г. ({rows:>7} записей): прогноз {elapsed * 1000:.1f} мс; под угрозой {len(found)}")
+            check(found == expected, f"прогноз для {count} товаров расходится с эталонным расчётом: {sorted(found ^ expected)}")
+
+# История по кнопкам периода у нескольких пользователей: текстом и графиками с кэшем.
+# После всех нажатий записывается новая сверка товара — его графики должны построиться заново.
+def bench_history_charts(chat_counts, clicks):
+    import bot
+    from catalog import ProductCatalog
+    from history_store import history_store
+    from history_chart import chart_cache, charts_available
+    from metrics import metrics
+    from outbox import outbox
+
+    if not charts_available():
+        print("Графики истории: matplotlib не установлен")
+        return
+    codes = [str(100 + i) for i in range(5)]
+    catalog = ProductCatalog(os.path.join(BENCH_DIR, "products_charts.json"), save_delay=60)
+    for code in codes:
+        catalog.add(code, f"Товар {code}", 10)
+    bot.PRODUCTS = catalog
+    history_store.resync(make_history_rows(codes, len(codes) * 30))
+    periods = ("period_30", "period_5", "period_10", "period_20")
+
+    def counter(family, name):
+        return metrics.counters.get((family, name), 0)
+
+    def renders():
+        histogram = metrics.histograms.get(("history_chart_seconds", "render"))
+        return histogram.count if histogram else 0
+
+    def render_seconds():
+        histogram = metrics.histograms.get(("history_chart_seconds", "render"))
+        return histogram.sum if histogram else 0
+
+    async def browse(chat, index):
+        await chat.send_text(bot.history_command, "/history")
+        await chat.send_text(bot.handle_input, codes[index % 2])
+        for click in range(clicks):
+            await chat.press(bot.button_handler, periods[(index + click) % len(periods)])
+
+    async def run(chats):
+        fake_bot = FakeBot()
+        application = FakeApplication(fake_bot)
+        chat_list = [FakeChat(application, chat_id=1000 + i, user_id=1000 + i) for i in range(chats)]
+        started = time.perf_counter()
+        await asyncio.gather(*(browse(chat, i) for i, chat in enumerate(chat_list)))
+        await outbox.drain()
+        return time.perf_counter() - started, fake_bot
+
+    print(f"Графики истории ({clicks} нажатий периода на пользователя, 2 товара)")
+    saved = bot.HISTORY_CHARTS
+    try:
+        for chats in chat_counts:
+            bot.HISTORY_CHARTS = False
+            text_elapsed, text_bot = asyncio.run(run(chats))
+
+            bot.HISTORY_CHARTS = True
+            chart_cache.invalidate(None)
+            renders_before, hits_before, seconds_before = renders(), counter("history_chart_cache_total", "hit"), render_seconds()
+            chart_elapsed, chart_bot = asyncio.run(run(chats))
+            built = renders() - renders_before
+            render_ms = (render_seconds() - seconds_before) / max(built, 1) * 1000
+            hits = counter("history_chart_cache_total", "hit") - hits_before
+
+            # Новая сверка товара: его графики удаляются из кэша и строятся заново
+            cached = len(chart_cache)
+            history_store.record_rows([build_row(datetime.date.today().isoformat(), codes[0], "Товар", 7, 9)])
+            invalidated = cached - len(chart_cache)
+            renders_before = renders()
+            asyncio.run(run(1))
+            rebuilt = renders() - renders_before
+            print(
+                f"  {chats:>4} польз.: текстом {text_elapsed:.2f} с, сообщений {len(text_bot.sent)}; "
+                f"графиком {chart_elapsed:.2f} с, сообщений {len(chart_bot.sent)}, построено {built} (по {render_ms:.0f} мс), из кэша {hits}, "
+                f"загружено PNG {getattr(chart_bot, 'uploaded', 0)}; после записи удалено {invalidated}, построено заново {rebuilt}"
+            )
+    finally:
+        bot.HISTORY_CHARTS = saved
+
+SUITES = ("writes", "parse", "engines", "memory", "e2e", "stress", "partitions", "faults", "outbox", "forecast", "charts")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота сверки остатков")
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--latency", type=float, default=0.001, help="Задержка одного запроса к фейковому API, с")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--stock-sizes", type=int, nargs="+", default=[10_000, 100_000], help="Размеры выгрузок, строк (например, 10000 100000 1000000)")
+    parser.add_argument("--distinct-codes", type=int, default=500, help="Различных кодов в выгрузке для замера памяти")
+    parser.add_argument("--catalog-sizes", type=int, nargs="+", default=[20, 200], help="Размеры каталога для сквозной сессии")
+    parser.add_argument("--sheet-sizes", type=int, nargs="+", default=[1_000, 20_000], help="Число строк истории в листе для сквозной сессии")
+    parser.add_argument("--session-stock-rows", type=int, default=5_000, help="Строк в выгрузке для сквозной сессии")
+    parser.add_argument("--partition-months", type=int, nargs="+", default=[3, 12], help="Месяцев истории для сравнения разбиения листа")
+    parser.add_argument("--fault-rates", type=float, nargs="+", default=[0.1, 0.3], help="Доля запросов, на которые фейковый API отвечает 429")
+    parser.add_argument("--outbox-catalog-size", type=int, default=500, help="Размер каталога для сводки в группу (сводка длиннее 4096 символов)")
+    parser.add_argument("--outbox-scale", type=float, default=20, help="Во сколько раз ускорить лимиты Telegram в наборе outbox")
+    parser.add_argument("--forecast-products", type=int, nargs="+", default=[100, 500], help="Размеры каталога для прогноза расхода")
+    parser.add_argument("--forecast-years", type=float, nargs="+", default=[1, 5], help="Глубина истории для прогноза расхода, лет")
+    parser.add_argument("--chart-chats", type=int, nargs="+", default=[1, 20], help="Число пользователей, листающих историю")
+    parser.add_argument("--chart-clicks", type=int, default=8, help="Нажатий кнопок периода на пользователя")
+    parser.add_argument("--stress-chats", type=int, nargs="+", default=[10, 50], help="Число одновременных пользователей для нагрузочного теста")
+    parser.add_argument("--stress-catalog-size", type=int, default=20, help="Размер каталога для нагрузочного теста")
+    parser.add_argument("--concurrency", type=int, default=16, help="Число одновременно обрабатываемых обновлений")
+    parser.add_argument("--writes-per-minute", type=int, default=600, help="Квота записей в Google Sheets для нагрузочного теста")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    try:
+        if "writes" in args.suites:
+            bench_sheet_writes(args.sizes, args.latency)
+        if "parse" in args.suites:
+            bench_stock_aggregation(args.stock_sizes)
+        if "engines" in args.suites:
+            bench_ingest_engines(args.stock_sizes)
+        if "memory" in args.suites:
+            bench_parse_memory(args.stock_sizes, args.distinct_codes)
+        if "e2e" in args.suites:
+            bench_sessions(args.catalog_sizes, args.sheet_sizes, args.latency, args.session_stock_rows)
+        if "partitions" in args.suites:
+            bench_partitions(args.partition_months, args.stress_catalog_size, args.latency)
+        if "faults" in args.suites:
+            bench_faults(args.fault_rates, args.stress_catalog_size, 30, args.latency)
+        if "outbox" in args.suites:
+            bench_outbox(args.stress_chats, args.outbox_catalog_size, args.outbox_scale)
+        if "forecast" in args.suites:
+            bench_forecast(args.forecast_products, args.forecast_years)
+        if "charts" in args.suites:
+            bench_history_charts(args.chart_chats, args.chart_clicks)
+        if "stress" in args.suites:
+            bench_stress(args.stress_chats, args.stress_catalog_size, args.latency, args.session_stock_rows, args.concurrency, args.writes_per_minute)
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,35 @@
+import time
+
+STARTED_AT = time.perf_counter()  # Момент запуска процесса для замера времени старта
+
+import io
 import os
+import sys
+import asyncio
+import tempfile
+import contextlib
+import functools
 import datetime
 import logging
-import json
-import pandas as pd
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from dotenv import load_dotenv
-from google_sheets import setup_google_sheets, add_to_sheet
+from google_sheets import build_row, resync_history
+from sheets_journal import sheets_journal, run_flusher
+from outbox import outbox
+from executors import run_sheets, run_local, run_parse, shutdown_executors
+from history_store import history_store
+from forecast import build_forecast, FORECAST_HISTORY_DAYS
+from history_chart import HistoryChart, chart_cache, chart_key, render_history_chart, preload_charts, charts_available, HISTORY_OUTPUT
+from stock_parser import parse_stock_file, scope_stock, OutsideStock
+from ingest import STOCK_EXTENSIONS
+from stock_cache import stock_cache, stock_digest
+from catalog import ProductCatalog
+from discrepancies import DiscrepancyTable
+from bulk_input import parse_counts_text, parse_counts_file, is_stock_export
+from concurrency import PerChatUpdateProcessor
+from session import get_session, sweep_sessions, memory_report, ACTIVE, EXPIRED, SESSION_SWEEP_INTERVAL
+from metrics import metrics, timed, log_digest, start_metrics_server, METRICS_PORT, METRICS_LOG_INTERVAL
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,41 +43,28 @@ load_dotenv()
 NOTIFY_CHAT_ID = "-1002130385571"  # ID группы для уведомлений
 ADMIN_ID = int(os.getenv("ADMIN_ID"))  # ID администратора из .env
 PRODUCTS_FILE = "products.json"  # Файл для хранения списка продуктов
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # Режим получения обновлений: polling или webhook
+BULK_STATES = ('ready_check', 'input')  # Состояния, в которых принимается массовый ввод остатков
+MAX_COUNTS_FILE_SIZE = 1024 * 1024  # Максимальный размер файла с фактическими остатками, байт
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(20 * 1024 * 1024)))  # Максимальный размер выгрузки (лимит Bot API — 20 МБ), байт
+UPLOAD_MEMORY_LIMIT = int(os.getenv("UPLOAD_MEMORY_LIMIT", str(8 * 1024 * 1024)))  # Выгрузки больше — во временный файл, байт
+MEASURE_STARTUP = "--startup-time" in sys.argv or os.getenv("MEASURE_STARTUP") == "1"  # Режим замера времени старта
+RECONCILE_SCOPE = os.getenv("RECONCILE_SCOPE", "catalog")  # Область сверки: catalog — только товары каталога, file — все коды выгрузки
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))  # Число одновременно обрабатываемых обновлений; 0 или 1 — по одному (сверка идёт фоновой задачей)
+UPLOAD_FORMATS_HINT = "Пожалуйста, отправьте выгрузку остатков в формате .xlsx, .xls, .ods или .csv."
+OUTBOX_DRAIN_TIMEOUT = 10  # Сколько ждать отправки исходящих сообщений при остановке, с
 
-sheet = setup_google_sheets()
-
-# Функция для загрузки продуктов из файла
-def load_products():
-    try:
-        if os.path.exists(PRODUCTS_FILE):
-            with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
-                products = json.load(f)
-                # Добавляем threshold, если его нет
-                for product in products:
-                    if "threshold" not in product:
-                        product["threshold"] = 10  # Значение по умолчанию
-                logger.info(f"Продукты загружены из {PRODUCTS_FILE}")
-                return products
-        else:
-            logger.info(f"Файл {PRODUCTS_FILE} не найден, создаётся пустой список")
-            save_products([])
-            return []
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке продуктов: {e}")
-        save_products([])
-        return []
-
-# Функция для сохранения продуктов в файл
-def save_products(products):
-    try:
-        with open(PRODUCTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(products, f, ensure_ascii=False, indent=4)
-        logger.info(f"Продукты сохранены в {PRODUCTS_FILE}")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении продуктов: {e}")
+# Загружаем каталог продуктов при запуске
+PRODUCTS = ProductCatalog(PRODUCTS_FILE).load()
+PARSES_IN_FLIGHT = {}  # SHA-256 выгрузки -> задача её разбора
+CHARTS_IN_FLIGHT = {}  # Ключ графика истории -> задача его построения
+HISTORY_CHARTS = HISTORY_OUTPUT == 'chart' and charts_available()  # История графиком (нужен matplotlib) или текстом
 
-# Загружаем продукты при запуске
-PRODUCTS = load_products()
+# Товары текущей сессии подсчёта: снимок каталога на момент её начала
+def session_products(session):
+    if session.products is None:
+        session.products = PRODUCTS.snapshot()
+    return session.products
 
 # Проверка, является ли пользователь администратором
 def is_admin(update: Update):
@@ -67,7 +77,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Запуск админ-панели для user_id={update.effective_user.id}")
         if not is_admin(update):
             logger.info("Пользователь не админ")
-            await context.bot.send_message(update.effective_chat.id, "Эта функция доступна только администратору.")
+            outbox.send(context.bot, update.effective_chat.id, "Эта функция доступна только администратору.")
             return
         
         logger.info("Создание клавиатуры")
@@ -76,10 +86,11 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("Удалить товар", callback_data='admin_remove')],
             [InlineKeyboardButton("Список товаров", callback_data='admin_list')],
             [InlineKeyboardButton("Изменить порог", callback_data='admin_edit_threshold')],
+            [InlineKeyboardButton("Статистика", callback_data='admin_stats')],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         logger.info(f"Отправка сообщения в чат {update.effective_chat.id}")
-        await context.bot.send_message(update.effective_chat.id, "Панель администратора:", reply_markup=reply_markup)
+        outbox.send(context.bot, update.effective_chat.id, "Панель администратора:", reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Ошибка в admin_panel: {e}", exc_info=True)
         raise
@@ -92,9 +103,10 @@ async def show_admin_panel(chat_id, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("Удалить товар", callback_data='admin_remove')],
             [InlineKeyboardButton("Список товаров", callback_data='admin_list')],
             [InlineKeyboardButton("Изменить порог", callback_data='admin_edit_threshold')],
+            [InlineKeyboardButton("Статистика", callback_data='admin_stats')],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(chat_id, "Панель администратора:", reply_markup=reply_markup)
+        outbox.send(context.bot, chat_id, "Панель администратора:", reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Ошибка в show_admin_panel: {e}")
 
@@ -104,7 +116,7 @@ async def handle_edit_threshold(update: Update, context: ContextTypes.DEFAULT_TY
         query = update.callback_query
         await query.answer()
         context.user_data['admin_state'] = 'edit_threshold_code'
-        await query.message.reply_text("Введите код товара, для которого хотите изменить порог (например, 999):")
+        outbox.send(context.bot, query.message.chat_id, "Введите код товара, для которого хотите изменить порог (например, 999):")
     except Exception as e:
         logger.error(f"Ошибка в handle_edit_threshold: {e}")
 
@@ -114,7 +126,7 @@ async def handle_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
         query = update.callback_query
         await query.answer()
         context.user_data['admin_state'] = 'add_code'
-        await query.message.reply_text("Введите код нового товара (например, 999):")
+        outbox.send(context.bot, query.message.chat_id, "Введите код нового товара (например, 999):")
     except Exception as e:
         logger.error(f"Ошибка в handle_add_product: {e}")
 
@@ -124,7 +136,7 @@ async def handle_remove_product(update: Update, context: ContextTypes.DEFAULT_TY
         query = update.callback_query
         await query.answer()
         context.user_data['admin_state'] = 'remove_code'
-        await query.message.reply_text("Введите код товара для удаления (например, 109):")
+        outbox.send(context.bot, query.message.chat_id, "Введите код товара для удаления (например, 109):")
     except Exception as e:
         logger.error(f"Ошибка в handle_remove_product: {e}")
 
@@ -132,14 +144,35 @@ async def handle_remove_product(update: Update, context: ContextTypes.DEFAULT_TY
 async def list_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         if not PRODUCTS:
-            await context.bot.send_message(update.effective_chat.id, "Список товаров пуст.")
+            outbox.send(context.bot, update.effective_chat.id, "Список товаров пуст.")
             return
         
-        products_text = "Текущий список товаров:\n" + "\n".join([f"{p['short_name']} ({p['code']}), Порог: {p['threshold']}" for p in PRODUCTS])
-        await context.bot.send_message(update.effective_chat.id, products_text)
+        products_text = "Текущий список товаров:\n" + "\n".join([f"{p.short_name} ({p.code}), Порог: {p.threshold}" for p in PRODUCTS])
+        outbox.send(context.bot, update.effective_chat.id, products_text)
     except Exception as e:
         logger.error(f"Ошибка в list_products: {e}")
 
+# Команда статистики: задержки обработчиков и вызовов Google Sheets (p50/p95)
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not is_admin(update):
+            outbox.send(context.bot, update.effective_chat.id, "Эта функция доступна только администратору.")
+            return
+        outbox.send(context.bot, update.effective_chat.id, "📊 Статистика:\n" + metrics.render_summary())
+    except Exception as e:
+        logger.error(f"Ошибка в stats_command: {e}")
+
+# Команда отчёта о памяти: RSS процесса и объём данных сессий пользователей
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not is_admin(update):
+            outbox.send(context.bot, update.effective_chat.id, "Эта функция доступна только администратору.")
+            return
+        report = memory_report(context.application.user_data.values())
+        outbox.send(context.bot, update.effective_chat.id, "🧠 Память:\n" + report)
+    except Exception as e:
+        logger.error(f"Ошибка в memory_command: {e}")
+
 # Обработка ввода администратора
 async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update) or 'admin_state' not in context.user_data:
@@ -153,12 +186,12 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if state == 'add_code':
             context.user_data['new_product_code'] = text
             context.user_data['admin_state'] = 'add_name'
-            await update.message.reply_text("Введите название товара (например, Апельсин):")
+            outbox.send(context.bot, update.effective_chat.id, "Введите название товара (например, Апельсин):")
         
         elif state == 'add_name':
             context.user_data['new_product_name'] = text
             context.user_data['admin_state'] = 'add_threshold'
-            await update.message.reply_text("Введите минимальный порог остатка для товара (например, 10):")
+            outbox.send(context.bot, update.effective_chat.id, "Введите минимальный порог остатка для товара (например, 10):")
         
         elif state == 'add_threshold':
             code = context.user_data['new_product_code']
@@ -168,15 +201,13 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 if threshold < 0:
                     raise ValueError("Порог не может быть отрицательным")
             except ValueError:
-                await update.message.reply_text("Пожалуйста, введите корректное число для порога (например, 10):")
+                outbox.send(context.bot, update.effective_chat.id, "Пожалуйста, введите корректное число для порога (например, 10):")
                 return
             
-            if any(p["code"] == code for p in PRODUCTS):
-                await update.message.reply_text(f"Товар с кодом {code} уже существует.")
+            if not PRODUCTS.add(code, short_name, threshold):
+                outbox.send(context.bot, update.effective_chat.id, f"Товар с кодом {code} уже существует.")
             else:
-                PRODUCTS.append({"code": code, "short_name": short_name, "threshold": threshold})
-                save_products(PRODUCTS)
-                await update.message.reply_text(f"Товар добавлен: {short_name} ({code}), Порог: {threshold}")
+                outbox.send(context.bot, update.effective_chat.id, f"Товар добавлен: {short_name} ({code}), Порог: {threshold}")
                 logger.info(f"Добавлен товар: {code} - {short_name}, Порог: {threshold}")
             context.user_data.pop('admin_state', None)
             context.user_data.pop('new_product_code', None)
@@ -185,28 +216,25 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         elif state == 'remove_code':
             code = text
-            initial_len = len(PRODUCTS)
-            PRODUCTS[:] = [p for p in PRODUCTS if p["code"] != code]
-            if len(PRODUCTS) < initial_len:
-                save_products(PRODUCTS)
-                await update.message.reply_text(f"Товар с кодом {code} удалён.")
+            if PRODUCTS.remove(code):
+                outbox.send(context.bot, update.effective_chat.id, f"Товар с кодом {code} удалён.")
                 logger.info(f"Удалён товар с кодом: {code}")
             else:
-                await update.message.reply_text(f"Товар с кодом {code} не найден.")
+                outbox.send(context.bot, update.effective_chat.id, f"Товар с кодом {code} не найден.")
             context.user_data.pop('admin_state', None)
             await show_admin_panel(chat_id, context)
         
         elif state == 'edit_threshold_code':
             code = text
-            product = next((p for p in PRODUCTS if p["code"] == code), None)
+            product = PRODUCTS.get(code)
             if not product:
-                await update.message.reply_text(f"Товар с кодом {code} не найден.")
+                outbox.send(context.bot, update.effective_chat.id, f"Товар с кодом {code} не найден.")
                 context.user_data.pop('admin_state', None)
                 await show_admin_panel(chat_id, context)
                 return
             context.user_data['edit_product_code'] = code
             context.user_data['admin_state'] = 'edit_threshold_value'
-            await update.message.reply_text(f"Введите новый порог для товара {product['short_name']} ({code}) (текущий порог: {product['threshold']}):")
+            outbox.send(context.bot, update.effective_chat.id, f"Введите новый порог для товара {product.short_name} ({code}) (текущий порог: {product.threshold}):")
         
         elif state == 'edit_threshold_value':
             code = context.user_data['edit_product_code']
@@ -215,84 +243,125 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 if threshold < 0:
                     raise ValueError("Порог не может быть отрицательным")
             except ValueError:
-                await update.message.reply_text("Пожалуйста, введите корректное число для порога (например, 10):")
+                outbox.send(context.bot, update.effective_chat.id, "Пожалуйста, введите корректное число для порога (например, 10):")
                 return
             
-            product = next((p for p in PRODUCTS if p["code"] == code), None)
+            product = PRODUCTS.set_threshold(code, threshold)
             if product:
-                product['threshold'] = threshold
-                save_products(PRODUCTS)
-                await update.message.reply_text(f"Порог для товара {product['short_name']} ({code}) обновлён: {threshold}")
+                outbox.send(context.bot, update.effective_chat.id, f"Порог для товара {product.short_name} ({code}) обновлён: {threshold}")
                 logger.info(f"Обновлён порог для товара: {code}, Новый порог: {threshold}")
             context.user_data.pop('admin_state', None)
             context.user_data.pop('edit_product_code', None)
             await show_admin_panel(chat_id, context)
     
     except Exception as e:
-        await update.message.reply_text(f"Ошибка: {e}")
+        outbox.send(context.bot, update.effective_chat.id, f"Ошибка: {e}")
         logger.error(f"Ошибка при обработке ввода администратора: {e}")
         context.user_data.pop('admin_state', None)
         await show_admin_panel(chat_id, context)
 
-def process_stock_file(context: ContextTypes.DEFAULT_TYPE = None):
+# Скачивание выгрузки: в память, а очень большие файлы — в уникальный временный файл.
+# Возвращает (источник для разбора, путь временного файла или None).
+async def download_upload(document):
+    file = await document.get_file()
+    if (document.file_size or 0) <= UPLOAD_MEMORY_LIMIT:
+        buffer = io.BytesIO()
+        await file.download_to_memory(buffer)
+        return buffer.getvalue(), None
+    fd, path = tempfile.mkstemp(prefix="stock-", suffix=os.path.splitext(document.file_name)[1])
+    os.close(fd)
     try:
-        # Если файл был загружен через Telegram, используем его
-        if context and 'stock_file_path' in context.user_data:
-            latest_file = context.user_data['stock_file_path']
-            logger.info(f"Используется загруженный файл: {latest_file}")
-        else:
-            raise FileNotFoundError("Файл остатков (.xlsx) не найден. Пожалуйста, загрузите файл через Telegram.")
+        await file.download_to_drive(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, path
+
+# Разбор выгрузки выполняется в пуле процессов, чтобы не блокировать других пользователей
+async def parse_stock(source, file_name=None):
+    with metrics.timer("excel_parse_seconds", "read_excel"):
+        return await run_parse(parse_stock_file, source, file_name)
+
+# Завершение общего разбора: снятие с учёта и удаление временного файла, с которого шёл разбор
+def finish_parse(digest, spill_path, task):
+    PARSES_IN_FLIGHT.pop(digest, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка при разборе выгрузки {digest[:12]}: {task.exception()}")
+    if spill_path:
+        remove_file(spill_path)
+
+def remove_file(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+# Разбор выгрузки сразу после загрузки, пока пользователь вводит остатки.
+# Повторно загруженный файл (тот же SHA-256) берётся из кэша без разбора.
+# Возвращает StockSnapshot или None при ошибке; временный файл удаляется в любом случае.
+async def parse_upload(source, spill_path=None, file_name=None):
+    shared_spill = False
+    try:
+        digest = await run_local(stock_digest, source)
+        snapshot = await run_local(stock_cache.get, digest)
+        if snapshot is not None:
+            metrics.inc("stock_cache_total", "hit")
+            logger.info(f"Выгрузка {digest[:12]} взята из кэша (получена {snapshot.ingested_at:%Y-%m-%d %H:%M})")
+            return snapshot
+        metrics.inc("stock_cache_total", "miss")
+        # Один файл, загруженный несколькими пользователями одновременно, разбирается один раз
+        parse = PARSES_IN_FLIGHT.get(digest)
+        if parse is None:
+            parse = PARSES_IN_FLIGHT[digest] = asyncio.ensure_future(parse_stock(source, file_name))
+            parse.add_done_callback(functools.partial(finish_parse, digest, spill_path))
+            shared_spill = True  # Временный файл удалит сама задача разбора
+        stocks = await asyncio.shield(parse)  # Отмена одной сессии не прерывает разбор для других
+        return await run_local(stock_cache.put, digest, stocks)
+    except Exception as e:
+        logger.error(f"Ошибка при разборе выгрузки: {e}")
+        return None
+    finally:
+        if spill_path and not shared_spill:
+            remove_file(spill_path)
+
+# Остатки выгрузки сессии в области сверки с проверкой срока давности.
+# Срок считается от первого получения файла: повторная загрузка старой выгрузки его не обновляет.
+async def process_stock_file(session):
+    try:
+        if session.stock_task is None:
+            raise FileNotFoundError("Файл остатков не найден. Пожалуйста, загрузите файл через Telegram.")
         
-        file_time = datetime.datetime.fromtimestamp(os.path.getmtime(latest_file))
-        current_time = datetime.datetime.now()
-        time_difference = (current_time - file_time).total_seconds() / 3600
+        snapshot = await session.stock_task
+        if snapshot is None:
+            return None
         
+        time_difference = (datetime.datetime.now() - snapshot.ingested_at).total_seconds() / 3600
         if time_difference > 24:
-            raise ValueError(f"Файл остатков устарел (дата: {file_time.strftime('%Y-%m-%d %H:%M')}). Загрузите актуальный файл.")
-        
-        df = pd.read_excel(latest_file, header=3)
-        if "Код товара" not in df.columns or "Наименование карточки товара" not in df.columns or "Количество (1 регистр)" not in df.columns:
-            raise KeyError("В файле отсутствуют необходимые столбцы.")
-        
-        stock_data = {}
-        for _, row in df.iterrows():
-            code = str(row["Код товара"])
-            name = row["Наименование карточки товара"]
-            quantity = row["Количество (1 регистр)"]
-            if code in stock_data:
-                stock_data[code]["quantity"] += quantity
-            else:
-                stock_data[code] = {"name": name, "quantity": quantity}
-        return stock_data
+            raise ValueError(f"Файл остатков устарел (дата: {snapshot.ingested_at.strftime('%Y-%m-%d %H:%M')}). Загрузите актуальный файл.")
+        
+        # Коды области сверки: товары сессии подсчёта и введённые остатки; None — вся выгрузка
+        codes = None
+        if RECONCILE_SCOPE != 'file':
+            codes = frozenset(p.code for p in session_products(session)) | frozenset(session.actual_stocks)
+        system_stocks, session.outside_stock = scope_stock(snapshot.stocks, codes)
+        return system_stocks
     except Exception as e:
         logger.error(f"Ошибка при обработке файла: {e}")
         return None
 
-def update_sheet_row(sheet, date, code, product_name, actual_stock, egais_stock):
-    try:
-        cell_list = sheet.findall(code)
-        for cell in cell_list:
-            row = sheet.row_values(cell.row)
-            if row[0] == date and row[1] == code:
-                sheet.update(range_name=f'A{cell.row}:F{cell.row}', values=[[date, code, product_name, actual_stock, egais_stock, actual_stock - egais_stock]])
-                logger.info(f"Обновлена строка в Google Sheets: {code} на {actual_stock}")
-                return
-        add_to_sheet(sheet, date, code, product_name, actual_stock, egais_stock)
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении строки: {e}")
+# Запись строк сверки: строки фиксируются в локальном журнале, в Google Sheets их переносит фоновая задача
+async def write_rows(context: ContextTypes.DEFAULT_TYPE, rows):
+    await run_local(sheets_journal.append, rows)
+    context.application.bot_data['journal_wakeup'].set()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type != 'private':
         return
     
     # Очищаем предыдущие данные
-    context.user_data['actual_stocks'] = {}
-    context.user_data['product_index'] = 0
-    context.user_data['state'] = 'waiting_for_file'
+    get_session(context.user_data).reset()
 
-    await update.message.reply_text(
+    outbox.send(context.bot, update.effective_chat.id,
         "Здравствуйте! Я бот для сверки остатков.\n"
-        "Пожалуйста, отправьте файл остатков в формате .xlsx, чтобы начать процесс."
+        "Пожалуйста, отправьте файл остатков (.xlsx, .xls, .ods или .csv), чтобы начать процесс."
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -300,13 +369,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📋 **Справка по боту:**\n"
         "- /start — Начать процесс сверки остатков.\n"
         "- /history — Показать историю остатков по товару (бот покажет список товаров и запросит код, затем выбор периода).\n"
+        "- /forecast — Прогноз расхода: на сколько дней хватит остатков и что опустится ниже порога до следующей сверки.\n"
         "- Используйте кнопки для навигации по процессу.\n"
-        "Введите остатки числом для каждого товара.\n\n"
+        "Введите остатки числом для каждого товара или все сразу одним сообщением (строки «код количество»).\n\n"
     )
     
     if is_admin(update):
         help_text += (
             "🔑 **Администраторские функции:**\n"
+            "- /resync\\_history — Пересинхронизировать локальную историю с Google Sheets.\n"
+            "- /stats — Статистика задержек (p50/p95).\n"
+            "- /memory — Использование памяти процессом и сессиями.\n"
             "Вы можете открыть панель администратора, нажав кнопку ниже или введя любой текст для активации.\n"
         )
         keyboard = [[InlineKeyboardButton("Открыть панель администратора", callback_data='admin_open')]]
@@ -314,85 +387,168 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         reply_markup = None
     
-    await context.bot.send_message(update.effective_chat.id, help_text, reply_markup=reply_markup, parse_mode='Markdown')
+    outbox.send(context.bot, update.effective_chat.id, help_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         logger.info(f"Запуск команды /history для user_id={update.effective_user.id}")
         if not PRODUCTS:
             logger.info("Список товаров пуст")
-            await context.bot.send_message(update.effective_chat.id, "Список товаров пуст. Добавьте товары через админ-панель.")
+            outbox.send(context.bot, update.effective_chat.id, "Список товаров пуст. Добавьте товары через админ-панель.")
             return
         
         # Формируем список товаров
-        products_text = "Список товаров:\n" + "\n".join([f"{p['short_name']} ({p['code']})" for p in PRODUCTS])
+        products_text = "Список товаров:\n" + "\n".join([f"{p.short_name} ({p.code})" for p in PRODUCTS])
         logger.info(f"Отправка списка товаров: {products_text}")
-        await context.bot.send_message(update.effective_chat.id, products_text)
+        outbox.send(context.bot, update.effective_chat.id, products_text)
         
         # Запрашиваем код товара и переходим в состояние выбора
         logger.info("Запрос кода товара и установка состояния history_select")
-        await context.bot.send_message(update.effective_chat.id, "Введите код товара, чтобы посмотреть историю (например, 999):")
-        context.user_data['state'] = 'history_select'
+        outbox.send(context.bot, update.effective_chat.id, "Введите код товара, чтобы посмотреть историю (например, 999):")
+        get_session(context.user_data).state = 'history_select'
         
     except Exception as e:
         logger.error(f"Ошибка в history_command: {e}", exc_info=True)
-        await context.bot.send_message(update.effective_chat.id, f"Ошибка: {e}")
+        outbox.send(context.bot, update.effective_chat.id, f"Ошибка: {e}")
+
+# Команда прогноза: расход по истории сверок, запас в днях и товары, которые опустятся ниже порога
+async def forecast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not PRODUCTS:
+            outbox.send(context.bot, update.effective_chat.id, "Список товаров пуст. Добавьте товары через админ-панель.")
+            return
+        await sync_forecast_history()
+        forecast = await run_local(build_forecast, PRODUCTS.snapshot())
+        outbox.send(context.bot, update.effective_chat.id, forecast.render())
+    except Exception as e:
+        logger.error(f"Ошибка в forecast_command: {e}", exc_info=True)
+        outbox.send(context.bot, update.effective_chat.id, f"Ошибка: {e}")
+
+# График истории товара за период: из кэша или построение в пуле потоков.
+# Одновременные запросы одного графика строятся один раз. None — истории за период нет.
+async def history_chart(code, days, start_date, end_date):
+    key = await run_local(chart_key, code, start_date, end_date)
+    chart = chart_cache.get(key)
+    if chart is not None:
+        return chart
+    build = CHARTS_IN_FLIGHT.get(key)
+    if build is None:
+        build = CHARTS_IN_FLIGHT[key] = asyncio.ensure_future(build_history_chart(key, code, days, start_date, end_date))
+        build.add_done_callback(lambda task: CHARTS_IN_FLIGHT.pop(key, None))
+    return await asyncio.shield(build)
+
+async def build_history_chart(key, code, days, start_date, end_date):
+    rows = await run_local(history_store.query, code, start_date, end_date)
+    if not rows:
+        return None
+    product = PRODUCTS.get(code)
+    title = f"{product.short_name} ({code})" if product else code
+    with metrics.timer("history_chart_seconds", "render"):
+        png = await run_local(render_history_chart, f"{title}: последние {days} дней", rows)
+    caption = f"История {title} за последние {days} дней: сверок {len(rows)}"
+    return chart_cache.put(key, HistoryChart(code, png, caption))
 
+# Пересинхронизация локальной истории с листом (или с листами месяцев периода);
+# ещё не отправленные строки журнала накладываются сверху
+async def sync_history(start_date=None, end_date=None):
+    count = await run_sheets(resync_history, start_date, end_date)
+    pending_rows, _ = await run_local(sheets_journal.pending, None)
+    await run_local(history_store.record_rows, pending_rows)
+    return count
+
+# Синхронизация окна истории прогноза (FORECAST_HISTORY_DAYS), если оно ещё не загружено из Google Sheets:
+# после развёртывания локальная история пуста
+async def sync_forecast_history():
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    start_date = (datetime.datetime.now() - datetime.timedelta(days=FORECAST_HISTORY_DAYS)).strftime('%Y-%m-%d')
+    if not await run_local(history_store.is_synced, start_date, today):
+        await sync_history(start_date, today)
+
+# Команда пересинхронизации локальной истории с Google Sheets
+async def resync_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not is_admin(update):
+            outbox.send(context.bot, update.effective_chat.id, "Эта функция доступна только администратору.")
+            return
+        count = await sync_history()
+        outbox.send(context.bot, update.effective_chat.id, f"История синхронизирована с Google Sheets: {count} записей.")
+    except Exception as e:
+        logger.error(f"Ошибка в resync_history_command: {e}", exc_info=True)
+        outbox.send(context.bot, update.effective_chat.id, f"Ошибка: {e}")
+
+@timed("handler_seconds", "handle_file")
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type != 'private':
         return
 
     # Проверяем, что отправлен документ
     if not update.message.document:
-        await update.message.reply_text("Пожалуйста, отправьте файл в формате .xlsx.")
+        outbox.send(context.bot, update.effective_chat.id, UPLOAD_FORMATS_HINT)
         return
 
-    # Проверяем, что файл имеет расширение .xlsx
     file_name = update.message.document.file_name
-    if not file_name.endswith('.xlsx'):
-        await update.message.reply_text("Пожалуйста, отправьте файл в формате .xlsx.")
+    lower_name = file_name.lower()
+    session = get_session(context.user_data)
+    downloaded = None  # Содержимое, уже скачанное для проверки файла остатков
+
+    # Во время подсчёта небольшой файл .csv/.xlsx считается файлом фактических остатков
+    if session.state in BULK_STATES and lower_name.endswith(('.csv', '.xlsx')) \
+            and (update.message.document.file_size or 0) <= MAX_COUNTS_FILE_SIZE:
+        try:
+            file = await update.message.document.get_file()
+            data = bytes(await file.download_as_bytearray())
+            if not is_stock_export(data, file_name):
+                await show_bulk_confirmation(update, context, parse_counts_file(data, file_name, PRODUCTS))
+                return
+            downloaded = data
+        except Exception as e:
+            logger.error(f"Ошибка при разборе файла остатков {file_name}: {e}")
+            outbox.send(context.bot, update.effective_chat.id, f"Не удалось разобрать файл с остатками: {e}")
+            return
+
+    # Проверяем формат выгрузки: .xlsx, .xls, .ods или .csv
+    if not lower_name.endswith(STOCK_EXTENSIONS):
+        outbox.send(context.bot, update.effective_chat.id, UPLOAD_FORMATS_HINT)
         return
 
-    try:
-        # Скачиваем файл
-        file = await update.message.document.get_file()
-        temp_file_path = f"/tmp/{file_name}"  # Временный путь на сервере
-        await file.download_to_drive(temp_file_path)
-        logger.info(f"Файл {file_name} скачан в {temp_file_path}")
+    if (update.message.document.file_size or 0) > MAX_UPLOAD_SIZE:
+        outbox.send(context.bot, update.effective_chat.id, f"Файл слишком большой (более {MAX_UPLOAD_SIZE // 2 ** 20} МБ).")
+        return
 
-        # Сохраняем путь к файлу в context.user_data
-        context.user_data['stock_file_path'] = temp_file_path
+    try:
+        # Скачиваем файл в память (или во временный файл, если он очень большой); выгрузку,
+        # уже скачанную при проверке на файл остатков, повторно не скачиваем
+        if downloaded is not None:
+            source, spill_path = downloaded, None
+        else:
+            source, spill_path = await download_upload(update.message.document)
+        logger.info(f"Файл {file_name} получен" + (f" во временный файл {spill_path}" if spill_path else " в память"))
 
-        # Запускаем процесс сверки
-        context.user_data['actual_stocks'] = {}
-        context.user_data['product_index'] = 0
-        context.user_data['state'] = 'ready_check'
+        # Запускаем процесс сверки: новая сессия со снимком каталога; разбор выгрузки начинается сразу
+        file_time = datetime.datetime.now()
+        session.begin(PRODUCTS.snapshot(), asyncio.create_task(parse_upload(source, spill_path, file_name)))
 
-        file_time = datetime.datetime.fromtimestamp(os.path.getmtime(temp_file_path))
         intro_text = (
             "Привет! Файл остатков получен.\n"
             "Я буду запрашивать фактические остатки для каждого товара по очереди.\n"
             "Отвечайте числом остатка для каждого товара.\n"
+            "Можно отправить все остатки сразу: одним сообщением по строке «код количество» "
+            "(или «название количество») либо файлом .csv/.xlsx из двух столбцов.\n"
             f"Используется файл: {file_name} (дата: {file_time.strftime('%Y-%m-%d %H:%M')})"
         )
-        await update.message.reply_text(intro_text)
+        outbox.send(context.bot, update.effective_chat.id, intro_text)
 
         keyboard = [
             [InlineKeyboardButton("Да", callback_data='ready_yes'), InlineKeyboardButton("Нет", callback_data='ready_no')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(update.effective_chat.id, "Готовы ли для подсчёта фактических остатков?", reply_markup=reply_markup)
+        outbox.send(context.bot, update.effective_chat.id, "Готовы ли для подсчёта фактических остатков?", reply_markup=reply_markup)
 
     except Exception as e:
         logger.error(f"Ошибка при обработке файла: {e}")
-        await update.message.reply_text(f"Ошибка при обработке файла: {str(e)}")
-        if 'stock_file_path' in context.user_data:
-            try:
-                os.remove(context.user_data['stock_file_path'])
-            except:
-                pass
-            context.user_data.pop('stock_file_path', None)
+        outbox.send(context.bot, update.effective_chat.id, f"Ошибка при обработке файла: {str(e)}")
 
+@timed("handler_seconds", "handle_input")
 async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type != 'private':
         return
@@ -401,21 +557,30 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_admin_input(update, context)
         return
     
-    state = context.user_data.get('state', 'input')
+    session = get_session(context.user_data)
+    state = session.state
     logger.info(f"Текущее состояние: {state}, текст ввода: {update.message.text.strip()}")
     
+    # Нет начатого диалога: подсказываем, как начать (или сообщаем об истёкшей сессии)
+    if state is None:
+        if session.stage == EXPIRED:
+            outbox.send(context.bot, update.effective_chat.id, "Сессия сверки истекла из-за бездействия. Отправьте файл остатков заново.")
+        else:
+            outbox.send(context.bot, update.effective_chat.id, "Отправьте файл остатков (.xlsx, .xls, .ods или .csv), чтобы начать сверку, или /history для истории.")
+        return
+    
     try:
         if state == 'history_select':
             code = update.message.text.strip()
             logger.info(f"Введён код товара: {code}")
             # Проверяем, есть ли такой код в списке товаров
-            if not any(p['code'] == code for p in PRODUCTS):
+            if code not in PRODUCTS:
                 logger.info(f"Товар с кодом {code} не найден")
-                await context.bot.send_message(update.effective_chat.id, f"Товар с кодом {code} не найден. Попробуйте снова:")
+                outbox.send(context.bot, update.effective_chat.id, f"Товар с кодом {code} не найден. Попробуйте снова:")
                 return
             
             # Сохраняем код товара
-            context.user_data['history_code'] = code
+            session.history_code = code
             logger.info(f"Сохранён код товара: {code}")
             
             # Показываем кнопки для выбора периода
@@ -428,92 +593,108 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             logger.info("Создание и отправка клавиатуры для выбора периода")
-            await context.bot.send_message(update.effective_chat.id, "Выберите период для истории:", reply_markup=reply_markup)
-            context.user_data['state'] = 'history_period'
+            outbox.send(context.bot, update.effective_chat.id, "Выберите период для истории:", reply_markup=reply_markup)
+            session.state = 'history_period'
             logger.info("Установлено состояние history_period")
         
+        elif state in BULK_STATES and not update.message.text.strip().lstrip('-').isdigit():
+            # Массовый ввод: все остатки одним сообщением
+            await show_bulk_confirmation(update, context, parse_counts_text(update.message.text, PRODUCTS))
+        
         elif state == 'input':
-            product_index = context.user_data['product_index']
+            products = session_products(session)
             stock = int(update.message.text.strip())
-            product = PRODUCTS[product_index]
-            await update.message.reply_text(f"Добавлено: {product['short_name']} ({product['code']}) = {stock}")
-            context.user_data['actual_stocks'][product['code']] = stock
-            context.user_data['product_index'] += 1
+            product = products[session.product_index]
+            outbox.send(context.bot, update.effective_chat.id, f"Добавлено: {product.short_name} ({product.code}) = {stock}")
+            session.actual_stocks[product.code] = stock
+            session.product_index += 1
             
-            if context.user_data['product_index'] < len(PRODUCTS):
-                next_product = PRODUCTS[context.user_data['product_index']]
-                await context.bot.send_message(update.effective_chat.id, f"Введите остаток для {next_product['short_name']} ({next_product['code']}):")
+            if session.product_index < len(products):
+                next_product = products[session.product_index]
+                outbox.send(context.bot, update.effective_chat.id, f"Введите остаток для {next_product.short_name} ({next_product.code}):")
             else:
                 keyboard = [
                     [InlineKeyboardButton("Да", callback_data='check_yes'), InlineKeyboardButton("Нет", callback_data='check_no')]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await context.bot.send_message(update.effective_chat.id, "Все фактические остатки введены. Провести сверку?", reply_markup=reply_markup)
-                context.user_data['state'] = 'check'
+                outbox.send(context.bot, update.effective_chat.id, "Все фактические остатки введены. Провести сверку?", reply_markup=reply_markup)
+                session.state = 'check'
         
         elif state == 'edit_value':
             stock = int(update.message.text.strip())
-            code = context.user_data['edit_code']
+            code = session.edit_code
             today = datetime.datetime.now().strftime('%Y-%m-%d')
-            system_stocks = context.user_data['system_stocks']
+            system_stocks = session.system_stocks
             system_data = system_stocks.get(code, {"name": "", "quantity": 0})
             name = system_data["name"]
             system_stock = system_data["quantity"]
-            context.user_data['actual_stocks'][code] = stock
-            update_sheet_row(sheet, today, code, name, stock, system_stock)
-            await update.message.reply_text(f"Обновлено: {name} ({code}) = {stock}")
+            session.actual_stocks[code] = stock
+            await write_rows(context, [build_row(today, code, name, stock, system_stock)])
+            outbox.send(context.bot, update.effective_chat.id, f"Обновлено: {name} ({code}) = {stock}")
             
-            discrepancies = [
-                f"{system_stocks[c]['name']} ({c}): Факт = {context.user_data['actual_stocks'][c]}, ЕГАИС = {system_stocks[c]['quantity']}, Расхождение = {context.user_data['actual_stocks'][c] - system_stocks[c]['quantity']}"
-                for c in context.user_data['actual_stocks'].keys() & system_stocks.keys()
-                if context.user_data['actual_stocks'][c] != system_stocks[c]['quantity']
-            ]
-            context.user_data['discrepancies'] = discrepancies
+            # Пересчитываем расхождение только для исправленного товара
+            discrepancies = session.discrepancies
+            discrepancies.set(code, name, stock, system_stock)
             if discrepancies:
                 keyboard = [
                     [InlineKeyboardButton("Да", callback_data='edit_yes'), InlineKeyboardButton("Нет", callback_data='edit_no')]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await context.bot.send_message(update.effective_chat.id, "Расхождения остались:\n" + "\n".join(discrepancies) + "\nИсправить ещё один товар?", reply_markup=reply_markup)
-                context.user_data['state'] = 'edit'
+                outbox.send(context.bot, update.effective_chat.id, "Расхождения остались:\n" + discrepancies.render() + "\nИсправить ещё один товар?", reply_markup=reply_markup)
+                session.state = 'edit'
             else:
                 keyboard = [
                     [InlineKeyboardButton("Да", callback_data='send_yes'), InlineKeyboardButton("Нет", callback_data='send_no')]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await context.bot.send_message(update.effective_chat.id, "Отправить остатки в группу?", reply_markup=reply_markup)
-                context.user_data['state'] = 'send'
+                outbox.send(context.bot, update.effective_chat.id, "Отправить остатки в группу?", reply_markup=reply_markup)
+                session.state = 'send'
         
         elif state == 'edit':
-            response = update.message.text.strip().lower()
-            if any(d.split('(')[1].startswith(response + ')') for d in context.user_data['discrepancies']):
-                context.user_data['edit_code'] = response
-                context.user_data['state'] = 'edit_value'
-                await context.bot.send_message(update.effective_chat.id, f"Введите новый остаток для товара с кодом {response}:")
+            response = update.message.text.strip()
+            if response in session.discrepancies:
+                session.edit_code = response
+                session.state = 'edit_value'
+                outbox.send(context.bot, update.effective_chat.id, f"Введите новый остаток для товара с кодом {response}:")
             else:
-                await context.bot.send_message(update.effective_chat.id, "Неверный код. Введите код из списка расхождений:")
+                outbox.send(context.bot, update.effective_chat.id, "Неверный код. Введите код из списка расхождений:")
     
     except ValueError:
         if state == 'input':
-            product = PRODUCTS[context.user_data['product_index']]
-            await context.bot.send_message(update.effective_chat.id, f"Пожалуйста, введите число для {product['short_name']} ({product['code']}):")
+            product = session_products(session)[session.product_index]
+            outbox.send(context.bot, update.effective_chat.id, f"Пожалуйста, введите число для {product.short_name} ({product.code}):")
         elif state == 'edit_value':
-            await context.bot.send_message(update.effective_chat.id, "Пожалуйста, введите число для нового остатка:")
+            outbox.send(context.bot, update.effective_chat.id, "Пожалуйста, введите число для нового остатка:")
         elif state == 'history_select':
-            await context.bot.send_message(update.effective_chat.id, "Пожалуйста, введите код товара (например, 999):")
+            outbox.send(context.bot, update.effective_chat.id, "Пожалуйста, введите код товара (например, 999):")
     except Exception as e:
         logger.error(f"Ошибка ввода: {e}", exc_info=True)
-        await context.bot.send_message(update.effective_chat.id, f"Ошибка: {e}. Попробуйте снова.")
+        outbox.send(context.bot, update.effective_chat.id, f"Ошибка: {e}. Попробуйте снова.")
+
+# Подтверждение массового ввода: распознанные, пропущенные и неизвестные позиции одним сообщением
+async def show_bulk_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE, result):
+    if not result.counts:
+        outbox.send(context.bot, update.effective_chat.id,
+            "Не удалось распознать ни одной позиции. Отправьте строки вида «код количество», например:\n109 12\n108 5\n\n"
+            + result.render(PRODUCTS)
+        )
+        return
+    get_session(context.user_data).bulk_counts = result.counts
+    keyboard = [
+        [InlineKeyboardButton("Подтвердить", callback_data='bulk_yes'), InlineKeyboardButton("Отмена", callback_data='bulk_no')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    outbox.send(context.bot, update.effective_chat.id, result.render(PRODUCTS) + "\nПодтвердить остатки?", reply_markup=reply_markup)
 
 # Функция для отправки сводки остатков и расхождений в группу
-async def send_stock_summary(context: ContextTypes.DEFAULT_TYPE, products: list, actual_stocks: dict, system_stocks: dict, discrepancies: list):
+async def send_stock_summary(context: ContextTypes.DEFAULT_TYPE, products: ProductCatalog, actual_stocks: dict, system_stocks: dict, discrepancies: DiscrepancyTable, outside: OutsideStock = None):
     try:
         # Формируем список всех товаров
         all_items_message = "📋 Сводка остатков:\n"
         for product in products:
-            code = product["code"]
-            name = product["short_name"]
-            threshold = product.get("threshold", 10)
+            code = product.code
+            name = product.short_name
+            threshold = product.threshold
             actual_stock = actual_stocks.get(code, 0)
             
             # Формируем строку для товара
@@ -527,82 +708,97 @@ async def send_stock_summary(context: ContextTypes.DEFAULT_TYPE, products: list,
         # Формируем список расхождений, если они есть
         discrepancies_message = ""
         if discrepancies:
-            discrepancies_message = "\n🆘 Выявлены расхождения:\n"
-            for discrepancy in discrepancies:
-                # Разбираем строку расхождения: "Название (код): Факт = X, ЕГАИС = Y, Расхождение = Z"
-                parts = discrepancy.split(": ")
-                name_with_code = parts[0]  # "Название (код)"
-                name = name_with_code.split(" (")[0]  # Извлекаем название
-                details = parts[1].split(", ")  # ["Факт = X", "ЕГАИС = Y", "Расхождение = Z"]
-                actual = details[0].split(" = ")[1]  # X
-                egais = details[1].split(" = ")[1]  # Y
-                diff = details[2].split(" = ")[1]  # Z
-                discrepancies_message += f"{name}: ЕГАИС = {egais}, Факт = {actual}, Расхождение = {diff}\n"
+            discrepancies_message = "\n🆘 Выявлены расхождения:\n" + discrepancies.render_summary() + "\n"
+        
+        # Остатки вне каталога — одной строкой
+        outside_message = f"\n{outside.render()}\n" if outside and outside.codes else ""
+        
+        # Прогноз: товары, которые при текущем расходе опустятся ниже порога до следующей сверки
+        forecast_message = ""
+        try:
+            await sync_forecast_history()
+            forecast = await run_local(build_forecast, products.snapshot(), actual_stocks)
+            if forecast.at_risk():
+                forecast_message = "\n" + forecast.render_summary() + "\n"
+        except Exception as e:
+            logger.error(f"Ошибка при расчёте прогноза: {e}", exc_info=True)
         
         # Объединяем сообщение
-        full_message = all_items_message + discrepancies_message
+        full_message = all_items_message + discrepancies_message + outside_message + forecast_message
         
-        # Отправляем сообщение в группу
-        await context.bot.send_message(chat_id=NOTIFY_CHAT_ID, text=full_message)
-        logger.info("Сводка остатков отправлена в группу")
+        # Ставим сообщение в очередь группы: при нагрузке сводки склеиваются и не задерживают сессию,
+        # слишком длинная сводка делится на части
+        outbox.send(context.bot, chat_id=NOTIFY_CHAT_ID, text=full_message)
+        logger.info("Сводка остатков поставлена в очередь отправки в группу")
     except Exception as e:
         logger.error(f"Ошибка при отправке сводки остатков: {e}")
 
+@timed("handler_seconds", "perform_check")
 async def perform_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    wait_msg = await context.bot.send_message(chat_id, "Идёт сверка остатков, пожалуйста, подождите...")
+    session = get_session(context.user_data)
+    stock_task = session.stock_task
+    outbox.send(context.bot, chat_id, "Идёт сверка остатков, пожалуйста, подождите...")
     
     try:
         today = datetime.datetime.now().strftime('%Y-%m-%d')
-        system_stocks = process_stock_file(context)
-        if not system_stocks:
-            await context.bot.send_message(chat_id, "Ошибка обработки файла остатков. Проверьте файл и попробуйте снова.")
+        system_stocks = await process_stock_file(session)
+        if system_stocks is None:
+            outbox.send(context.bot, chat_id, "Ошибка обработки файла остатков. Проверьте файл и попробуйте снова.")
             return
         
         processed = 0
-        discrepancies = []
+        discrepancies = DiscrepancyTable()
+        rows = []
         
-        for code in set(context.user_data['actual_stocks'].keys()) | set(system_stocks.keys()):
-            actual_stock = context.user_data['actual_stocks'].get(code, 0)
+        for code in set(session.actual_stocks.keys()) | set(system_stocks.keys()):
+            actual_stock = session.actual_stocks.get(code, 0)
             system_data = system_stocks.get(code, {"name": "", "quantity": 0})
             name = system_data["name"]
             system_stock = system_data["quantity"]
-            add_to_sheet(sheet, today, code, name, actual_stock, system_stock)
+            rows.append(build_row(today, code, name, actual_stock, system_stock))
             processed += 1
-            discrepancy = actual_stock - system_stock
-            if discrepancy != 0:
-                discrepancies.append(f"{name} ({code}): Факт = {actual_stock}, ЕГАИС = {system_stock}, Расхождение = {discrepancy}")
+            discrepancies.set(code, name, actual_stock, system_stock)
         
-        context.user_data['system_stocks'] = system_stocks
-        context.user_data['discrepancies'] = discrepancies
+        # Фиксируем строки сверки в журнале; в Google Sheets они уйдут пакетами в фоне
+        await write_rows(context, rows)
+        
+        session.system_stocks = system_stocks
+        session.discrepancies = discrepancies
         message_text = f"Сверка завершена. Обработано: {processed} товаров"
+        # Коды выгрузки вне каталога не сверяются и не пишутся в таблицу — только одна строка сводки
+        outside = session.outside_stock
+        outside_line = "\n" + outside.render() if outside and outside.codes else ""
+        message_text += outside_line
         if discrepancies:
-            message_text += "\nРасхождения:\n" + "\n".join(discrepancies) + "\nЕсть расхождения. Перепроверить позиции?"
+            message_text += "\nРасхождения:\n" + discrepancies.render() + "\nЕсть расхождения. Перепроверить позиции?"
             keyboard = [
                 [InlineKeyboardButton("Да", callback_data='review_yes'), InlineKeyboardButton("Нет", callback_data='review_no')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            context.user_data['state'] = 'review'
-            await context.bot.send_message(chat_id, message_text, reply_markup=reply_markup)
+            session.state = 'review'
+            outbox.send(context.bot, chat_id, message_text, reply_markup=reply_markup)
         else:
             keyboard = [
                 [InlineKeyboardButton("Да", callback_data='send_yes'), InlineKeyboardButton("Нет", callback_data='send_no')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id, "Отправить остатки в группу?", reply_markup=reply_markup)
-            context.user_data['state'] = 'send'
+            if outside_line:
+                outbox.send(context.bot, chat_id, outside_line.strip())
+            outbox.send(context.bot, chat_id, "Отправить остатки в группу?", reply_markup=reply_markup)
+            session.state = 'send'
     except Exception as e:
         logger.error(f"Ошибка при сверке: {e}", exc_info=True)
-        await context.bot.send_message(chat_id, f"Ошибка при сверке: {e}")
+        outbox.send(context.bot, chat_id, f"Ошибка при сверке: {e}")
     finally:
-        if 'stock_file_path' in context.user_data:
-            try:
-                os.remove(context.user_data['stock_file_path'])
-                logger.info(f"Временный файл {context.user_data['stock_file_path']} удалён")
-            except Exception as e:
-                logger.error(f"Ошибка при удалении временного файла: {e}")
-            context.user_data.pop('stock_file_path', None)
+        if session.state == 'checking':
+            # Сверка не завершилась: кнопка «Да» снова доступна, разобранная выгрузка остаётся для повтора
+            session.state = 'check'
+        elif session.stock_task is stock_task:
+            # Разобранная выгрузка больше не нужна: остатки сохранены в сессии
+            session.stock_task = None
 
+@timed("handler_seconds", "button_handler")
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
@@ -619,68 +815,75 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         data = query.data
         logger.info(f"Данные callback: {data}")
+        session = get_session(context.user_data)
         
         # Обработка выбора периода для истории
         if data.startswith('period_'):
             days = int(data.split('_')[1])  # Извлекаем количество дней (5, 10, 20, 30)
-            code = context.user_data.get('history_code')
+            code = session.history_code
             logger.info(f"Выбран период: {days} дней, код товара: {code}")
             
             if not code:
-                logger.error("Код товара отсутствует в context.user_data['history_code']")
-                await context.bot.send_message(chat_id, "Произошла ошибка: код товара не сохранён. Пожалуйста, начните заново с команды /history.")
-                context.user_data.pop('state', None)
-                context.user_data.pop('history_code', None)
+                logger.error("Код товара отсутствует в сессии пользователя")
+                outbox.send(context.bot, chat_id, "Произошла ошибка: код товара не сохранён. Пожалуйста, начните заново с команды /history.")
+                session.state = None
+                session.history_code = None
                 return
             
             # Вычисляем дату начала периода
-            today = datetime.datetime.now()
-            start_date = today - datetime.timedelta(days=days)
+            today = datetime.datetime.now().strftime('%Y-%m-%d')
+            start_date = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+            
+            # Кнопки для выбора другого периода
+            keyboard = [
+                [InlineKeyboardButton("5 дней", callback_data='period_5'),
+                 InlineKeyboardButton("10 дней", callback_data='period_10')],
+                [InlineKeyboardButton("20 дней", callback_data='period_20'),
+                 InlineKeyboardButton("30 дней", callback_data='period_30')],
+                [InlineKeyboardButton("Завершить", callback_data='history_done')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
             
-            # Получаем историю из Google Sheets
-            all_data = sheet.get_all_values()
-            history = []
+            # Получаем историю из локальной копии; при первом обращении к периоду синхронизируем его с Google Sheets
+            if not await run_local(history_store.is_synced, start_date, today):
+                await sync_history(start_date, today)
             
-            for row in all_data:
-                if len(row) >= 2 and row[1] == code:  # Проверяем, что строка содержит код
-                    try:
-                        row_date = datetime.datetime.strptime(row[0], '%Y-%m-%d')
-                        if start_date <= row_date <= today:  # Фильтруем по дате
-                            date = row[0]
-                            actual_stock = float(row[3]) if row[3] else 0  # Фактический остаток
-                            egais_stock = float(row[4]) if row[4] else 0   # Остаток ЕГАИС
-                            discrepancy = actual_stock - egais_stock
-                            history.append(f"{date}: Факт = {actual_stock}, ЕГАИС = {egais_stock}, Расхождение = {discrepancy}")
-                    except ValueError:
-                        logger.warning(f"Некорректный формат даты в строке: {row[0]}")
-                        continue
+            # График: одно фото с кнопками периода, повторные запросы берутся из кэша
+            if HISTORY_CHARTS:
+                chart = await history_chart(code, days, start_date, today)
+                if chart is None:
+                    logger.info(f"История для товара {code} за {days} дней не найдена")
+                    outbox.send(context.bot, chat_id, f"История для товара с кодом {code} за последние {days} дней не найдена.", reply_markup=reply_markup)
+                else:
+                    logger.info(f"Отправка графика истории для товара {code} за {days} дней")
+                    sent = outbox.send_photo(context.bot, chat_id, chart.photo, caption=chart.caption, reply_markup=reply_markup)
+                    sent.add_done_callback(chart.remember_upload)
+                return
+            
+            rows = await run_local(history_store.query, code, start_date, today)
+            history = [
+                f"{date}: Факт = {actual_stock}, ЕГАИС = {egais_stock}, Расхождение = {actual_stock - egais_stock}"
+                for date, actual_stock, egais_stock in rows
+            ]
             
             if not history:
                 logger.info(f"История для товара {code} за {days} дней не найдена")
-                await context.bot.send_message(chat_id, f"История для товара с кодом {code} за последние {days} дней не найдена.")
+                outbox.send(context.bot, chat_id, f"История для товара с кодом {code} за последние {days} дней не найдена.")
             else:
                 logger.info(f"Отправка истории для товара {code} за {days} дней")
                 history_text = f"История для товара с кодом {code} (последние {days} дней):\n" + "\n".join(history)
-                await context.bot.send_message(chat_id, history_text)
+                outbox.send(context.bot, chat_id, history_text)
             
             # Повторно показываем кнопки для выбора периода
-            keyboard = [
-                [InlineKeyboardButton("5 дней", callback_data='period_5'),
-                 InlineKeyboardButton("10 дней", callback_data='period_10')],
-                [InlineKeyboardButton("20 дней", callback_data='period_20'),
-                 InlineKeyboardButton("30 дней", callback_data='period_30')],
-                [InlineKeyboardButton("Завершить", callback_data='history_done')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id, "Выберите другой период или завершите:", reply_markup=reply_markup)
+            outbox.send(context.bot, chat_id, "Выберите другой период или завершите:", reply_markup=reply_markup)
             return
         
         # Обработка завершения процесса истории
         if data == 'history_done':
             logger.info("Пользователь завершил просмотр истории")
-            await context.bot.send_message(chat_id, "Просмотр истории завершён.")
-            context.user_data.pop('state', None)
-            context.user_data.pop('history_code', None)
+            outbox.send(context.bot, chat_id, "Просмотр истории завершён.")
+            session.state = None
+            session.history_code = None
             return
         
         # Сначала проверяем admin_open
@@ -694,7 +897,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if data.startswith('admin_'):
             logger.info("Обработка admin_ callback")
             if not is_admin(update):
-                await query.message.reply_text("Эта функция доступна только администратору.")
+                outbox.send(context.bot, query.message.chat_id, "Эта функция доступна только администратору.")
                 return
             
             if data == 'admin_add':
@@ -706,78 +909,215 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await show_admin_panel(chat_id, context)
             elif data == 'admin_edit_threshold':
                 await handle_edit_threshold(update, context)
+            elif data == 'admin_stats':
+                await stats_command(update, context)
+                await show_admin_panel(chat_id, context)
             return
         
         if query.message.chat.type != 'private':
             logger.info("Сообщение не в приватном чате")
             return
         
+        # Кнопки сверки работают только в активной сессии: данные завершённой или брошенной уже очищены
+        if session.stage != ACTIVE:
+            text = "Сессия сверки истекла из-за бездействия." if session.stage == EXPIRED else "Сверка уже завершена."
+            outbox.send(context.bot, chat_id, text + " Отправьте файл остатков, чтобы начать новую.")
+            return
+        
         if data == 'ready_yes':
-            context.user_data['state'] = 'input'
-            if not PRODUCTS:
-                await context.bot.send_message(chat_id, "Список товаров пуст. Обратитесь к администратору для добавления товаров.")
+            session.state = 'input'
+            products = session_products(session)
+            if not products:
+                outbox.send(context.bot, chat_id, "Список товаров пуст. Обратитесь к администратору для добавления товаров.")
                 return
-            product = PRODUCTS[0]
-            await context.bot.send_message(chat_id, f"Введите остаток для {product['short_name']} ({product['code']}):")
+            product = products[0]
+            outbox.send(context.bot, chat_id, f"Введите остаток для {product.short_name} ({product.code}):")
+        elif data == 'bulk_yes':
+            bulk_counts, session.bulk_counts = session.bulk_counts, None
+            if bulk_counts is None or session.state not in BULK_STATES:
+                outbox.send(context.bot, chat_id, "Нет данных для подтверждения. Отправьте остатки ещё раз.")
+                return
+            session.actual_stocks.update(bulk_counts)
+            session.product_index = len(session_products(session))
+            keyboard = [
+                [InlineKeyboardButton("Да", callback_data='check_yes'), InlineKeyboardButton("Нет", callback_data='check_no')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            outbox.send(context.bot, chat_id, "Все фактические остатки введены. Провести сверку?", reply_markup=reply_markup)
+            session.state = 'check'
+        elif data == 'bulk_no':
+            session.bulk_counts = None
+            outbox.send(context.bot, chat_id, "Массовый ввод отменён.")
+            products = session_products(session)
+            if session.state == 'input' and session.product_index < len(products):
+                product = products[session.product_index]
+                outbox.send(context.bot, chat_id, f"Введите остаток для {product.short_name} ({product.code}):")
         elif data == 'ready_no':
-            await context.bot.send_message(chat_id, "Хорошо, вернитесь когда будете готовы!")
+            outbox.send(context.bot, chat_id, "Хорошо, вернитесь когда будете готовы!")
         elif data == 'check_yes':
-            await perform_check(update, context)
+            # Сверка запускается один раз: повторное нажатие во время сверки или после неё игнорируется
+            if session.state != 'check':
+                logger.info(f"Нажатие check_yes в состоянии {session.state} проигнорировано")
+                return
+            session.state = 'checking'
+            if CONCURRENT_UPDATES > 1:
+                # Обновления чатов обрабатываются параллельно: сверка идёт в очереди своего чата,
+                # поэтому следующие нажатия пользователя дождутся её результата
+                await perform_check(update, context)
+            else:
+                # Сверка выполняется фоновой задачей, чтобы очередь обновлений других чатов не ждала её
+                context.application.create_task(perform_check(update, context), update=update)
         elif data == 'check_no':
-            context.user_data['state'] = 'confirm_cancel'
+            if session.state == 'checking':
+                outbox.send(context.bot, chat_id, "Сверка уже выполняется, дождитесь результата.")
+                return
+            session.state = 'confirm_cancel'
             keyboard = [
                 [InlineKeyboardButton("Да", callback_data='cancel_yes'), InlineKeyboardButton("Нет", callback_data='cancel_no')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id, "Вы уверены, что хотите прервать процесс сверки?", reply_markup=reply_markup)
+            outbox.send(context.bot, chat_id, "Вы уверены, что хотите прервать процесс сверки?", reply_markup=reply_markup)
         elif data == 'cancel_yes':
-            await context.bot.send_message(chat_id, "Сверка отменена.")
+            session.finish()
+            outbox.send(context.bot, chat_id, "Сверка отменена.")
         elif data == 'cancel_no':
-            context.user_data['state'] = 'check'
+            session.state = 'check'
             keyboard = [
                 [InlineKeyboardButton("Да", callback_data='check_yes'), InlineKeyboardButton("Нет", callback_data='check_no')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id, "Все фактические остатки введены. Провести сверку?", reply_markup=reply_markup)
+            outbox.send(context.bot, chat_id, "Все фактические остатки введены. Провести сверку?", reply_markup=reply_markup)
         elif data == 'review_yes':
-            context.user_data['state'] = 'edit'
-            discrepancies = context.user_data['discrepancies']
-            await context.bot.send_message(chat_id, "Расхождения:\n" + "\n".join(discrepancies) + "\nИсправить данные для какого товара? Введите код:")
+            session.state = 'edit'
+            discrepancies = session.discrepancies
+            outbox.send(context.bot, chat_id, "Расхождения:\n" + discrepancies.render() + "\nИсправить данные для какого товара? Введите код:")
         elif data == 'review_no':
-            discrepancies = context.user_data['discrepancies']
+            discrepancies = session.discrepancies
             keyboard = [
                 [InlineKeyboardButton("Да", callback_data='send_yes'), InlineKeyboardButton("Нет", callback_data='send_no')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id, "Отправить остатки в группу?", reply_markup=reply_markup)
-            context.user_data['state'] = 'send'
+            outbox.send(context.bot, chat_id, "Отправить остатки в группу?", reply_markup=reply_markup)
+            session.state = 'send'
         elif data == 'edit_yes':
-            discrepancies = context.user_data['discrepancies']
-            await context.bot.send_message(chat_id, "Расхождения:\n" + "\n".join(discrepancies) + "\nИсправить данные для какого товара? Введите код:")
+            discrepancies = session.discrepancies
+            outbox.send(context.bot, chat_id, "Расхождения:\n" + discrepancies.render() + "\nИсправить данные для какого товара? Введите код:")
         elif data == 'edit_no':
-            discrepancies = context.user_data['discrepancies']
+            discrepancies = session.discrepancies
             keyboard = [
                 [InlineKeyboardButton("Да", callback_data='send_yes'), InlineKeyboardButton("Нет", callback_data='send_no')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id, "Отправить остатки в группу?", reply_markup=reply_markup)
-            context.user_data['state'] = 'send'
+            outbox.send(context.bot, chat_id, "Отправить остатки в группу?", reply_markup=reply_markup)
+            session.state = 'send'
         elif data == 'send_yes':
-            await send_stock_summary(context, PRODUCTS, context.user_data['actual_stocks'], context.user_data['system_stocks'], context.user_data.get('discrepancies', []))
-            await context.bot.send_message(chat_id, "Остатки отправлены в группу.")
+            await send_stock_summary(context, PRODUCTS, session.actual_stocks, session.system_stocks, session.discrepancies or DiscrepancyTable(), session.outside_stock)
+            session.finish()
+            outbox.send(context.bot, chat_id, "Остатки отправлены в группу.")
         elif data == 'send_no':
-            await context.bot.send_message(chat_id, "Остатки не отправлены в группу.")
+            session.finish()
+            outbox.send(context.bot, chat_id, "Остатки не отправлены в группу.")
     except Exception as e:
         logger.error(f"Ошибка в button_handler: {e}", exc_info=True)
 
+# Замер времени от запуска процесса до начала опроса Telegram.
+# В режиме --startup-time бот завершает работу сразу после замера.
+def log_startup_time():
+    elapsed = time.perf_counter() - STARTED_AT
+    logger.info(f"Время до начала приёма обновлений Telegram: {elapsed:.3f} с")
+    if MEASURE_STARTUP:
+        print(f"time-to-first-poll: {elapsed:.3f} s")
+
+async def report_startup_time(application: Application):
+    while not application.updater.running:
+        await asyncio.sleep(0.01)
+    log_startup_time()
+    if MEASURE_STARTUP:
+        application.stop_running()
+    else:
+        preload_in_background()
+
+# Готовность webhook-сервера: замер времени старта
+def on_webhook_ready(stop_event: asyncio.Event):
+    log_startup_time()
+    if MEASURE_STARTUP:
+        stop_event.set()
+    else:
+        preload_in_background()
+
+# Загрузка тяжёлых библиотек после начала приёма обновлений: не замедляет старт и первый запрос графика
+def preload_in_background():
+    if HISTORY_CHARTS:
+        asyncio.ensure_future(run_local(preload_charts))
+
+# Периодическая очистка брошенных сессий (задача JobQueue)
+async def sweep_sessions_job(context: ContextTypes.DEFAULT_TYPE):
+    sweep_sessions(context.application.user_data.values())
+
+# Та же очистка фоновой задачей, если JobQueue недоступна (PTB установлен без extra job-queue)
+async def run_session_sweeper(application: Application):
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            sweep_sessions(application.user_data.values())
+        except Exception as e:
+            logger.error(f"Ошибка при очистке сессий: {e}", exc_info=True)
+
+# Запуск фоновых задач: запись журнала в Google Sheets (с дозаписью оставшегося с прошлого запуска),
+# очистка брошенных сессий и метрики
+async def on_startup(application: Application):
+    if BOT_MODE == 'polling':
+        asyncio.create_task(report_startup_time(application))
+    wakeup = asyncio.Event()
+    application.bot_data['journal_wakeup'] = wakeup
+    application.bot_data['journal_task'] = asyncio.create_task(run_flusher(sheets_journal, wakeup))
+    if application.job_queue:
+        application.job_queue.run_repeating(sweep_sessions_job, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+    else:
+        application.bot_data['session_task'] = asyncio.create_task(run_session_sweeper(application))
+    if METRICS_LOG_INTERVAL > 0:
+        application.bot_data['metrics_task'] = asyncio.create_task(log_digest())
+    if METRICS_PORT:
+        application.bot_data['metrics_runner'] = await start_metrics_server()
+    if PRODUCTS.corrupt_path:
+        outbox.send(
+            application.bot, ADMIN_ID,
+            f"⚠️ Файл продуктов повреждён и перенесён в {PRODUCTS.corrupt_path}. "
+            "Каталог пуст: восстановите файл и перезапустите бота или добавьте товары заново.",
+        )
+
+# Отправка сообщений, оставшихся в очереди (в том числе сводок в группу), пока HTTP-клиент бота ещё открыт:
+# post_stop вызывается после остановки приёма обновлений, но до Application.shutdown()
+async def on_stop(application: Application):
+    await outbox.drain(timeout=OUTBOX_DRAIN_TIMEOUT)
+
+# Остановка фоновых задач и пулов выполнения при завершении бота
+async def on_shutdown(application: Application):
+    for key in ('journal_task', 'metrics_task', 'session_task'):
+        task = application.bot_data.pop(key, None)
+        if task:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    runner = application.bot_data.pop('metrics_runner', None)
+    if runner:
+        await runner.cleanup()
+    PRODUCTS.flush()
+    shutdown_executors()
+
 def main():
-    application = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+    builder = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    if CONCURRENT_UPDATES > 1:
+        # Разные чаты обрабатываются одновременно, обновления одного чата — по порядку
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
     
     # Настраиваем команды для меню Telegram
     commands = [
         BotCommand("start", "Начать сверку остатков"),
         BotCommand("help", "Показать справку"),
-        BotCommand("history", "Показать историю остатков по товару")
+        BotCommand("history", "Показать историю остатков по товару"),
+        BotCommand("forecast", "Прогноз расхода остатков")
     ]
     application.bot.set_my_commands(commands)
     
@@ -785,12 +1125,21 @@ def main():
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("forecast", forecast_command))
+    application.add_handler(CommandHandler("resync_history", resync_history_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("memory", memory_command))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_file))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_input))
     application.add_handler(CallbackQueryHandler(button_handler))
     
-    # Запускаем бота
-    application.run_polling()
+    # Запускаем бота: webhook-сервер или long polling
+    if BOT_MODE == 'webhook':
+        from webhook_server import serve_webhook  # aiohttp нужен только в режиме webhook
+
+        asyncio.run(serve_webhook(application, on_ready=on_webhook_ready))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,154 @@
+import io
+import re
+import csv
+import difflib
+
+# Строка ввода: "<код или название> <количество>"; количество — последнее слово строки,
+# явный разделитель — ":", ";", "=" или табуляция. Запятая и дефис разделителями не считаются:
+# "12,5" и "-5" — не целые количества, а не разделитель с числом после него.
+SEPARATOR_PATTERN = re.compile(r'[:;=\t]')
+QUANTITY_PATTERN = re.compile(r'\d+')
+# Слово, похожее на число или знак: перед количеством означает "1 2", "- 5", "12,5 3" и т.п.
+NUMERIC_TOKEN_PATTERN = re.compile(r'[+-]|[+-]?\d+(?:[.,]\d*)?')
+NAME_MATCH_CUTOFF = 0.75  # Минимальное сходство при нечётком сопоставлении названий
+MAX_COUNTS_FILE_ROWS = 5000  # Ограничение размера файла с остатками
+
+# Результат разбора массового ввода остатков
+class BulkCounts:
+    __slots__ = ("counts", "matched", "unknown", "invalid")
+
+    def __init__(self):
+        self.counts = {}  # код -> количество
+        self.matched = {}  # код -> исходный текст, если товар найден по названию
+        self.unknown = []  # ключи, не найденные в каталоге
+        self.invalid = []  # строки, которые не удалось разобрать
+
+    # Товары каталога, для которых остаток не указан
+    def missing(self, catalog):
+        return [p for p in catalog if p.code not in self.counts]
+
+    # Текст подтверждения для пользователя
+    def render(self, catalog):
+        lines = [f"Распознано позиций: {len(self.counts)} из {len(catalog)}."]
+        for code, qty in self.counts.items():
+            product = catalog.get(code)
+            source = f" ← «{self.matched[code]}»" if code in self.matched else ""
+            lines.append(f"{product.short_name} ({code}) = {qty}{source}")
+        missing = self.missing(catalog)
+        if missing:
+            lines.append("Не указаны (будут учтены как 0): " + ", ".join(f"{p.short_name} ({p.code})" for p in missing))
+        if self.unknown:
+            lines.append("Неизвестные коды/названия: " + ", ".join(self.unknown))
+        if self.invalid:
+            lines.append("Не удалось разобрать: " + "; ".join(self.invalid))
+        return "\n".join(lines)
+
+# Поиск кода товара по коду или названию (точно, затем нечётко)
+def resolve_product(key, catalog, names):
+    if key in catalog:
+        return key, False
+    lowered = key.lower()
+    if lowered in names:
+        return names[lowered], True
+    close = difflib.get_close_matches(lowered, list(names), n=1, cutoff=NAME_MATCH_CUTOFF)
+    if close:
+        return names[close[0]], True
+    return None, False
+
+# Разбор пар (ключ, количество) за один проход; повторный ключ перезаписывает количество
+def resolve_pairs(pairs, catalog):
+    result = BulkCounts()
+    names = {p.short_name.lower(): p.code for p in catalog}
+    for key, qty in pairs:
+        key = str(key).strip() if key is not None else ""
+        qty = str(qty).strip() if qty is not None else ""
+        # Числа из xlsx приходят как float: 109.0 -> 109
+        if qty.endswith(".0"):
+            qty = qty[:-2]
+        if key.endswith(".0") and key[:-2].isdigit():
+            key = key[:-2]
+        if not key or not qty.isdigit():
+            result.invalid.append(f"{key} {qty}".strip())
+            continue
+        code, fuzzy = resolve_product(key, catalog, names)
+        if code is None:
+            result.unknown.append(key)
+            continue
+        result.counts[code] = int(qty)
+        if fuzzy:
+            result.matched[code] = key
+        else:
+            result.matched.pop(code, None)
+    return result
+
+# Разбор строки ввода в (ключ, количество) или None, если строка неоднозначна: количество
+# со знаком или дробной частью, лишние числа перед количеством. Ключ, точно совпадающий
+# с кодом или названием из known (например, «Вода 0,5»), принимается как есть.
+def split_line(line, known=()):
+    separator = None
+    for separator in SEPARATOR_PATTERN.finditer(line):
+        pass
+    if separator is not None:
+        key, qty = line[:separator.start()], line[separator.end():]
+    else:
+        parts = line.rsplit(None, 1)
+        if len(parts) < 2:
+            return None
+        key, qty = parts
+    key, qty = key.strip(), qty.strip()
+    if not key or not QUANTITY_PATTERN.fullmatch(qty):
+        return None
+    words = key.split()
+    if words[-1] != key and key.lower() not in known and NUMERIC_TOKEN_PATTERN.fullmatch(words[-1]):
+        return None
+    if NUMERIC_TOKEN_PATTERN.fullmatch(key) and not key.isdigit():
+        return None
+    return key, qty
+
+# Разбор многострочного сообщения "код количество" / "название количество"
+def parse_counts_text(text, catalog):
+    pairs = []
+    invalid = []
+    known = {p.short_name.lower() for p in catalog} | {p.code.lower() for p in catalog}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        pair = split_line(line, known)
+        if pair:
+            pairs.append(pair)
+        else:
+            invalid.append(line.strip())
+    result = resolve_pairs(pairs, catalog)
+    result.invalid = invalid + result.invalid
+    return result
+
+# Разбор небольшого файла CSV/xlsx с остатками: первый столбец — код или название, второй — количество
+def parse_counts_file(data, file_name, catalog):
+    if file_name.lower().endswith(".csv"):
+        text = data.decode("utf-8-sig", errors="replace")
+        dialect = csv.Sniffer().sniff(text[:2048], delimiters=",;\t") if text.strip() else csv.excel
+        rows = list(csv.reader(io.StringIO(text), dialect))
+    else:
+        from openpyxl import load_workbook
+
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            rows = [list(row) for row in wb.active.iter_rows(max_row=MAX_COUNTS_FILE_ROWS, max_col=2, values_only=True)]
+        finally:
+            wb.close()
+    rows = [row for row in rows[:MAX_COUNTS_FILE_ROWS] if row and any(cell not in (None, "") for cell in row)]
+    # Первая строка с нечисловым количеством считается заголовком
+    if rows and (len(rows[0]) < 2 or not str(rows[0][1]).strip().replace(".0", "").isdigit()):
+        rows = rows[1:]
+    return resolve_pairs(((row[0], row[1] if len(row) > 1 else None) for row in rows), catalog)
+
+# Признак выгрузки ЕГАИС (а не файла с остатками): заголовок "Код товара" в первых строках
+def is_stock_export(data, file_name, marker="Код товара", scan_rows=10):
+    from ingest import open_rows, find_header
+
+    try:
+        _, rows = open_rows(data, file_name)
+        find_header(rows, marker, scan_rows)
+    except (KeyError, ValueError):
+        return False
+    return True
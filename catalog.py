@@ -0,0 +1,158 @@
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 10  # Порог остатка по умолчанию
+SAVE_DELAY = 2.0  # Задержка отложенного сохранения каталога, с
+
+# Товар каталога
+class Product:
+    __slots__ = ("code", "short_name", "threshold")
+
+    def __init__(self, code, short_name, threshold=DEFAULT_THRESHOLD):
+        self.code = code
+        self.short_name = short_name
+        self.threshold = threshold
+
+    def to_dict(self):
+        return {"code": self.code, "short_name": self.short_name, "threshold": self.threshold}
+
+# Каталог товаров: индекс по коду и стабильный порядок для пошагового подсчёта.
+# Изменения сохраняются в файл отложенно и атомарно (временный файл + переименование).
+class ProductCatalog:
+    def __init__(self, path, save_delay=SAVE_DELAY):
+        self.path = path
+        self.save_delay = save_delay
+        self.lock = threading.RLock()
+        self._by_code = {}
+        self._order = []
+        self._save_timer = None
+        self._dirty = False
+        self.corrupt_path = None  # Куда отложен нечитаемый файл каталога при загрузке
+
+    # Загрузка каталога из файла; товарам без порога назначается порог по умолчанию.
+    # Нечитаемый файл переименовывается в <файл>.corrupt: первое сохранение каталога
+    # (правка администратора) не должно затереть его единственную копию.
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    products = json.load(f)
+                with self.lock:
+                    self._by_code = {
+                        p["code"]: Product(p["code"], p["short_name"], p.get("threshold", DEFAULT_THRESHOLD))
+                        for p in products
+                    }
+                    self._order = list(self._by_code.values())
+                logger.info(f"Продукты загружены из {self.path}")
+            else:
+                logger.info(f"Файл {self.path} не найден, создаётся пустой список")
+                self.save()
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке продуктов: {e}")
+            self.set_aside()
+        return self
+
+    # Перенос повреждённого файла каталога в <файл>.corrupt (существующий не перезаписывается)
+    def set_aside(self):
+        path = f"{self.path}.corrupt"
+        number = 1
+        while os.path.exists(path):
+            path = f"{self.path}.corrupt.{number}"
+            number += 1
+        try:
+            os.replace(self.path, path)
+        except OSError as e:
+            logger.error(f"Не удалось отложить повреждённый файл {self.path}: {e}")
+            return
+        self.corrupt_path = path
+        logger.error(f"Повреждённый файл продуктов перенесён в {path}; каталог пуст до восстановления")
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __getitem__(self, index):
+        return self._order[index]
+
+    def __contains__(self, code):
+        return code in self._by_code
+
+    # Неизменяемый снимок порядка товаров: сессия подсчёта не сбивается при правках каталога
+    def snapshot(self):
+        return tuple(self._order)
+
+    # Товар по коду или None
+    def get(self, code):
+        return self._by_code.get(code)
+
+    # Добавление товара; False, если товар с таким кодом уже есть
+    def add(self, code, short_name, threshold=DEFAULT_THRESHOLD):
+        with self.lock:
+            if code in self._by_code:
+                return False
+            product = Product(code, short_name, threshold)
+            self._by_code[code] = product
+            self._order = self._order + [product]
+        self.schedule_save()
+        return True
+
+    # Удаление товара; False, если товар не найден
+    def remove(self, code):
+        with self.lock:
+            product = self._by_code.pop(code, None)
+            if product is None:
+                return False
+            self._order = [p for p in self._order if p is not product]
+        self.schedule_save()
+        return True
+
+    # Изменение порога; возвращает товар или None, если он не найден
+    def set_threshold(self, code, threshold):
+        with self.lock:
+            product = self._by_code.get(code)
+            if product is None:
+                return None
+            product.threshold = threshold
+        self.schedule_save()
+        return product
+
+    # Отложенное сохранение: серия правок в течение save_delay записывается один раз
+    def schedule_save(self):
+        with self.lock:
+            self._dirty = True
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    # Немедленное сохранение отложенных изменений
+    def flush(self):
+        with self.lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if self._dirty:
+                self.save()
+
+    # Атомарная запись каталога: временный файл в том же каталоге + os.replace
+    def save(self):
+        with self.lock:
+            data = [p.to_dict() for p in self._order]
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+                logger.info(f"Продукты сохранены в {self.path}")
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении продуктов: {e}")
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Лимит, передаваемый PTB: сам PTB обновления не ограничивает (каждое сразу получает свою задачу),
+# лимит одновременной обработки держит PerChatUpdateProcessor
+UNBOUNDED_UPDATES = 2 ** 16
+
+# Параллельная обработка обновлений с сохранением порядка внутри одного чата:
+# обновления разных чатов обрабатываются одновременно (не более max_concurrent_updates),
+# а обновления одного чата — строго по очереди поступления. Обновление ждёт своей очереди
+# в чате, не занимая места в общем лимите: место берётся, только когда подошла очередь чата,
+# поэтому долгие обновления одного чата и нажатия в нём не задерживают другие чаты.
+# Построен только на публичных точках расширения PTB (do_process_update), без process_update и _semaphore.
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должно быть положительным")
+        super().__init__(UNBOUNDED_UPDATES)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}
+        self._lock_users = {}
+
+    # Ключ очереди: чат, а для обновлений без чата — пользователь
+    @staticmethod
+    def _chat_key(update):
+        chat = getattr(update, "effective_chat", None)
+        if chat:
+            return chat.id
+        user = getattr(update, "effective_user", None)
+        if user:
+            return ("user", user.id)
+        return None
+
+    # Сначала очередь чата, затем место в общем лимите: ожидание очереди места не занимает
+    async def do_process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()  # asyncio.Lock пропускает ожидающих по порядку
+        self._lock_users[key] = self._lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._slots:
+                    await coroutine
+        finally:
+            # Блокировка чата удаляется, когда его обновлений больше нет в очереди
+            self._lock_users[key] -= 1
+            if not self._lock_users[key]:
+                del self._lock_users[key]
+                del self._chat_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,53 @@
+# Расхождение по товару между фактическим остатком и ЕГАИС
+class Discrepancy:
+    __slots__ = ("code", "name", "actual", "egais")
+
+    def __init__(self, code, name, actual, egais):
+        self.code = code
+        self.name = name
+        self.actual = actual
+        self.egais = egais
+
+    @property
+    def diff(self):
+        return self.actual - self.egais
+
+    # Строка для пользователя: "Название (код): Факт = X, ЕГАИС = Y, Расхождение = Z"
+    def render(self):
+        return f"{self.name} ({self.code}): Факт = {self.actual}, ЕГАИС = {self.egais}, Расхождение = {self.diff}"
+
+    # Строка для сводки в группу: "Название: ЕГАИС = Y, Факт = X, Расхождение = Z"
+    def render_summary(self):
+        return f"{self.name}: ЕГАИС = {self.egais}, Факт = {self.actual}, Расхождение = {self.diff}"
+
+# Таблица расхождений по коду товара. Изменение одного остатка обновляет
+# только его запись; текст формируется лишь при отправке сообщения.
+class DiscrepancyTable:
+    def __init__(self):
+        self._items = {}
+
+    # Учёт остатков товара: запись добавляется, обновляется или удаляется, если расхождения нет
+    def set(self, code, name, actual, egais):
+        if actual == egais:
+            self._items.pop(code, None)
+            return
+        item = self._items.get(code)
+        if item is None:
+            self._items[code] = Discrepancy(code, name, actual, egais)
+        else:
+            item.name, item.actual, item.egais = name, actual, egais
+
+    def __contains__(self, code):
+        return code in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def render(self):
+        return "\n".join(item.render() for item in self)
+
+    def render_summary(self):
+        return "\n".join(item.render_summary() for item in self)
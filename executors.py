@@ -0,0 +1,82 @@
+import os
+import asyncio
+import logging
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Размеры пулов: потоки для запросов к Google Sheets, потоки для локальной работы
+# (журнал, хэши выгрузок, SQLite, графики, прогноз), процессы для разбора выгрузок
+load_dotenv()
+SHEETS_IO_WORKERS = int(os.getenv("SHEETS_IO_WORKERS", "4"))
+LOCAL_IO_WORKERS = int(os.getenv("LOCAL_IO_WORKERS", "4"))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "2"))
+
+_sheets_executor = None
+_local_executor = None
+_parse_executor = None
+
+# Признак остановки бота: паузы повторов и ожидание квоты Google Sheets прерываются сразу
+sheets_stopping = threading.Event()
+
+# Пул потоков для блокирующих вызовов gspread. Потоки могут подолгу ждать квоту и повторы
+# после 429, поэтому локальная работа идёт в отдельном пуле и их не ждёт.
+def get_sheets_executor():
+    global _sheets_executor
+    if _sheets_executor is None:
+        sheets_stopping.clear()
+        _sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_IO_WORKERS, thread_name_prefix="sheets-io")
+        logger.info(f"Создан пул потоков Google Sheets: {SHEETS_IO_WORKERS}")
+    return _sheets_executor
+
+# Пул потоков для быстрой блокирующей локальной работы: fsync журнала, SQLite, кэш выгрузок, графики
+def get_local_executor():
+    global _local_executor
+    if _local_executor is None:
+        _local_executor = ThreadPoolExecutor(max_workers=LOCAL_IO_WORKERS, thread_name_prefix="local-io")
+        logger.info(f"Создан пул потоков локальных операций: {LOCAL_IO_WORKERS}")
+    return _local_executor
+
+# Пул процессов для разбора Excel (spawn: дочерние процессы не наследуют потоки бота)
+def get_parse_executor():
+    global _parse_executor
+    if _parse_executor is None:
+        _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"Создан пул процессов разбора файлов: {PARSE_WORKERS}")
+    return _parse_executor
+
+# Выполнение блокирующего вызова Google Sheets вне цикла событий
+async def run_sheets(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_sheets_executor(), functools.partial(func, *args, **kwargs))
+
+# Выполнение блокирующей локальной операции (диск, SQLite, расчёты) вне цикла событий
+async def run_local(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_local_executor(), functools.partial(func, *args, **kwargs))
+
+# Разбор файла в отдельном процессе; func и аргументы должны быть сериализуемы pickle
+async def run_parse(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_parse_executor(), func, *args)
+
+# Остановка пулов при завершении бота. Запросы к Google Sheets не ждутся: паузы повторов прерываются,
+# очередь отменяется, неотправленные строки остаются в журнале до следующего запуска.
+# Локальный пул дожидается завершения, чтобы записи журнала и SQLite не оборвались.
+def shutdown_executors(wait=True):
+    global _sheets_executor, _local_executor, _parse_executor
+    if _sheets_executor is not None:
+        sheets_stopping.set()
+        _sheets_executor.shutdown(wait=False, cancel_futures=True)
+        _sheets_executor = None
+    if _local_executor is not None:
+        _local_executor.shutdown(wait=wait)
+        _local_executor = None
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=wait)
+        _parse_executor = None
+    logger.info("Пулы выполнения остановлены")
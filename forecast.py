@@ -0,0 +1,168 @@
+import os
+import datetime
+import logging
+from dotenv import load_dotenv
+from history_store import history_store
+
+logger = logging.getLogger(__name__)
+
+# Параметры прогноза расхода
+load_dotenv()
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "28"))  # За сколько последних дней считается средний расход
+FORECAST_HISTORY_DAYS = int(os.getenv("FORECAST_HISTORY_DAYS", "60"))  # Сколько дней истории загружается (окно и интервал сверок)
+FORECAST_COUNT_INTERVAL = float(os.getenv("FORECAST_COUNT_INTERVAL", "0"))  # Дней до следующей сверки; 0 — медиана интервалов между сверками
+DEFAULT_COUNT_INTERVAL = 7  # Интервал сверок, если истории для его оценки мало, дней
+
+# Прогноз по товару: оценка текущего остатка (None — товара нет в истории), средний расход в день (None — нет данных),
+# на сколько дней хватит остатка и через сколько дней он опустится ниже порога
+class ProductForecast:
+    __slots__ = ("code", "name", "threshold", "stock", "rate", "cover_days", "threshold_days", "at_risk")
+
+    def __init__(self, code, name, threshold, stock, rate, cover_days, threshold_days, at_risk):
+        self.code = code
+        self.name = name
+        self.threshold = threshold
+        self.stock = stock
+        self.rate = rate
+        self.cover_days = cover_days
+        self.threshold_days = threshold_days
+        self.at_risk = at_risk
+
+    # Строка для /forecast: "Название: остаток X, расход Y/день, хватит на Z дн."
+    def render(self):
+        if self.stock is None:
+            return f"{self.name}: нет истории сверок"
+        line = f"{self.name}: остаток {self.stock:g}"
+        if self.rate is None:
+            return line + ", нет данных о расходе"
+        if self.rate == 0:
+            return line + ", расхода нет"
+        line += f", расход {self.rate:.1f}/день, хватит на {self.cover_days:.0f} дн."
+        if self.stock < self.threshold:
+            line += " ⚠️ ниже порога"
+        elif self.at_risk:
+            line += f" ⚠️ ниже порога через {self.threshold_days:.0f} дн."
+        return line
+
+    # Строка для сводки в группу: "Название: остаток X, порог Y через Z дн."
+    def render_summary(self):
+        return f"{self.name}: остаток {self.stock:g}, порог {self.threshold} через {self.threshold_days:.0f} дн."
+
+# Прогноз по каталогу. Товары под угрозой — те, что сейчас не ниже порога,
+# но при текущем расходе опустятся ниже него до следующей сверки.
+class StockForecast:
+    def __init__(self, items, count_interval):
+        self.items = items
+        self.count_interval = count_interval
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def at_risk(self):
+        return [item for item in self.items if item.at_risk]
+
+    def render(self):
+        lines = [f"📉 Прогноз расхода (следующая сверка примерно через {self.count_interval:.0f} дн.):"]
+        lines.extend(item.render() for item in self.items)
+        return "\n".join(lines)
+
+    # Блок для сводки в группу; пустая строка, если угрозы нет
+    def render_summary(self):
+        items = sorted(self.at_risk(), key=lambda item: item.threshold_days)
+        if not items:
+            return ""
+        return (
+            f"📉 До следующей сверки (~{self.count_interval:.0f} дн.) опустятся ниже порога:\n"
+            + "\n".join(item.render_summary() for item in items)
+        )
+
+# Прогноз по истории всех товаров одним расчётом над столбцами (без запроса на каждый товар).
+# codes, dates, stocks — столбцы истории (код, дата 'YYYY-MM-DD', фактический остаток);
+# current — {код: остаток} только что подсчитанных остатков (иначе берётся последняя запись
+# истории за вычетом расхода с её даты). Расход считается по соседним сверкам товара в окне
+# FORECAST_WINDOW_DAYS: уменьшение остатка, делённое на дни между сверками; интервалы,
+# в которых остаток вырос (поставка), не учитываются.
+def compute_forecast(products, codes, dates, stocks, today=None, current=None, window_days=FORECAST_WINDOW_DAYS):
+    import numpy as np  # numpy загружается только при расчёте прогноза
+
+    products = list(products)
+    count = len(products)
+    today_day = np.datetime64(today or datetime.date.today().isoformat(), "D").astype(np.int64)
+
+    # Номер товара в каталоге для каждой записи (-1 — кода нет в каталоге)
+    if len(codes):
+        unique_codes, inverse = np.unique(np.array(codes, dtype=str), return_inverse=True)
+        positions = {p.code: i for i, p in enumerate(products)}
+        product = np.array([positions.get(code, -1) for code in unique_codes], dtype=np.int64)[inverse]
+    else:
+        product = np.empty(0, np.int64)
+    days = np.array(dates, dtype="datetime64[D]").astype(np.int64) if len(dates) else np.empty(0, np.int64)
+    values = np.asarray(stocks, dtype=np.float64) if len(stocks) else np.empty(0, np.float64)
+    known = product >= 0
+    product, days, values = product[known], days[known], values[known]
+    order = np.lexsort((days, product))
+    product, days, values = product[order], days[order], values[order]
+
+    # Пары соседних сверок одного товара, закончившиеся в окне, без поставок между ними
+    same = product[1:] == product[:-1]
+    gaps = days[1:] - days[:-1]
+    drops = values[:-1] - values[1:]
+    used = same & (gaps > 0) & (drops >= 0) & (days[1:] > today_day - window_days)
+    consumed = np.bincount(product[1:][used], weights=drops[used], minlength=count)
+    elapsed = np.bincount(product[1:][used], weights=gaps[used], minlength=count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(elapsed > 0, consumed / elapsed, np.nan)
+
+    # Последняя запись каждого товара
+    last = np.ones(len(product), dtype=bool)
+    last[:-1] = product[1:] != product[:-1]
+    last_stock = np.full(count, np.nan)
+    last_day = np.full(count, today_day, dtype=np.int64)
+    last_stock[product[last]] = values[last]
+    last_day[product[last]] = days[last]
+
+    if current is not None:
+        stock = np.array([float(current.get(p.code, 0) or 0) for p in products])
+    else:
+        stock = np.maximum(last_stock - np.nan_to_num(rate) * (today_day - last_day), 0)
+    threshold = np.array([float(p.threshold) for p in products])
+
+    interval = FORECAST_COUNT_INTERVAL or count_interval(days)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cover = np.where(rate > 0, stock / rate, np.inf)
+        to_threshold = np.where(rate > 0, (stock - threshold) / rate, np.inf)
+    with np.errstate(invalid="ignore"):
+        at_risk = (stock >= threshold) & (to_threshold < interval)
+
+    items = [
+        ProductForecast(
+            p.code, p.short_name, p.threshold, _stock_value(stock[i]),
+            None if np.isnan(rate[i]) else float(rate[i]), float(cover[i]), float(to_threshold[i]), bool(at_risk[i]),
+        )
+        for i, p in enumerate(products)
+    ]
+    return StockForecast(items, interval)
+
+def _stock_value(value):
+    if value != value:
+        return None
+    return int(value) if value.is_integer() else round(float(value), 2)
+
+# Интервал между сверками, дней: медиана промежутков между датами сверок в истории
+def count_interval(days):
+    import numpy as np
+
+    gaps = np.diff(np.unique(days))
+    return float(np.median(gaps)) if len(gaps) else DEFAULT_COUNT_INTERVAL
+
+# Прогноз по каталогу из локальной истории (за FORECAST_HISTORY_DAYS дней)
+def build_forecast(products, current=None, today=None, store=history_store):
+    today = today or datetime.date.today().isoformat()
+    start_date = (datetime.date.fromisoformat(today) - datetime.timedelta(days=FORECAST_HISTORY_DAYS)).isoformat()
+    codes, dates, stocks = store.columns_since(start_date)
+    forecast = compute_forecast(products, codes, dates, stocks, today, current)
+    logger.debug(f"Прогноз рассчитан: товаров {len(forecast)}, записей истории {len(codes)}")
+    return forecast
@@ -1,8 +1,14 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import logging
 from dotenv import load_dotenv
 import os
+import time
+import random
+import datetime
+import threading
+from history_store import history_store, months_between
+from metrics import metrics
+from rate_limit import TokenBucket
+from executors import sheets_stopping
 
 # Настройка логирования
 logging.basicConfig(
@@ -14,30 +20,376 @@ logger = logging.getLogger(__name__)
 # Загружаем переменные окружения
 load_dotenv()
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "60"))  # Квота записей в минуту на процесс
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))  # Квота чтений в минуту на процесс
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))  # Повторов одного вызова при 429/5xx
+SHEETS_BACKOFF_BASE = float(os.getenv("SHEETS_BACKOFF_BASE", "1"))  # Начальная пауза перед повтором, с
+SHEETS_BACKOFF_MAX = float(os.getenv("SHEETS_BACKOFF_MAX", "64"))  # Предел паузы перед повтором, с
+SHEETS_PARTITION = os.getenv("SHEETS_PARTITION", "none")  # Разбиение истории: none — всё в sheet1, month — лист на месяц
+MONTH_TAB_ROWS = 1000  # Начальный размер листа месяца; append расширяет его по мере необходимости
+SHEET_HEADER = ["Дата", "Код", "Название", "Факт", "ЕГАИС", "Расхождение"]
+
+# Общие для всех потоков ограничители частоты записей и чтений Google Sheets
+# (квоты API считаются раздельно для записи и чтения)
+WRITE_CALLS = {"append_row", "append_rows", "update", "batch_update", "add_worksheet"}
+sheets_write_limiter = TokenBucket(SHEETS_WRITES_PER_MINUTE / 60, capacity=max(1, SHEETS_WRITES_PER_MINUTE // 6))
+sheets_read_limiter = TokenBucket(SHEETS_READS_PER_MINUTE / 60, capacity=max(1, SHEETS_READS_PER_MINUTE // 6))
+
+# Временные ошибки API, после которых вызов повторяется. Добавление строк при 5xx
+# не повторяется: запрос мог быть выполнен, и повтор продублировал бы строки
+# (такие строки отправит журнал после перестроения индекса). 429 означает, что запрос отклонён.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+APPEND_CALLS = {"append_row", "append_rows"}
+
+# HTTP-статус ошибки gspread (APIError) или None для прочих исключений
+def api_error_status(error):
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+# Пауза из заголовка Retry-After (секунды или HTTP-дата), с; None, если заголовка нет
+def retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Пауза перед повтором attempt (с нуля): экспоненциальная с полным случайным разбросом,
+# чтобы потоки и процессы, получившие 429 одновременно, не повторяли запросы синхронно
+def backoff_delay(attempt):
+    return random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+
+# Вызов прерван остановкой бота. Считается сетевой ошибкой: строки журнала остаются
+# неотправленными и будут записаны после перезапуска
+class SheetsStopped(ConnectionError):
+    pass
+
+# Вызов метода gspread с учётом количества, длительности и ошибок в метриках.
+# Каждый вызов проходит через общий ограничитель частоты; при 429/5xx вызов повторяется
+# с паузой не короче Retry-After, после SHEETS_MAX_RETRIES повторов ошибка выбрасывается.
+# Ожидание квоты и паузы повторов прерываются при остановке бота (SheetsStopped).
+def sheets_call(name, func, *args, **kwargs):
+    limiter = sheets_write_limiter if name in WRITE_CALLS else sheets_read_limiter
+    attempt = 0
+    while True:
+        waited = limiter.acquire(cancel=sheets_stopping)
+        if waited is None:
+            raise SheetsStopped(f"Google Sheets {name}: бот останавливается")
+        if waited:
+            metrics.inc("sheets_throttled_total", name)
+            metrics.observe("sheets_throttle_wait_seconds", name, waited)
+        metrics.inc("sheets_calls_total", name)
+        try:
+            with metrics.timer("sheets_call_seconds", name):
+                return func(*args, **kwargs)
+        except Exception as e:
+            metrics.inc("sheets_errors_total", name)
+            status = api_error_status(e)
+            if (
+                status not in RETRY_STATUSES
+                or (status != 429 and name in APPEND_CALLS)
+                or attempt >= SHEETS_MAX_RETRIES
+            ):
+                raise
+            delay = max(backoff_delay(attempt), retry_after(e) or 0.0)
+            metrics.inc("sheets_retries_total", name)
+            metrics.observe("sheets_backoff_seconds", name, delay)
+            logger.warning(f"Google Sheets {name}: ошибка {status}, повтор {attempt + 1}/{SHEETS_MAX_RETRIES} через {delay:.1f} с")
+            if sheets_stopping.wait(delay):
+                raise SheetsStopped(f"Google Sheets {name}: бот останавливается") from e
+            attempt += 1
 
 # Настройка авторизации для Google Sheets
 def setup_google_sheets():
+    # gspread и oauth2client импортируются при первом подключении, чтобы не замедлять запуск бота
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
     try:
         scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
         creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
-        client = gspread.authorize(creds)
-        sheet = client.open_by_key(SPREADSHEET_ID).sheet1
+        client = sheets_call("authorize", gspread.authorize, creds)
+        spreadsheet = sheets_call("open_by_key", client.open_by_key, SPREADSHEET_ID)
         logger.info("Google Sheets успешно настроен")
-        return sheet
+        return spreadsheet
     except Exception as e:
         logger.error(f"Ошибка при настройке Google Sheets: {e}")
         raise
 
+_spreadsheet = None
+_sheet = None
+_sheet_lock = threading.Lock()
+
+# Таблица Google Sheets с ленивой авторизацией: подключение выполняется при первом обращении
+# (в потоке пула, а не при импорте) и кэшируется; после ошибки следующий вызов повторит попытку.
+def get_spreadsheet():
+    global _spreadsheet
+    if _spreadsheet is None:
+        with _sheet_lock:
+            if _spreadsheet is None:
+                _spreadsheet = setup_google_sheets()
+    return _spreadsheet
+
+# Первый лист таблицы (вся история, если разбиение по месяцам не включено)
+def get_sheet():
+    global _sheet
+    if _sheet is None:
+        spreadsheet = get_spreadsheet()
+        with _sheet_lock:
+            if _sheet is None:
+                _sheet = sheets_call("get_worksheet", spreadsheet.get_worksheet, 0)
+    return _sheet
+
+# Индекс расположения строк листа: (дата, код) -> номер строки.
+# Строится одним чтением столбцов A:B раз в день (или лениво при первом обращении)
+# и пополняется при добавлении строк, чтобы обновление не требовало findall по всему листу.
+class RowLocator:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = {}
+        self.built_on = None
+
+    # Перечитывание столбцов дата/код и перестроение индекса
+    def rebuild(self, sheet):
+        columns = sheets_call("get", sheet.get, 'A:B')
+        index = {}
+        for row_number, row in enumerate(columns, start=1):
+            if len(row) >= 2:
+                index.setdefault((row[0], row[1]), row_number)
+        with self.lock:
+            self.index = index
+            self.built_on = datetime.date.today()
+        logger.info(f"Индекс строк Google Sheets перестроен: {len(index)} записей")
+
+    # Номера строк для набора ключей (дата, код): {ключ: номер строки} для найденных.
+    # Устаревший индекс перестраивается; при промахе лист перечитывается один раз,
+    # т.к. строка могла появиться в обход индекса. Номера, взятые из индекса без перечитывания,
+    # сверяются с ключевыми ячейками листа: строки могли удалить или пересортировать вручную.
+    def locate_many(self, sheet, keys):
+        rebuilt = False
+        if self.built_on != datetime.date.today():
+            self.rebuild(sheet)
+            rebuilt = True
+        with self.lock:
+            found = {key: self.index[key] for key in keys if key in self.index}
+        if len(found) < len(keys) and not rebuilt:
+            self.rebuild(sheet)
+            rebuilt = True
+            with self.lock:
+                found = {key: self.index[key] for key in keys if key in self.index}
+        if found and not rebuilt and not self.verify(sheet, found):
+            self.rebuild(sheet)
+            with self.lock:
+                found = {key: self.index[key] for key in keys if key in self.index}
+        return found
+
+    # Проверка, что в строках found по-прежнему лежат их ключи: дата и код читаются одним batch_get
+    def verify(self, sheet, found):
+        cells = sheets_call("batch_get", sheet.batch_get, [f"A{row}:B{row}" for row in found.values()])
+        stale = [key for key, values in zip(found, cells) if not values or tuple(values[0][:2]) != key]
+        if stale:
+            metrics.inc("sheets_row_index_total", "stale", len(stale))
+            logger.warning(f"Индекс строк Google Sheets устарел ({len(stale)} строк сдвинуто), перестраивается")
+        return not stale
+
+    # Номер строки для (дата, код) или None
+    def locate(self, sheet, date, code):
+        return self.locate_many(sheet, [(date, code)]).get((date, code))
+
+    # Сброс индекса: следующий поиск перечитает лист
+    def invalidate(self):
+        with self.lock:
+            self.built_on = None
+
+    # Учёт добавленных строк по ответу API append (updates.updatedRange)
+    def record_append(self, response, rows):
+        from gspread.utils import a1_to_rowcol, get_a1_from_absolute_range
+
+        try:
+            updated_range = get_a1_from_absolute_range(response["updates"]["updatedRange"])
+            first_row, _ = a1_to_rowcol(updated_range.split(":")[0])
+        except (KeyError, TypeError, ValueError):
+            # Номер строки неизвестен — перестроим индекс при следующем поиске
+            self.invalidate()
+            return
+        with self.lock:
+            for offset, row in enumerate(rows):
+                self.index.setdefault((row[0], row[1]), first_row + offset)
+
+_locators = {}
+_locators_lock = threading.Lock()
+
+# Индекс строк своего листа: у каждого листа месяца — отдельный
+def get_locator(sheet):
+    with _locators_lock:
+        locator = _locators.get(sheet.title)
+        if locator is None:
+            locator = _locators[sheet.title] = RowLocator()
+        return locator
+
+# Название листа месяца для даты 'YYYY-MM-DD': 'YYYY-MM'
+def month_title(date):
+    return str(date)[:7]
+
+def is_month_title(title):
+    try:
+        datetime.datetime.strptime(title, '%Y-%m')
+    except ValueError:
+        return False
+    return len(title) == 7
+
+# Листы месяцев таблицы. Список листов читается один раз; лист месяца создаётся
+# при первой записи за этот месяц (с заголовком), так что каждый лист остаётся небольшим.
+class MonthTabs:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tabs = None
+
+    def _load(self, spreadsheet):
+        self.tabs = {ws.title: ws for ws in sheets_call("worksheets", spreadsheet.worksheets)}
+
+    # Лист месяца по названию 'YYYY-MM' или None; create=True создаёт недостающий лист
+    def get(self, title, create=False):
+        with self.lock:
+            if self.tabs is None:
+                self._load(get_spreadsheet())
+            worksheet = self.tabs.get(title)
+            if worksheet is None and create:
+                worksheet = self._create(title)
+            return worksheet
+
+    def _create(self, title):
+        spreadsheet = get_spreadsheet()
+        try:
+            worksheet = sheets_call(
+                "add_worksheet", spreadsheet.add_worksheet, title=title, rows=MONTH_TAB_ROWS, cols=len(SHEET_HEADER)
+            )
+        except Exception:
+            # Лист мог создать другой процесс — перечитываем список листов
+            self._load(spreadsheet)
+            worksheet = self.tabs.get(title)
+            if worksheet is None:
+                raise
+            return worksheet
+        sheets_call("append_row", worksheet.append_row, SHEET_HEADER)
+        self.tabs[title] = worksheet
+        logger.info(f"Создан лист месяца {title}")
+        return worksheet
+
+    # Названия существующих листов месяцев по возрастанию
+    def titles(self):
+        with self.lock:
+            if self.tabs is None:
+                self._load(get_spreadsheet())
+            return sorted(title for title in self.tabs if is_month_title(title))
+
+    def invalidate(self):
+        with self.lock:
+            self.tabs = None
+
+month_tabs = MonthTabs()
+
+# Запись строк сверки с маршрутизацией по дате: при разбиении по месяцам каждая строка
+# попадает в лист своего месяца, иначе — в sheet1. При ошибке выбрасывает исключение.
+def upsert_by_date(rows):
+    if SHEETS_PARTITION != "month":
+        upsert_rows(get_sheet(), rows)
+        return
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(month_title(row[0]), []).append(row)
+    for title, month_rows in by_month.items():
+        upsert_rows(month_tabs.get(title, create=True), month_rows)
+
+# Запись набора строк с идемпотентностью по (дата, код): существующие строки обновляются
+# одним batch_update, новые добавляются через append_rows. При ошибке выбрасывает исключение.
+def upsert_rows(sheet, rows):
+    latest = {}
+    for row in rows:
+        latest[(row[0], row[1])] = row
+    locator = get_locator(sheet)
+    located = locator.locate_many(sheet, list(latest))
+
+    updates = [
+        {'range': f'A{row_number}:F{row_number}', 'values': [latest[key]]}
+        for key, row_number in located.items()
+    ]
+    if updates:
+        try:
+            sheets_call("batch_update", sheet.batch_update, updates)
+        except Exception:
+            locator.invalidate()
+            raise
+        history_store.record_rows([update['values'][0] for update in updates])
+        logger.info(f"Обновлено {len(updates)} строк в Google Sheets")
+
+    new_rows = [row for key, row in latest.items() if key not in located]
+    failed_chunks = add_rows_to_sheet(sheet, new_rows)
+    if failed_chunks:
+        raise failed_chunks[0][2]
+
+# Максимальное количество строк в одном запросе append_rows
+APPEND_CHUNK_SIZE = int(os.getenv("SHEETS_APPEND_CHUNK_SIZE", "500"))
+
+# Формирование строки сверки для Google Sheet
+def build_row(date, code, product_name, actual_stock, egais_stock):
+    discrepancy = actual_stock - egais_stock
+    return [date, code, product_name, actual_stock, egais_stock, discrepancy]
+
 # Функция для добавления новой строки в Google Sheet
 def add_to_sheet(sheet, date, code, product_name, actual_stock, egais_stock):
     try:
         # Формируем данные для новой строки
-        discrepancy = actual_stock - egais_stock
-        row = [date, code, product_name, actual_stock, egais_stock, discrepancy]
+        row = build_row(date, code, product_name, actual_stock, egais_stock)
         
         # Добавляем строку в Google Sheet
-        sheet.append_row(row)
+        response = sheets_call("append_row", sheet.append_row, row)
+        get_locator(sheet).record_append(response, [row])
+        history_store.record_rows([row])
         logger.info(f"Добавлена новая строка в Google Sheets: {code} - {product_name}, Факт: {actual_stock}, ЕГАИС: {egais_stock}")
     except Exception as e:
         logger.error(f"Ошибка при добавлении строки в Google Sheets: {e}")
-        raise
\ No newline at end of file
+        raise
+
+# Пакетное добавление строк в Google Sheet: один запрос append_rows на каждые chunk_size строк.
+# Возвращает список неудавшихся пакетов в виде (номер первой строки, строки, ошибка).
+def add_rows_to_sheet(sheet, rows, chunk_size=APPEND_CHUNK_SIZE):
+    failed_chunks = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        try:
+            response = sheets_call("append_rows", sheet.append_rows, chunk)
+            get_locator(sheet).record_append(response, chunk)
+            history_store.record_rows(chunk)
+            logger.info(f"Добавлено {len(chunk)} строк в Google Sheets (строки {start + 1}-{start + len(chunk)})")
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном добавлении строк {start + 1}-{start + len(chunk)} в Google Sheets: {e}")
+            failed_chunks.append((start, chunk, e))
+    return failed_chunks
+
+# Пересинхронизация локальной истории с Google Sheets. При разбиении по месяцам читаются
+# только листы месяцев, пересекающихся с периодом start_date..end_date (без периода — все);
+# без разбиения sheet1 перечитывается целиком.
+def resync_history(start_date=None, end_date=None):
+    if SHEETS_PARTITION != "month":
+        sheet = get_sheet()
+        return history_store.resync(sheets_call("get_all_values", sheet.get_all_values))
+    if start_date is None:
+        months = month_tabs.titles()
+    else:
+        months = months_between(start_date, end_date)
+    rows = []
+    for title in months:
+        worksheet = month_tabs.get(title)
+        if worksheet is not None:
+            rows.extend(sheets_call("get_all_values", worksheet.get_all_values))
+    return history_store.resync(rows, months=None if start_date is None else months)
@@ -0,0 +1,133 @@
+import io
+import os
+import logging
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from metrics import metrics
+from history_store import history_store
+
+logger = logging.getLogger(__name__)
+
+# Вывод /history: chart — PNG-график одним сообщением, text — строки истории текстом.
+# Размер LRU-кэша готовых графиков.
+load_dotenv()
+HISTORY_OUTPUT = os.getenv("HISTORY_OUTPUT", "chart")
+HISTORY_CHART_CACHE_SIZE = int(os.getenv("HISTORY_CHART_CACHE_SIZE", "64"))
+CHART_SIZE = (8, 4.5)  # Размер графика, дюймы
+CHART_DPI = 100
+
+# Установлен ли matplotlib (без него история выводится текстом)
+def charts_available():
+    import importlib.util
+
+    return importlib.util.find_spec("matplotlib") is not None
+
+# Загрузка matplotlib заранее (около секунды), чтобы первый запрос графика её не ждал
+# (matplotlib.dates загружается вместе с matplotlib.figure).
+# Вызывается в пуле потоков после запуска бота: время старта не увеличивается.
+def preload_charts():
+    import importlib
+
+    for module in ("matplotlib.figure", "matplotlib.backends.backend_agg"):
+        importlib.import_module(module)
+
+# График истории товара: факт и ЕГАИС линиями, расхождение столбцами. Возвращает PNG (bytes).
+# Рисуется без pyplot и без дисплея (Agg), поэтому безопасен в потоках пула.
+def render_history_chart(title, rows):
+    import datetime
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.dates import AutoDateLocator, DateFormatter
+
+    dates = [datetime.date.fromisoformat(date) for date, _, _ in rows]
+    actual = [actual for _, actual, _ in rows]
+    egais = [egais for _, _, egais in rows]
+    discrepancy = [a - e for a, e in zip(actual, egais)]
+
+    figure = Figure(figsize=CHART_SIZE, dpi=CHART_DPI)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.bar(
+        dates, discrepancy, width=0.6, label="Расхождение", alpha=0.45,
+        color=["tab:red" if value < 0 else "tab:green" for value in discrepancy],
+    )
+    axes.plot(dates, actual, marker="o", label="Факт", color="tab:blue")
+    axes.plot(dates, egais, marker="s", linestyle="--", label="ЕГАИС", color="tab:orange")
+    axes.axhline(0, color="grey", linewidth=0.8)
+    axes.xaxis.set_major_locator(AutoDateLocator(maxticks=10))
+    axes.xaxis.set_major_formatter(DateFormatter("%d.%m"))
+    axes.set_title(title)
+    axes.grid(True, alpha=0.3)
+    axes.legend(loc="upper left", framealpha=0.8)
+    figure.subplots_adjust(left=0.08, right=0.98, top=0.92, bottom=0.1)  # Фиксированные поля: без повторной отрисовки tight_layout
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+# Готовый график: PNG и file_id Telegram после первой отправки (повторно файл не загружается)
+class HistoryChart:
+    __slots__ = ("code", "png", "caption", "file_id")
+
+    def __init__(self, code, png, caption):
+        self.code = code
+        self.png = png
+        self.caption = caption
+        self.file_id = None
+
+    # Что передать в send_photo: file_id уже загруженного файла или сам PNG
+    @property
+    def photo(self):
+        return self.file_id or self.png
+
+    # Запоминание file_id после отправки (колбэк future из outbox.send_photo);
+    # если отправка по file_id не удалась, в следующий раз загружается PNG
+    def remember_upload(self, future):
+        message = None if future.cancelled() else future.result()
+        photos = getattr(message, "photo", None)
+        self.file_id = photos[-1].file_id if photos else None
+
+# LRU-кэш графиков по ключу (код, начало периода, конец периода, время последней записи истории товара).
+# Запись строк товара удаляет его графики сразу (подписка на history_store), а время записи в ключе
+# не даёт отдать устаревший график, построенный одновременно с записью.
+class ChartCache:
+    def __init__(self, max_size=HISTORY_CHART_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            chart = self._items.get(key)
+            if chart is not None:
+                self._items.move_to_end(key)
+        metrics.inc("history_chart_cache_total", "miss" if chart is None else "hit")
+        return chart
+
+    def put(self, key, chart):
+        with self.lock:
+            self._items[key] = chart
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return chart
+
+    # Удаление графиков товаров codes (None — всех)
+    def invalidate(self, codes):
+        with self.lock:
+            stale = [key for key in self._items if codes is None or key[0] in codes]
+            for key in stale:
+                del self._items[key]
+        if stale:
+            metrics.inc("history_chart_cache_total", "invalidated", len(stale))
+
+    def __len__(self):
+        return len(self._items)
+
+chart_cache = ChartCache()
+history_store.on_write(chart_cache.invalidate)
+
+# Ключ кэша для графика истории товара за период start_date < date <= end_date
+def chart_key(code, start_date, end_date):
+    return (code, start_date, end_date, history_store.last_write(code))
@@ -0,0 +1,158 @@
+import os
+import time
+import sqlite3
+import datetime
+import logging
+import threading
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Файл локальной копии истории сверок
+load_dotenv()
+HISTORY_DB_FILE = os.getenv("HISTORY_DB_FILE", "history.db")
+
+# Месяцы 'YYYY-MM', пересекающиеся с периодом start_date..end_date (строки 'YYYY-MM-DD')
+def months_between(start_date, end_date):
+    year, month = int(start_date[:4]), int(start_date[5:7])
+    last = end_date[:7]
+    months = []
+    while True:
+        title = f"{year:04d}-{month:02d}"
+        if title > last:
+            return months
+        months.append(title)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+# Локальное зеркало истории сверок из Google Sheets.
+# Одна запись на пару (код товара, дата), индекс по (code, date) позволяет
+# отвечать на запросы /history выборкой по диапазону без обращения к API.
+class HistoryStore:
+    def __init__(self, path=HISTORY_DB_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.written_at = {}  # Код товара -> время последней записи его строк (time.time_ns)
+        self.reset_at = time.time_ns()  # Время последней пересинхронизации: меняет историю всех товаров
+        self.write_listeners = []
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "code TEXT NOT NULL, date TEXT NOT NULL, name TEXT, "
+                "actual REAL NOT NULL, egais REAL NOT NULL, "
+                "PRIMARY KEY (code, date))"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # Покрывающий индекс по дате для выборки недавней истории всех товаров (прогноз расхода)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS history_recent ON history (date, code, actual)")
+
+    # Преобразование строки листа [дата, код, название, факт, ЕГАИС, расхождение] в запись.
+    # Строки с некорректной датой или числами пропускаются.
+    @staticmethod
+    def _to_record(row):
+        if len(row) < 5:
+            return None
+        try:
+            datetime.datetime.strptime(str(row[0]), '%Y-%m-%d')
+            actual = float(row[3]) if row[3] != "" else 0
+            egais = float(row[4]) if row[4] != "" else 0
+        except (TypeError, ValueError):
+            return None
+        return (str(row[1]), str(row[0]), str(row[2]), actual, egais)
+
+    # Запись (или перезапись) строк, отправленных в Google Sheets
+    def record_rows(self, rows):
+        records = [r for r in (self._to_record(row) for row in rows) if r]
+        if not records:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?)", records)
+            written_at = time.time_ns()
+            codes = {record[0] for record in records}
+            for code in codes:
+                self.written_at[code] = written_at
+        self._notify(codes)
+
+    # Пересинхронизация с содержимым листа (результат sheet.get_all_values()).
+    # months=None — полная замена истории; иначе заменяются только записи указанных месяцев 'YYYY-MM'.
+    def resync(self, all_values, months=None):
+        records = {}
+        skipped = 0
+        for row in all_values:
+            record = self._to_record(row)
+            if record and (months is None or record[1][:7] in months):
+                records[record[:2]] = record
+            else:
+                skipped += 1
+        synced_at = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.lock, self.conn:
+            if months is None:
+                self.conn.execute("DELETE FROM history")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('synced_at', ?)", (synced_at,))
+            else:
+                self.conn.executemany("DELETE FROM history WHERE substr(date, 1, 7) = ?", [(m,) for m in months])
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)", [(f"synced_month:{m}", synced_at) for m in months]
+                )
+            self.conn.executemany("INSERT INTO history VALUES (?, ?, ?, ?, ?)", records.values())
+            self.written_at.clear()
+            self.reset_at = time.time_ns()
+        self._notify(None)
+        logger.info(f"История синхронизирована с Google Sheets: {len(records)} записей, пропущено строк: {skipped}")
+        return len(records)
+
+    # Подписка на изменения истории: listener(codes) вызывается после записи строк этих кодов,
+    # codes=None — пересинхронизация, история всех товаров могла измениться
+    def on_write(self, listener):
+        self.write_listeners.append(listener)
+
+    def _notify(self, codes):
+        for listener in self.write_listeners:
+            try:
+                listener(codes)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика записи истории: {e}")
+
+    # Время последнего изменения истории товара (time.time_ns): записи его строк или пересинхронизации
+    def last_write(self, code):
+        with self.lock:
+            return max(self.written_at.get(code, 0), self.reset_at)
+
+    # Время последней полной синхронизации или None, если её ещё не было
+    def synced_at(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'synced_at'").fetchone()
+        return row[0] if row else None
+
+    # Есть ли локальная история за период: после полной синхронизации или синхронизации всех его месяцев
+    def is_synced(self, start_date, end_date):
+        if self.synced_at() is not None:
+            return True
+        keys = [f"synced_month:{m}" for m in months_between(start_date, end_date)]
+        with self.lock:
+            found = self.conn.execute(
+                f"SELECT COUNT(*) FROM meta WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchone()[0]
+        return found == len(keys)
+
+    # История товара за период: даты start_date < date <= end_date (строки 'YYYY-MM-DD')
+    def query(self, code, start_date, end_date):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT date, actual, egais FROM history "
+                "WHERE code = ? AND date > ? AND date <= ? ORDER BY date",
+                (code, start_date, end_date)
+            ).fetchall()
+
+    # История всех товаров с даты start_date (не включая её) столбцами: (коды, даты, фактические остатки).
+    # Выборка идёт по индексу дат и не упорядочена — глубина истории не влияет на время.
+    def columns_since(self, start_date):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT code, date, actual FROM history WHERE date > ?", (start_date,)
+            ).fetchall()
+        if not rows:
+            return (), (), ()
+        return tuple(zip(*rows))
+
+history_store = HistoryStore()
@@ -0,0 +1,309 @@
+import io
+import os
+import csv
+import codecs
+import logging
+import zipfile
+import posixpath
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Порядок движков чтения выгрузок: для файла используется первый установленный движок,
+# поддерживающий его формат; при ошибке чтения пробуется следующий
+load_dotenv()
+STOCK_INGEST_ENGINES = [
+    name.strip() for name in os.getenv("STOCK_INGEST_ENGINES", "calamine,openpyxl,xlrd,odf,csv").split(",") if name.strip()
+]
+HEADER_SCAN_ROWS = 30  # В скольких первых строках искать заголовок
+CSV_SNIFF_SIZE = 64 * 1024  # По скольким байтам начала CSV определяются кодировка и разделитель
+CSV_ENCODINGS = ("utf-8-sig", "cp1251")  # Выгрузки из Windows-программ часто в cp1251
+
+# Поддерживаемые форматы выгрузки
+STOCK_EXTENSIONS = (".xlsx", ".xlsm", ".xls", ".ods", ".csv")
+
+# Формат файла: по расширению, а если оно неизвестно — по сигнатуре содержимого
+def detect_format(source, file_name=None):
+    extension = os.path.splitext(file_name or (source if isinstance(source, str) else ""))[1].lower()
+    if extension in STOCK_EXTENSIONS:
+        return extension
+    if isinstance(source, (bytes, bytearray)):
+        head = bytes(source[:8])
+    else:
+        with open(source, "rb") as f:
+            head = f.read(8)
+    if head.startswith(b"PK\x03\x04"):
+        return ".xlsx"
+    if head.startswith(b"\xd0\xcf\x11\xe0"):
+        return ".xls"
+    return ".csv"
+
+def _open(source):
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+
+# Движок calamine (Rust): xlsx, xls, ods; самый быстрый, но держит лист в памяти целиком
+def read_rows_calamine(source):
+    from python_calamine import CalamineWorkbook
+
+    sheet = CalamineWorkbook.from_object(_open(source)).get_sheet_by_index(0)
+    iter_rows = getattr(sheet, "iter_rows", None)
+    yield from iter_rows() if iter_rows else sheet.to_python()
+
+# Движок openpyxl в режиме только чтения: xlsx
+def read_rows_openpyxl(source):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(_open(source), read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+# Движок xlrd: старый формат xls
+def read_rows_xlrd(source):
+    import xlrd
+
+    if isinstance(source, (bytes, bytearray)):
+        workbook = xlrd.open_workbook(file_contents=bytes(source), on_demand=True)
+    else:
+        workbook = xlrd.open_workbook(source, on_demand=True)
+    try:
+        sheet = workbook.sheet_by_index(0)
+        for index in range(sheet.nrows):
+            yield sheet.row_values(index)
+    finally:
+        workbook.release_resources()
+
+# Движок odf (через pandas): ods
+def read_rows_odf(source):
+    import pandas as pd
+
+    df = pd.read_excel(_open(source), engine="odf", header=None, dtype=object)
+    for row in df.itertuples(index=False):
+        yield [None if value != value else value for value in row]
+
+# Кодировка CSV по началу файла: первая из CSV_ENCODINGS, которой оно декодируется
+# (неполный многобайтовый символ в конце фрагмента ошибкой не считается)
+def detect_encoding(head):
+    for encoding in CSV_ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return CSV_ENCODINGS[0]
+
+# CSV: кодировка UTF-8 или cp1251, разделитель определяется по началу файла.
+# Файл читается построчно, без загрузки целиком.
+def read_rows_csv(source):
+    binary = _open(source) if isinstance(source, (bytes, bytearray)) else open(source, "rb")
+    try:
+        head = binary.read(CSV_SNIFF_SIZE)
+        binary.seek(0)
+        encoding = detect_encoding(head)
+        text = io.TextIOWrapper(binary, encoding=encoding, errors="replace", newline="")
+        try:
+            dialect = csv.Sniffer().sniff(head.decode(encoding, errors="ignore")[:8192], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(text, dialect)
+    finally:
+        binary.close()
+
+# Движки чтения: название -> (функция, поддерживаемые форматы, читает ли строки потоково)
+ENGINES = {
+    "calamine": (read_rows_calamine, {".xlsx", ".xlsm", ".xls", ".ods"}, False),
+    "openpyxl": (read_rows_openpyxl, {".xlsx", ".xlsm"}, True),
+    "xlrd": (read_rows_xlrd, {".xls"}, False),
+    "odf": (read_rows_odf, {".ods"}, False),
+    "csv": (read_rows_csv, {".csv"}, True),
+}
+
+# Установлен ли модуль, нужный движку
+def engine_available(name):
+    import importlib.util
+
+    module = {"calamine": "python_calamine", "openpyxl": "openpyxl", "xlrd": "xlrd", "odf": "odf"}.get(name)
+    return module is None or importlib.util.find_spec(module) is not None
+
+# Движки, которыми можно прочитать формат, в порядке предпочтения;
+# streaming=True ставит вперёд движки, читающие строки потоково (память не растёт с размером файла)
+def engines_for(file_format, engines=None, streaming=False):
+    names = [
+        name for name in (engines or STOCK_INGEST_ENGINES)
+        if name in ENGINES and file_format in ENGINES[name][1] and engine_available(name)
+    ]
+    if streaming:
+        names.sort(key=lambda name: not ENGINES[name][2])
+    return names
+
+XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+DOC_RELS_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+# Ячейка xlsx со ссылкой на общую строку (sharedStrings): текст подставляется позже и только
+# для нужных ячеек, чтобы не держать в памяти всю таблицу строк
+class SharedString:
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, SharedString) and other.index == self.index
+
+    def __hash__(self):
+        return hash(("s", self.index))
+
+# Номер столбца (с нуля) по ссылке на ячейку вида "AB12"
+def column_index(reference):
+    index = 0
+    for char in reference:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - 64
+    return index - 1
+
+def _cell_value(cell, cell_type):
+    if cell_type == "inlineStr":
+        return "".join(t.text or "" for t in cell.iter(f"{XLSX_NS}t"))
+    value = cell.find(f"{XLSX_NS}v")
+    if value is None or value.text is None:
+        return None
+    if cell_type == "s":
+        return SharedString(int(value.text))
+    if cell_type in ("str", "e", "d"):
+        return value.text
+    if cell_type == "b":
+        return value.text == "1"
+    try:
+        return int(value.text)
+    except ValueError:
+        return float(value.text)
+
+# Потоковое чтение первого листа xlsx без openpyxl: XML листа разбирается по мере распаковки,
+# обработанные строки сразу удаляются из дерева, общие строки читаются только по нужным индексам.
+# Память не зависит от числа строк (openpyxl в режиме только чтения оставляет в дереве
+# пустой элемент на каждую строку и загружает все общие строки).
+class XlsxReader:
+    def __init__(self, source):
+        self.zip = zipfile.ZipFile(_open(source))
+        self.sheet_path, self.strings_path = self._locate_parts()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.zip.close()
+
+    # Пути первого листа и таблицы общих строк по workbook.xml и его связям
+    def _locate_parts(self):
+        import xml.etree.ElementTree as ET
+
+        workbook = ET.fromstring(self.zip.read("xl/workbook.xml"))
+        first_sheet = workbook.find(f"{XLSX_NS}sheets/{XLSX_NS}sheet")
+        relation_id = first_sheet.get(f"{DOC_RELS_NS}id")
+        rels = ET.fromstring(self.zip.read("xl/_rels/workbook.xml.rels"))
+        sheet_path, strings_path = None, None
+        for rel in rels.iter(f"{RELS_NS}Relationship"):
+            target = rel.get("Target", "")
+            target = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+            if rel.get("Id") == relation_id:
+                sheet_path = target
+            elif rel.get("Type", "").endswith("/sharedStrings"):
+                strings_path = target
+        if sheet_path is None:
+            raise KeyError("В книге не найден первый лист")
+        return sheet_path, strings_path
+
+    # Строки листа: (номер строки с нуля, {номер столбца: значение}); общие строки — SharedString
+    def rows(self):
+        import xml.etree.ElementTree as ET
+
+        sheet_data = None
+        next_row = 0
+        with self.zip.open(self.sheet_path) as f:
+            for event, element in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    if element.tag == f"{XLSX_NS}sheetData":
+                        sheet_data = element
+                    continue
+                if element.tag != f"{XLSX_NS}row":
+                    continue
+                number = int(element.get("r", next_row + 1)) - 1
+                next_row = number + 1
+                cells = {}
+                next_column = 0
+                for cell in element.iter(f"{XLSX_NS}c"):
+                    reference = cell.get("r")
+                    column = column_index(reference) if reference else next_column
+                    next_column = column + 1
+                    value = _cell_value(cell, cell.get("t", "n"))
+                    if value is not None:
+                        cells[column] = value
+                if sheet_data is not None:
+                    sheet_data.clear()  # Обработанные строки не накапливаются в дереве
+                yield number, cells
+
+    # Тексты общих строк по индексам: {индекс: текст}; таблица читается до последнего нужного индекса
+    def shared_strings(self, indices):
+        import xml.etree.ElementTree as ET
+
+        indices = set(indices)
+        if not indices or self.strings_path is None:
+            return {}
+        last = max(indices)
+        strings = {}
+        index = 0
+        with self.zip.open(self.strings_path) as f:
+            for event, element in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    if element.tag == f"{XLSX_NS}sst":
+                        root = element
+                    continue
+                if element.tag != f"{XLSX_NS}si":
+                    continue
+                if index in indices:
+                    # Фонетические подсказки (rPh) в текст не входят
+                    phonetic = {id(t) for rph in element.iter(f"{XLSX_NS}rPh") for t in rph.iter(f"{XLSX_NS}t")}
+                    strings[index] = "".join(t.text or "" for t in element.iter(f"{XLSX_NS}t") if id(t) not in phonetic)
+                root.clear()
+                index += 1
+                if index > last:
+                    break
+        return strings
+
+# Строки первого листа файла. Движки пробуются по порядку: если первый не смог прочитать
+# файл до выдачи первой строки, используется следующий. Возвращает (движок, итератор строк).
+def open_rows(source, file_name=None, engines=None, streaming=False):
+    file_format = detect_format(source, file_name)
+    candidates = engines_for(file_format, engines, streaming)
+    if not candidates:
+        raise ValueError(f"Нет установленного движка для формата {file_format}")
+    error = None
+    for name in candidates:
+        rows = ENGINES[name][0](source)
+        try:
+            first = next(rows, None)
+        except Exception as e:
+            logger.warning(f"Движок {name} не смог прочитать файл ({file_format}): {e}")
+            error = e
+            continue
+        return name, _chain(first, rows)
+    raise error
+
+def _chain(first, rows):
+    if first is not None:
+        yield first
+    yield from rows
+
+# Поиск строки заголовка: первая строка, в которой есть ячейка marker.
+# Возвращает (номер строки с нуля, {название столбца: индекс}) и оставляет rows на следующей строке.
+def find_header(rows, marker, scan_rows=HEADER_SCAN_ROWS):
+    for number, row in enumerate(rows):
+        if number >= scan_rows:
+            break
+        names = [str(cell).strip() if cell is not None else "" for cell in row]
+        if marker in names:
+            return number, {name: index for index, name in reversed(list(enumerate(names))) if name}
+    raise KeyError(f"Не найден заголовок «{marker}» в первых {scan_rows} строках файла.")
@@ -0,0 +1,156 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+import contextlib
+from collections import deque
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Настройки экспорта метрик
+load_dotenv()
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Порт отдельного сервера /metrics (в обоих режимах); 0 — не запускать
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")  # Адрес сервера /metrics; 127.0.0.1 — только локальный сбор
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "0"))  # Период сводки в лог, с; 0 — не писать
+METRICS_PREFIX = "stockbot"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Границы гистограмм, с
+SAMPLE_WINDOW = 1000  # Сколько последних замеров хранить для расчёта p50/p95
+
+# Гистограмма длительностей: накопительные корзины для Prometheus и окно последних замеров для квантилей
+class Histogram:
+    __slots__ = ("bucket_counts", "count", "sum", "samples")
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    # Копия для вывода; снимается под блокировкой реестра, пока другие потоки дописывают замеры
+    def snapshot(self):
+        copy = Histogram()
+        copy.bucket_counts = list(self.bucket_counts)
+        copy.count = self.count
+        copy.sum = self.sum
+        copy.samples = list(self.samples)
+        return copy
+
+    def quantile(self, q):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# Реестр метрик процесса: гистограммы и счётчики, сгруппированные по семействам
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, family, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get((family, name))
+            if histogram is None:
+                histogram = self.histograms[(family, name)] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, family, name, amount=1):
+        with self.lock:
+            self.counters[(family, name)] = self.counters.get((family, name), 0) + amount
+
+    # Замер длительности блока кода
+    @contextlib.contextmanager
+    def timer(self, family, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(family, name, time.perf_counter() - started)
+
+    # Гистограммы и счётчики, скопированные под блокировкой, в порядке (семейство, имя)
+    def _snapshot(self):
+        with self.lock:
+            histograms = [(key, histogram.snapshot()) for key, histogram in self.histograms.items()]
+            counters = list(self.counters.items())
+        return sorted(histograms, key=lambda item: item[0]), sorted(counters)
+
+    # Текстовый формат Prometheus
+    def render_prometheus(self):
+        lines = []
+        histograms, counters = self._snapshot()
+        families = []
+        for (family, name), histogram in histograms:
+            metric = f"{METRICS_PREFIX}_{family}"
+            if family not in families:
+                families.append(family)
+                lines.append(f"# TYPE {metric} histogram")
+            for bound, bucket_count in zip(BUCKETS, histogram.bucket_counts):
+                lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {bucket_count}')
+            lines.append(f'{metric}_bucket{{name="{name}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{name="{name}"}} {histogram.sum:.6f}')
+            lines.append(f'{metric}_count{{name="{name}"}} {histogram.count}')
+        for (family, name), value in counters:
+            metric = f"{METRICS_PREFIX}_{family}"
+            if family not in families:
+                families.append(family)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f'{metric}{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    # Краткая сводка для /stats и лога: p50/p95 по гистограммам и значения счётчиков
+    def render_summary(self):
+        histograms, counters = self._snapshot()
+        if not histograms and not counters:
+            return "Метрик пока нет."
+        lines = [
+            f"{family} {name}: n={h.count}, p50={h.quantile(0.5) * 1000:.0f} мс, p95={h.quantile(0.95) * 1000:.0f} мс"
+            for (family, name), h in histograms
+        ]
+        lines += [f"{family} {name}: {value}" for (family, name), value in counters]
+        return "\n".join(lines)
+
+metrics = MetricsRegistry()
+
+# Декоратор замера длительности асинхронного обработчика
+def timed(family, name):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(family, name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Периодическая запись сводки метрик в лог
+async def log_digest(interval=METRICS_LOG_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Сводка метрик:\n" + metrics.render_summary())
+
+# Отдельный HTTP-сервер /metrics; возвращает AppRunner для остановки.
+# На публичном порту webhook метрики не отдаются: сервер метрик слушает свой порт.
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    from aiohttp import web  # aiohttp нужен только при включённом экспорте
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики Prometheus доступны на {host}:{port}: /metrics")
+    return runner
@@ -0,0 +1,87 @@
+import sys
+import logging
+import argparse
+import datetime
+from google_sheets import get_sheet, month_tabs, month_title, upsert_rows, sheets_call
+
+logger = logging.getLogger(__name__)
+
+# Перенос истории из sheet1 в листы месяцев ('YYYY-MM') для режима SHEETS_PARTITION=month.
+# Порядок: остановить бота (чтобы журнал не писал в sheet1), запустить
+#   python migrate_sheets.py --dry-run   # посмотреть, сколько строк уйдёт в какой месяц
+#   python migrate_sheets.py
+# затем задать SHEETS_PARTITION=month и запустить бота. Перенос идемпотентен: строки
+# записываются с заменой по (дата, код), повторный запуск ничего не дублирует.
+# В листах месяцев на каждую пару (дата, код) остаётся одна строка — последняя в sheet1;
+# более ранние сверки того же товара за тот же день не переносятся и выводятся списком.
+# sheet1 не изменяется и остаётся архивом; его можно очистить вручную после проверки.
+
+# Числа из get_all_values приходят строками; в листы месяцев они записываются числами
+def parse_number(value):
+    if isinstance(value, str):
+        try:
+            number = float(value.replace(",", ".").replace("\xa0", "").replace(" ", ""))
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() else number
+    return value
+
+# Разбиение строк листа по месяцам; строки без корректной даты (заголовок и т.п.) пропускаются.
+# Из повторов (дата, код) остаётся последняя строка, остальные возвращаются в duplicates.
+def split_by_month(all_values):
+    latest = {}
+    skipped = []
+    duplicates = []
+    for row in all_values:
+        date = str(row[0]).strip() if row else ""
+        try:
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            skipped.append(row)
+            continue
+        row = (list(row) + [""] * 6)[:6]
+        row = [date, str(row[1]).strip()] + row[2:3] + [parse_number(value) for value in row[3:]]
+        previous = latest.pop((row[0], row[1]), None)
+        if previous is not None:
+            duplicates.append(previous)
+        latest[(row[0], row[1])] = row
+    months = {}
+    for row in latest.values():
+        months.setdefault(month_title(row[0]), []).append(row)
+    return months, skipped, duplicates
+
+# Перенос sheet1 в листы месяцев; возвращает ({месяц: число строк}, число пропущенных строк,
+# непереносимые повторы (дата, код))
+def migrate(dry_run=False):
+    sheet = get_sheet()
+    months, skipped, duplicates = split_by_month(sheets_call("get_all_values", sheet.get_all_values))
+    for title, rows in sorted(months.items()):
+        if not dry_run:
+            upsert_rows(month_tabs.get(title, create=True), rows)
+        logger.info(f"{title}: {len(rows)} строк" + (" (проверка, без записи)" if dry_run else " перенесено"))
+    if duplicates:
+        logger.warning(f"Повторов (дата, код) не перенесено: {len(duplicates)}; в листах месяцев остаётся последняя сверка дня")
+    return {title: len(rows) for title, rows in months.items()}, len(skipped), duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description="Разбиение истории sheet1 на листы по месяцам")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, сколько строк попадёт в каждый месяц")
+    args = parser.parse_args()
+
+    counts, skipped, duplicates = migrate(dry_run=args.dry_run)
+    for title, count in sorted(counts.items()):
+        print(f"{title}: {count}")
+    if duplicates:
+        print(f"Не переносятся более ранние сверки того же товара за тот же день ({len(duplicates)}):")
+        for row in duplicates:
+            print("  " + "\t".join(str(value) for value in row))
+    print(
+        f"Всего строк: {sum(counts.values())}, месяцев: {len(counts)}, пропущено строк без даты: {skipped}, "
+        f"повторов (дата, код): {len(duplicates)}"
+    )
+    if not args.dry_run:
+        print("Готово. Задайте SHEETS_PARTITION=month и перезапустите бота.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from dotenv import load_dotenv
+from metrics import metrics
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Лимиты исходящих сообщений Telegram: около 1 сообщения в секунду в один чат,
+# 20 сообщений в минуту в группу и 30 сообщений в секунду на бота
+load_dotenv()
+TELEGRAM_GLOBAL_PER_SECOND = float(os.getenv("TELEGRAM_GLOBAL_PER_SECOND", "25"))
+TELEGRAM_CHAT_PER_SECOND = float(os.getenv("TELEGRAM_CHAT_PER_SECOND", "1"))
+TELEGRAM_GROUP_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_PER_MINUTE", "20"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))  # Сколько сообщений подряд можно отправить без паузы
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))  # Повторов одного сообщения после RetryAfter
+MESSAGE_LIMIT = 4096  # Предел длины текста сообщения Telegram
+COALESCE_SEPARATOR = "\n\n"
+CHAT_LIMITERS_MAX = 1024  # После скольких чатов ограничители простаивающих чатов удаляются
+
+# Группа или канал (отрицательный chat_id или @username) — у них поминутный лимит
+def is_group(chat_id):
+    return str(chat_id).startswith(("-", "@"))
+
+# Длина текста так, как её считает Telegram (в кодовых единицах UTF-16: эмодзи занимают две)
+def message_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+# Разбиение длинного текста на части не длиннее limit по границам строк;
+# строка длиннее limit режется на куски
+def split_text(text, limit=MESSAGE_LIMIT):
+    if message_length(text) <= limit:
+        return [text]
+    chunks = []
+    current = []
+    current_length = 0
+    for line in text.split("\n"):
+        while message_length(line) > limit:
+            cut = limit
+            while message_length(line[:cut]) > limit:
+                cut -= 1
+            if current:
+                chunks.append("\n".join(current))
+                current, current_length = [], 0
+            chunks.append(line[:cut])
+            line = line[cut:]
+        length = message_length(line)
+        if current and current_length + 1 + length > limit:
+            chunks.append("\n".join(current))
+            current, current_length = [], 0
+        current_length += length + (1 if current else 0)
+        current.append(line)
+    if current:
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()] or [text[:limit]]
+
+# Пауза из RetryAfter, с (в PTB это число секунд или timedelta)
+def retry_after_seconds(error):
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+# Исходящее сообщение в очереди чата; photo задано у фото (text тогда — подпись)
+class OutgoingMessage:
+    __slots__ = ("text", "reply_markup", "parse_mode", "future", "photo")
+
+    def __init__(self, text, reply_markup, parse_mode, future, photo=None):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.future = future
+        self.photo = photo
+
+    # Можно ли дописать next_message в это же сообщение: клавиатура бывает только в конце,
+    # режим разметки совпадает, а общий текст не длиннее лимита; фото не склеиваются
+    def can_absorb(self, next_message):
+        return (
+            self.photo is None
+            and next_message.photo is None
+            and self.reply_markup is None
+            and self.parse_mode == next_message.parse_mode
+            and message_length(self.text) + len(COALESCE_SEPARATOR) + message_length(next_message.text) <= MESSAGE_LIMIT
+        )
+
+# Очередь исходящих сообщений. У каждого чата своя очередь и своя задача отправки, так что
+# порядок сообщений в чате сохраняется, а медленный чат (группа) не задерживает остальные.
+# Тексты, скопившиеся в очереди, пока чат ждёт своей очереди по лимиту, склеиваются в одно
+# сообщение; длинные тексты делятся на части по 4096 символов. При RetryAfter отправка
+# в этот чат приостанавливается на указанное время и повторяется.
+class Outbox:
+    def __init__(self):
+        self.global_limiter = TokenBucket(TELEGRAM_GLOBAL_PER_SECOND, capacity=max(1, int(TELEGRAM_GLOBAL_PER_SECOND)))
+        self.chat_limiters = {}
+        self.queues = {}
+        self.workers = {}
+
+    # Лимит чата: группы и каналы — поминутный, личные чаты — посекундный
+    def _chat_limiter(self, chat_id):
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            if is_group(chat_id):
+                limiter = TokenBucket(TELEGRAM_GROUP_PER_MINUTE / 60, capacity=TELEGRAM_CHAT_BURST)
+            else:
+                limiter = TokenBucket(TELEGRAM_CHAT_PER_SECOND, capacity=TELEGRAM_CHAT_BURST)
+            self.chat_limiters[chat_id] = limiter
+        return limiter
+
+    # Постановка текста в очередь чата без ожидания отправки. Возвращает future с отправленным
+    # сообщением (последней частью) или None, если отправить не удалось — ошибка пишется в лог.
+    def send(self, bot, chat_id, text, reply_markup=None, parse_mode=None):
+        return self._enqueue(bot, chat_id, OutgoingMessage(str(text), reply_markup, parse_mode, None))
+
+    # Постановка фото в очередь чата (photo — bytes, файл или file_id); в общем порядке сообщений чата
+    def send_photo(self, bot, chat_id, photo, caption=None, reply_markup=None, parse_mode=None):
+        return self._enqueue(bot, chat_id, OutgoingMessage(caption or "", reply_markup, parse_mode, None, photo))
+
+    def _enqueue(self, bot, chat_id, message):
+        future = message.future = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault(chat_id, deque())
+        queue.append(message)
+        metrics.inc("telegram_queued_total", "group" if is_group(chat_id) else "private")
+        if chat_id not in self.workers:
+            if len(self.chat_limiters) > CHAT_LIMITERS_MAX:
+                self._prune()
+            self.workers[chat_id] = asyncio.create_task(self._run(bot, chat_id))
+        return future
+
+    # Удаление ограничителей чатов, которым нечего отправлять и чей лимит уже восстановился
+    def _prune(self):
+        now = time.monotonic()
+        for chat_id, limiter in list(self.chat_limiters.items()):
+            if chat_id not in self.workers and limiter.tokens + (now - limiter.updated_at) * limiter.rate >= limiter.capacity:
+                del self.chat_limiters[chat_id]
+
+    # Следующее сообщение чата: подряд идущие тексты из очереди склеиваются
+    def _take(self, queue):
+        first = queue.popleft()
+        message = OutgoingMessage(first.text, first.reply_markup, first.parse_mode, None, first.photo)
+        futures = [first.future]
+        while queue and message.can_absorb(queue[0]):
+            following = queue.popleft()
+            message.text += COALESCE_SEPARATOR + following.text
+            message.reply_markup = following.reply_markup
+            futures.append(following.future)
+            metrics.inc("telegram_coalesced_total", "messages")
+        return message, futures
+
+    async def _acquire(self, chat_id):
+        started = time.monotonic()
+        await asyncio.sleep(self._chat_limiter(chat_id).reserve())
+        await asyncio.sleep(self.global_limiter.reserve())
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            metrics.observe("telegram_send_wait_seconds", "group" if is_group(chat_id) else "private", waited)
+
+    async def _run(self, bot, chat_id):
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                # Пока чат ждёт маркера, в очередь успевают прийти новые тексты — они уйдут одним сообщением
+                await self._acquire(chat_id)
+                message, futures = self._take(queue)
+                result = None
+                try:
+                    if message.photo is not None:
+                        result = await self._deliver(
+                            bot, chat_id, message.text, message.reply_markup, message.parse_mode, message.photo
+                        )
+                        chunks = ()
+                    else:
+                        chunks = split_text(message.text)
+                    for index, chunk in enumerate(chunks):
+                        if index:
+                            await self._acquire(chat_id)
+                        last = index == len(chunks) - 1
+                        result = await self._deliver(
+                            bot, chat_id, chunk, message.reply_markup if last else None, message.parse_mode
+                        )
+                    if len(chunks) > 1:
+                        metrics.inc("telegram_chunks_total", "split", len(chunks) - 1)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Сообщение потеряно: future получает None, ошибка — в лог и в счётчик
+                    metrics.inc("telegram_send_failed_total", "group" if is_group(chat_id) else "private", len(futures))
+                    logger.error(f"Ошибка при отправке сообщения в чат {chat_id}: {e}", exc_info=True)
+                    result = None
+                for future in futures:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self.workers.pop(chat_id, None)
+            self.queues.pop(chat_id, None)
+            # Сообщения остаются в очереди, только если задача отменена
+            for message in queue:
+                message.future.cancel()
+
+    # Отправка одного сообщения (или фото с подписью text) с повтором после RetryAfter (флуд-контроль Telegram)
+    async def _deliver(self, bot, chat_id, text, reply_markup, parse_mode, photo=None):
+        from telegram.error import RetryAfter
+
+        kind = "group" if is_group(chat_id) else "private"
+        attempt = 0
+        while True:
+            try:
+                if photo is not None:
+                    result = await bot.send_photo(
+                        chat_id, photo, caption=text or None, reply_markup=reply_markup, parse_mode=parse_mode
+                    )
+                else:
+                    result = await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+                metrics.inc("telegram_sent_total", kind)
+                return result
+            except RetryAfter as e:
+                if attempt >= TELEGRAM_MAX_RETRIES:
+                    raise
+                attempt += 1
+                delay = retry_after_seconds(e)
+                metrics.inc("telegram_retry_after_total", kind)
+                logger.warning(f"Флуд-контроль Telegram для чата {chat_id}: повтор {attempt} через {delay:.0f} с")
+                # Весь лимит чата сдвигается на время паузы, чтобы следующие сообщения её не нарушили
+                self._chat_limiter(chat_id).reserve(delay * self._chat_limiter(chat_id).rate)
+                await asyncio.sleep(delay)
+
+    # Ожидание отправки всего, что уже стоит в очередях (при остановке бота, до закрытия HTTP-клиента)
+    async def drain(self, timeout=None):
+        workers = [task for task in self.workers.values() if not task.done()]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+        left = sum(len(queue) for queue in self.queues.values())
+        if left:
+            metrics.inc("telegram_send_failed_total", "drain_timeout", left)
+            logger.error(f"Не отправлено сообщений при остановке: {left} (истёк таймаут {timeout} с)")
+
+outbox = Outbox()
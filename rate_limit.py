@@ -0,0 +1,42 @@
+import time
+import threading
+
+# Потокобезопасный ограничитель частоты запросов «маркерная корзина»:
+# rate маркеров в секунду, не более capacity накопленных маркеров.
+# acquire() блокирует вызывающий поток до появления маркера.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Получение маркера; возвращает время ожидания в секундах или None, если ожидание прервано событием cancel
+    def acquire(self, tokens=1, cancel=None):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            if cancel is None:
+                time.sleep(delay)
+            elif cancel.wait(delay):
+                return None
+            waited += delay
+
+    # Резервирование маркера без блокировки: маркер списывается сразу (баланс может уйти в минус),
+    # возвращается пауза в секундах, после которой его можно использовать (для asyncio: await asyncio.sleep)
+    def reserve(self, tokens=1):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import logging
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Время жизни сессии без действий пользователя и период проверки, с
+load_dotenv()
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+
+# Этапы жизненного цикла сессии сверки
+IDLE = "idle"  # Сверка не начиналась
+ACTIVE = "active"  # Файл остатков загружен, идёт подсчёт, сверка или исправление
+FINISHED = "finished"  # Сводка отправлена или сверка отменена
+EXPIRED = "expired"  # Сессия брошена и очищена по истечении SESSION_TTL
+
+# Шаги диалога до загрузки файла остатков: данных нет, истекать нечему
+PRE_UPLOAD_STATES = (None, 'waiting_for_file')
+
+# Состояние диалога одного пользователя. Тяжёлые данные (выгрузка, остатки, расхождения)
+# живут только пока сессия активна и освобождаются при завершении или истечении срока.
+class CountSession:
+    __slots__ = (
+        "stage", "state", "touched_at",
+        "products", "product_index", "actual_stocks", "bulk_counts",
+        "stock_task", "system_stocks", "outside_stock", "discrepancies",
+        "edit_code", "history_code",
+    )
+
+    def __init__(self):
+        self.stage = IDLE
+        self.state = None  # Шаг диалога: waiting_for_file, ready_check, input, check, checking, review, edit, ...
+        self.touched_at = time.monotonic()
+        self.history_code = None
+        self.release()
+
+    def touch(self):
+        self.touched_at = time.monotonic()
+
+    # Новая сверка: снимок товаров каталога и задача разбора загруженной выгрузки
+    def begin(self, products, stock_task):
+        self.release()
+        self.stage = ACTIVE
+        self.state = 'ready_check'
+        self.products = products
+        self.stock_task = stock_task
+
+    # Сброс к началу диалога (команда /start)
+    def reset(self):
+        self.stage = IDLE
+        self.state = 'waiting_for_file'
+        self.release()
+
+    # Сверка завершена (сводка отправлена или отменена): данные больше не нужны
+    def finish(self):
+        self.stage = FINISHED
+        self.state = None
+        self.release()
+
+    # Брошенная сессия: очищается так же, как завершённая, но пользователю сообщается об истечении
+    def expire(self):
+        self.stage = EXPIRED
+        self.state = None
+        self.history_code = None
+        self.release()
+
+    # Брошенный диалог вне сверки (например, выбор периода /history): шаг сбрасывается молча,
+    # этап не меняется — сверки не было, сообщать об истечении нечего
+    def abandon_dialog(self):
+        self.state = None
+        self.history_code = None
+
+    # Освобождение тяжёлых данных сессии; незавершённый разбор выгрузки отменяется
+    def release(self):
+        task = getattr(self, "stock_task", None)
+        if task is not None and not task.done():
+            task.cancel()
+        self.products = None
+        self.product_index = 0
+        self.actual_stocks = {}
+        self.bulk_counts = None
+        self.stock_task = None
+        self.system_stocks = None
+        self.outside_stock = None
+        self.discrepancies = None
+        self.edit_code = None
+
+    # Сессия держит данные, а пользователь не отвечал дольше ttl.
+    # Ожидание файла после /start не истекает: иначе пользователь, не начавший сверку, получил бы «сессия истекла».
+    def is_stale(self, now, ttl):
+        return (self.stage == ACTIVE or self.state not in PRE_UPLOAD_STATES) and now - self.touched_at > ttl
+
+    # Приблизительный объём памяти сессии, байт (товары каталога общие для всех сессий и не учитываются)
+    def payload_size(self):
+        seen = {id(p) for p in self.products or ()}
+        size = deep_size(self, seen)
+        task = self.stock_task
+        if task is not None and task.done() and not task.cancelled() and task.exception() is None:
+            size += deep_size(task.result(), seen)
+        return size
+
+# Сессия пользователя из context.user_data (создаётся при первом обращении)
+def get_session(user_data):
+    session = user_data.get('session')
+    if session is None:
+        session = user_data['session'] = CountSession()
+    session.touch()
+    return session
+
+# Очистка брошенных сессий: активная сверка истекает (EXPIRED, пользователю сообщается),
+# прочие диалоги сбрасываются молча. Возвращает число истёкших сверок.
+def sweep_sessions(user_datas, ttl=SESSION_TTL):
+    now = time.monotonic()
+    expired = 0
+    for user_data in list(user_datas):
+        session = user_data.get('session')
+        if session is None or not session.is_stale(now, ttl):
+            continue
+        if session.stage == ACTIVE:
+            session.expire()
+            expired += 1
+        else:
+            session.abandon_dialog()
+    if expired:
+        logger.info(f"Очищено брошенных сессий: {expired}")
+    return expired
+
+# Рекурсивная оценка размера объекта: контейнеры, строки и объекты со __slots__
+def deep_size(value, seen=None):
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif hasattr(value, "__slots__"):
+        size += sum(deep_size(getattr(value, name, None), seen) for name in value.__slots__)
+    elif hasattr(value, "__dict__"):
+        size += deep_size(vars(value), seen)
+    return size
+
+# Текущий объём резидентной памяти процесса, байт (Linux: /proc, иначе пиковое значение)
+def process_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Отчёт об использовании памяти: процесс и сессии пользователей по этапам
+def memory_report(user_datas):
+    stages = {}
+    payload = 0
+    largest = 0
+    for user_data in list(user_datas):
+        session = user_data.get('session')
+        if session is None:
+            continue
+        stages[session.stage] = stages.get(session.stage, 0) + 1
+        size = session.payload_size()
+        payload += size
+        largest = max(largest, size)
+    lines = [
+        f"RSS процесса: {process_rss() / 2 ** 20:.1f} МБ",
+        f"Сессий: {sum(stages.values())} ("
+        + ", ".join(f"{stage}: {count}" for stage, count in sorted(stages.items())) + ")" if stages else "Сессий: 0",
+        f"Данные сессий: {payload / 2 ** 10:.1f} КБ, крупнейшая: {largest / 2 ** 10:.1f} КБ",
+        f"Срок жизни брошенной сессии: {SESSION_TTL:.0f} с",
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,155 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from dotenv import load_dotenv
+from executors import run_sheets, run_local
+from google_sheets import upsert_by_date, api_error_status
+from history_store import history_store
+
+logger = logging.getLogger(__name__)
+
+# Настройки журнала отложенной записи в Google Sheets
+load_dotenv()
+SHEETS_JOURNAL_FILE = os.getenv("SHEETS_JOURNAL_FILE", "sheets_journal.jsonl")
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", "500"))
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "5"))
+JOURNAL_BASE_BACKOFF = float(os.getenv("JOURNAL_BASE_BACKOFF", "1"))
+JOURNAL_MAX_BACKOFF = float(os.getenv("JOURNAL_MAX_BACKOFF", "300"))
+
+# Журнал строк для Google Sheets: строки сначала дописываются в локальный файл (с fsync),
+# затем фоновая задача переносит их в лист. Смещение отправленной части хранится в
+# файле <журнал>.offset; записи идемпотентны по (дата, код), поэтому повторная
+# отправка после сбоя не создаёт дублей.
+class SheetsJournal:
+    def __init__(self, path=SHEETS_JOURNAL_FILE):
+        self.path = path
+        self.offset_path = f"{path}.offset"
+        self.rejected_path = f"{path}.rejected"
+        self.lock = threading.Lock()
+
+    # Добавление строк в журнал; возвращается после fsync
+    def append(self, rows):
+        if not rows:
+            return
+        data = "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        history_store.record_rows(rows)
+        logger.info(f"В журнал Google Sheets добавлено строк: {len(rows)}")
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path, "r", encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = f"{self.offset_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    # Неотправленные строки (не более limit, None — все) и смещение конца прочитанной части
+    def pending(self, limit=JOURNAL_BATCH_SIZE):
+        with self.lock:
+            if not os.path.exists(self.path):
+                return [], 0
+            offset = self._read_offset()
+            if offset > os.path.getsize(self.path):
+                offset = 0
+            rows = []
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                while limit is None or len(rows) < limit:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        # Недописанная строка (сбой во время записи) — остаётся на следующий раз
+                        break
+                    offset += len(line)
+                    try:
+                        rows.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.error(f"Пропущена повреждённая запись журнала: {line[:200]!r}")
+            return rows, offset
+
+    # Отметка строк до offset как отправленных; полностью отправленный журнал очищается.
+    # Сначала записывается смещение 0, затем журнал обрезается: при сбое между этими шагами
+    # строки отправятся повторно (это безопасно), а не пропустятся из-за устаревшего смещения.
+    def commit(self, offset):
+        with self.lock:
+            if offset >= os.path.getsize(self.path):
+                self._write_offset(0)
+                open(self.path, "w").close()
+            else:
+                self._write_offset(offset)
+
+    # Перенос строк, которые нельзя записать (повтор ничего не изменит), в файл <журнал>.rejected
+    def reject(self, rows, error):
+        with open(self.rejected_path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps({"row": row, "error": repr(error)}, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        logger.error(f"Строки ({len(rows)}) не записаны в Google Sheets и сохранены в {self.rejected_path}: {error!r}")
+
+# Ошибки, при которых запись стоит повторить: квоты (429), ошибки сервера (5xx) и сеть.
+# Прочие исключения (ошибка в данных строки, 4xx) повторяются бесконечно с тем же результатом
+# и останавливали бы весь журнал, поэтому такие пакеты откладываются в .rejected.
+def is_retryable(error):
+    status = api_error_status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return is_transport_error(error)
+
+# Сетевые ошибки: соединение, таймауты, обрыв ответа (requests, google-auth, сокеты)
+def is_transport_error(error):
+    import requests
+    from google.auth.exceptions import TransportError
+
+    return isinstance(error, (
+        requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+        TransportError, ConnectionError, TimeoutError,
+    ))
+
+# Фоновая задача: переносит журнал в лист пакетами, повторяя с экспоненциальной задержкой.
+# При запуске сначала дописывает всё, что осталось в журнале с прошлого запуска.
+async def run_flusher(journal, wakeup: asyncio.Event):
+    attempt = 0
+    while True:
+        wakeup.clear()
+        rows, offset = await run_local(journal.pending)
+        if not rows:
+            if offset:
+                await run_local(journal.commit, offset)
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=JOURNAL_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await run_sheets(upsert_by_date, rows)
+            await run_local(journal.commit, offset)
+            attempt = 0
+            logger.info(f"Из журнала в Google Sheets отправлено строк: {len(rows)}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                await run_local(journal.reject, rows, e)
+                await run_local(journal.commit, offset)
+                attempt = 0
+                continue
+            delay = min(JOURNAL_MAX_BACKOFF, JOURNAL_BASE_BACKOFF * 2 ** attempt)
+            attempt += 1
+            logger.warning(f"Ошибка записи журнала в Google Sheets (попытка {attempt}), повтор через {delay:.0f} с: {e}")
+            await asyncio.sleep(delay)
+
+sheets_journal = SheetsJournal()
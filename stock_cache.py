@@ -0,0 +1,127 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Размер кэша разобранных выгрузок в памяти и каталог для их компактной копии на диске (необязательно)
+load_dotenv()
+STOCK_CACHE_SIZE = int(os.getenv("STOCK_CACHE_SIZE", "8"))
+STOCK_CACHE_DIR = os.getenv("STOCK_CACHE_DIR")  # Если не задан, кэш хранится только в памяти
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Разобранная выгрузка: агрегированные остатки и время, когда файл был получен впервые
+class StockSnapshot:
+    __slots__ = ("digest", "stocks", "ingested_at")
+
+    def __init__(self, digest, stocks, ingested_at):
+        self.digest = digest
+        self.stocks = stocks
+        self.ingested_at = ingested_at
+
+    # Компактная форма для диска: столбцы вместо словаря словарей
+    def to_dict(self):
+        return {
+            "ingested_at": self.ingested_at.isoformat(),
+            "codes": list(self.stocks),
+            "names": [data["name"] for data in self.stocks.values()],
+            "quantities": [data["quantity"] for data in self.stocks.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, digest, data):
+        stocks = {
+            code: {"name": name, "quantity": quantity}
+            for code, name, quantity in zip(data["codes"], data["names"], data["quantities"])
+        }
+        return cls(digest, stocks, datetime.datetime.fromisoformat(data["ingested_at"]))
+
+# SHA-256 содержимого выгрузки: bytes из памяти или путь к временному файлу
+def stock_digest(source):
+    digest = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray)):
+        digest.update(source)
+    else:
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+# LRU-кэш разобранных выгрузок по SHA-256 файла. Повторная загрузка того же файла
+# не разбирается заново. Методы блокирующие (диск), вызываются из пула run_local.
+class StockCache:
+    def __init__(self, max_size=STOCK_CACHE_SIZE, directory=STOCK_CACHE_DIR):
+        self.max_size = max_size
+        self.directory = directory
+        self.lock = threading.Lock()
+        self._items = OrderedDict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f"{digest}.json.gz")
+
+    # Снимок по хэшу или None; при промахе в памяти проверяется копия на диске
+    def get(self, digest):
+        with self.lock:
+            snapshot = self._items.get(digest)
+            if snapshot is not None:
+                self._items.move_to_end(digest)
+                return snapshot
+        if not self.directory:
+            return None
+        path = self._path(digest)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                snapshot = StockSnapshot.from_dict(digest, json.load(f))
+            os.utime(path)  # Порядок вытеснения на диске — по времени последнего использования
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша выгрузки {digest[:12]}: {e}")
+            return None
+        self._remember(snapshot)
+        return snapshot
+
+    # Сохранение результата разбора; время получения файла фиксируется при первом разборе
+    def put(self, digest, stocks, ingested_at=None):
+        snapshot = StockSnapshot(digest, stocks, ingested_at or datetime.datetime.now())
+        self._remember(snapshot)
+        if self.directory:
+            self._store(snapshot)
+        return snapshot
+
+    def _remember(self, snapshot):
+        with self.lock:
+            self._items[snapshot.digest] = snapshot
+            self._items.move_to_end(snapshot.digest)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    # Атомарная запись на диск и удаление самых старых копий сверх max_size
+    def _store(self, snapshot):
+        path = self._path(snapshot.digest)
+        tmp_path = f"{path}.tmp"
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump(snapshot.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, path)
+            files = sorted(
+                (os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json.gz")),
+                key=os.path.getmtime,
+            )
+            for old_path in files[:-self.max_size]:
+                os.remove(old_path)
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша выгрузки {snapshot.digest[:12]}: {e}")
+
+    def __len__(self):
+        return len(self._items)
+
+stock_cache = StockCache()
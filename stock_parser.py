@@ -0,0 +1,239 @@
+import os
+import logging
+from dotenv import load_dotenv
+from ingest import open_rows, find_header, detect_format, XlsxReader, SharedString, HEADER_SCAN_ROWS
+
+logger = logging.getLogger(__name__)
+
+# Столбцы выгрузки ЕГАИС, необходимые для сверки
+CODE_COLUMN = "Код товара"
+NAME_COLUMN = "Наименование карточки товара"
+QUANTITY_COLUMN = "Количество (1 регистр)"
+STOCK_COLUMNS = (CODE_COLUMN, NAME_COLUMN, QUANTITY_COLUMN)
+
+# Режим разбора: auto — выгрузки в памяти читаются движками по STOCK_INGEST_ENGINES (calamine быстрее
+# всего), а сброшенные во временный файл (больше UPLOAD_MEMORY_LIMIT) — потоково; stream — всегда
+# построчно с суммированием на лету (память зависит от числа кодов, а не от числа строк);
+# frame — всегда через DataFrame pandas
+load_dotenv()
+STOCK_PARSE_MODE = os.getenv("STOCK_PARSE_MODE", "auto")
+
+# Код товара как строка: числа из xlsx/xls приходят как 109 или 109.0
+def normalize_code(value):
+    if isinstance(value, float):
+        if value != value:
+            return None
+        if value.is_integer():
+            value = int(value)
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+# Количество как число: из CSV приходят строки вида "12,5" или "1 200"
+def normalize_quantity(value):
+    if isinstance(value, (int, float)) or value is None:
+        return value
+    try:
+        number = float(str(value).replace("\xa0", "").replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else number
+
+# Итог количества: целое число без дробной части (8, а не 8.0) во всех режимах разбора
+def total_quantity(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+# Строки данных выгрузки после заголовка: (движок, индексы столбцов кода, названия и количества, итератор строк)
+def open_stock_rows(source, file_name=None, engines=None, streaming=False):
+    engine, rows = open_rows(source, file_name, engines, streaming)
+    header_row, columns = find_header(rows, CODE_COLUMN)
+    if any(column not in columns for column in STOCK_COLUMNS):
+        raise KeyError("В файле отсутствуют необходимые столбцы.")
+    logger.debug(f"Выгрузка читается движком {engine}: заголовок в строке {header_row + 1}")
+    return engine, tuple(columns[column] for column in STOCK_COLUMNS), rows
+
+# Чтение только нужных столбцов выгрузки. Строка заголовка находится по столбцу «Код товара»,
+# формат (xlsx, xls, ods, csv) — по имени файла или содержимому, движок — по STOCK_INGEST_ENGINES.
+# source — путь к файлу или содержимое файла (bytes), загруженное в память.
+def read_stock_frame(source, file_name=None, engines=None):
+    import pandas as pd  # pandas загружается только при разборе файла
+
+    _, (code_index, name_index, quantity_index), rows = open_stock_rows(source, file_name, engines)
+    width = max(code_index, name_index, quantity_index) + 1
+    codes, names, quantities = [], [], []
+    for row in rows:
+        if len(row) < width:
+            row = list(row) + [None] * (width - len(row))
+        codes.append(normalize_code(row[code_index]))
+        name = row[name_index]
+        names.append(str(name).strip() if name is not None else None)
+        quantities.append(normalize_quantity(row[quantity_index]))
+    return pd.DataFrame({
+        CODE_COLUMN: pd.Series(codes, dtype=object),
+        NAME_COLUMN: pd.Series(names, dtype=object),
+        QUANTITY_COLUMN: pd.to_numeric(pd.Series(quantities, dtype=object), errors="coerce"),
+    })
+
+# Остатки выгрузки вне области сверки: число кодов и суммарное количество
+class OutsideStock:
+    __slots__ = ("codes", "quantity")
+
+    def __init__(self, codes=0, quantity=0):
+        self.codes = codes
+        self.quantity = quantity
+
+    # Одна строка сводки вместо построчного перечисления
+    def render(self):
+        quantity = int(self.quantity) if self.quantity == int(self.quantity) else round(self.quantity, 3)
+        return f"Вне каталога: {self.codes} кодов, всего {quantity} шт. (не сверялись)"
+
+# Суммирование количества по коду товара: {код: {"name": первое название, "quantity": сумма}}.
+# Порядок кодов — порядок первого появления в файле; строки без кода пропускаются.
+def aggregate_stock(df):
+    df = df.dropna(subset=[CODE_COLUMN])
+    df = df.assign(**{CODE_COLUMN: df[CODE_COLUMN].astype(str)})
+    quantities = df.groupby(CODE_COLUMN, sort=False)[QUANTITY_COLUMN].sum()
+    names = df.drop_duplicates(CODE_COLUMN)[NAME_COLUMN]
+    return {
+        code: {"name": name, "quantity": total_quantity(quantity)}
+        for code, name, quantity in zip(quantities.index.tolist(), names.tolist(), quantities.tolist())
+    }
+
+# Область сверки: остатки по кодам из codes и сводка OutsideStock по остальным.
+# codes=None — вся выгрузка без сводки.
+def scope_stock(stocks, codes):
+    if codes is None:
+        return stocks, None
+    scoped = {}
+    outside = OutsideStock()
+    for code, data in stocks.items():
+        if code in codes:
+            scoped[code] = data
+        else:
+            outside.codes += 1
+            outside.quantity += data["quantity"]
+    return scoped, outside
+
+# Потоковый разбор xlsx через XlsxReader. Итоги копятся по «сырому» значению кода
+# (число или ссылка на общую строку), тексты подставляются в конце только для кодов,
+# первых названий и количеств, записанных текстом. Память — по числу различных кодов.
+def stream_xlsx_stock(source):
+    with XlsxReader(source) as reader:
+        rows = reader.rows()
+        head = []
+        for number, cells in rows:
+            head.append((number, cells))
+            if len(head) >= HEADER_SCAN_ROWS:
+                break
+        texts = reader.shared_strings(
+            value.index for _, cells in head for value in cells.values() if isinstance(value, SharedString)
+        )
+        header_rows = [
+            [texts.get(value.index) if isinstance(value, SharedString) else value for value in _dense(cells)]
+            for _, cells in head
+        ]
+        header_row, columns = find_header(iter(header_rows), CODE_COLUMN)
+        if any(column not in columns for column in STOCK_COLUMNS):
+            raise KeyError("В файле отсутствуют необходимые столбцы.")
+        code_index, name_index, quantity_index = (columns[column] for column in STOCK_COLUMNS)
+
+        totals = {}  # сырой код -> [сырое первое название, сумма чисел, {индекс текстового количества: сколько раз}]
+        pending = head[header_row + 1:]
+        for number, cells in _chain_rows(pending, rows):
+            raw_code = cells.get(code_index)
+            if raw_code is None:
+                continue
+            quantity = cells.get(quantity_index)
+            entry = totals.get(raw_code)
+            if entry is None:
+                entry = totals[raw_code] = [cells.get(name_index), 0, None]
+            if isinstance(quantity, SharedString):
+                entry[2] = entry[2] or {}
+                entry[2][quantity.index] = entry[2].get(quantity.index, 0) + 1
+            elif quantity is not None and not isinstance(quantity, bool):
+                quantity = normalize_quantity(quantity)
+                if quantity:
+                    entry[1] += quantity
+
+        needed = set()
+        for raw_code, (raw_name, _, text_quantities) in totals.items():
+            for value in (raw_code, raw_name):
+                if isinstance(value, SharedString):
+                    needed.add(value.index)
+            needed.update(text_quantities or ())
+        texts = reader.shared_strings(needed)
+
+    def resolve(value):
+        return texts.get(value.index) if isinstance(value, SharedString) else value
+
+    stocks = {}
+    for raw_code, (raw_name, quantity, text_quantities) in totals.items():
+        code = normalize_code(resolve(raw_code))
+        if code is None:
+            continue
+        for index, count in (text_quantities or {}).items():
+            quantity += (normalize_quantity(texts.get(index)) or 0) * count
+        data = stocks.get(code)
+        if data is None:
+            name = resolve(raw_name)
+            stocks[code] = {"name": str(name).strip() if name is not None else None, "quantity": quantity}
+        else:
+            data["quantity"] += quantity
+    return _total_quantities(stocks)
+
+def _total_quantities(stocks):
+    for data in stocks.values():
+        data["quantity"] = total_quantity(data["quantity"])
+    return stocks
+
+# Разреженная строка {столбец: значение} в список
+def _dense(cells):
+    row = [None] * (max(cells) + 1 if cells else 0)
+    for column, value in cells.items():
+        row[column] = value
+    return row
+
+def _chain_rows(head, rows):
+    yield from head
+    yield from rows
+
+# Потоковый разбор: строки читаются по одной, из каждой берутся три нужных столбца,
+# количество сразу прибавляется к итогу по коду. xlsx читается через XlsxReader,
+# остальные форматы (и xlsx, который XlsxReader не смог прочитать) — потоковым движком ingest.
+# Результат тот же, что у aggregate_stock(read_stock_frame(...)): порядок первого появления кода,
+# первое название, сумма количества; строки без кода пропускаются.
+def stream_stock(source, file_name=None, engines=None):
+    if engines is None and detect_format(source, file_name) in (".xlsx", ".xlsm"):
+        try:
+            return stream_xlsx_stock(source)
+        except KeyError:
+            raise
+        except Exception as e:
+            logger.warning(f"Потоковое чтение xlsx не удалось, файл читается движками ingest: {e}")
+    _, (code_index, name_index, quantity_index), rows = open_stock_rows(source, file_name, engines, streaming=True)
+    width = max(code_index, name_index, quantity_index) + 1
+    stocks = {}
+    for row in rows:
+        if len(row) < width:
+            row = tuple(row) + (None,) * (width - len(row))
+        code = normalize_code(row[code_index])
+        if code is None:
+            continue
+        quantity = normalize_quantity(row[quantity_index])
+        if quantity != quantity:
+            quantity = None
+        data = stocks.get(code)
+        if data is None:
+            name = row[name_index]
+            stocks[code] = {"name": str(name).strip() if name is not None else None, "quantity": quantity or 0}
+        elif quantity:
+            data["quantity"] += quantity
+    return _total_quantities(stocks)
+
+# Разбор выгрузки ЕГАИС в словарь остатков. source — содержимое (bytes) или путь временного файла
+def parse_stock_file(source, file_name=None):
+    if STOCK_PARSE_MODE == "stream" or (STOCK_PARSE_MODE == "auto" and not isinstance(source, (bytes, bytearray))):
+        return stream_stock(source, file_name)
+    return aggregate_stock(read_stock_frame(source, file_name))
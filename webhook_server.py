@@ -0,0 +1,98 @@
+import os
+import hmac
+import json
+import signal
+import asyncio
+import logging
+from aiohttp import web
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Настройки режима webhook. Для локальной проверки достаточно отправить сохранённый update:
+#   curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json http://localhost:8080/telegram
+load_dotenv()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", "8080")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес; если не задан, set_webhook не вызывается
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# HTTP-приложение: приём обновлений Telegram и проверка работоспособности.
+# Метрики Prometheus сюда не входят: их отдаёт отдельный сервер на METRICS_PORT.
+def build_web_app(application: Application, secret_token, path=WEBHOOK_PATH):
+    expected_secret = secret_token.encode()
+
+    async def handle_update(request: web.Request):
+        # Сравнение байтов: заголовок с не-ASCII символами не вызывает TypeError в compare_digest
+        received_secret = request.headers.get(SECRET_HEADER, "").encode("utf-8", "surrogateescape")
+        if not hmac.compare_digest(received_secret, expected_secret):
+            logger.warning(f"Отклонён запрос webhook с неверным секретом от {request.remote}")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError(f"ожидался объект JSON, получен {type(data).__name__}")
+            update = Update.de_json(data, application.bot)
+        except (json.JSONDecodeError, ValueError, TypeError, KeyError) as e:
+            logger.error(f"Некорректное обновление webhook: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response(status=200)
+
+    async def handle_health(request: web.Request):
+        return web.json_response({
+            "status": "ok" if application.running else "stopping",
+            "pending_updates": application.update_queue.qsize(),
+        })
+
+    web_app = web.Application()
+    web_app.router.add_post(path, handle_update)
+    web_app.router.add_get("/health", handle_health)
+    return web_app
+
+# Запуск бота в режиме webhook. on_ready вызывается, когда сервер начал принимать обновления.
+# Завершение по SIGINT/SIGTERM: сервер перестаёт принимать запросы, затем Application
+# обрабатывает уже полученные обновления и фоновые задачи и только после этого останавливается.
+async def serve_webhook(application: Application, on_ready=None):
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для режима webhook необходимо задать WEBHOOK_SECRET")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    runner = web.AppRunner(build_web_app(application, WEBHOOK_SECRET))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Webhook-сервер запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"Webhook зарегистрирован в Telegram: {WEBHOOK_URL}")
+        if on_ready:
+            on_ready(stop_event)
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка webhook-сервера")
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)